@@ -0,0 +1,188 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""An audit log written to a database collection in the background.
+
+The RPC threads only queue records, a flusher thread writes them with one
+insert_many per batch, once `flush_size` records are queued or `flush_interval`
+seconds after the oldest was. When the queue is full new records are dropped
+(the default, an RPC never waits for the database) or the caller waits for
+room.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import logging
+import threading
+from monotonic import monotonic
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_FLUSH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+# What `AuditLog.log` does when the queue is full.
+POLICIES = ("drop", "block")
+
+
+class AuditLog(object):
+    """Batches records into a collection from a background thread.
+
+    :param collection: The collection written, e.g. a `pymongo.collection.Collection`.
+    :param max_queue: Maximum records queued and not yet written.
+    :param flush_size: Maximum records written by one insert_many.
+    :param flush_interval: Seconds a record may wait for more to be written with.
+    :param policy: "drop" to drop records when the queue is full, "block" to
+                   wait for room.
+    """
+
+    def __init__(self,
+                 collection,
+                 max_queue=DEFAULT_MAX_QUEUE,
+                 flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 policy="drop"):
+        if max_queue < 1 or flush_size < 1:
+            raise ValueError("max_queue and flush_size must be positive")
+        if policy not in POLICIES:
+            raise ValueError("Unknown audit log policy {}".format(policy))
+        self.collection = collection
+        self.max_queue = max_queue
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.cv = threading.Condition()
+        # (queued time, record)
+        self.records = collections.deque()
+        # Records taken by the flusher and not yet written.
+        self.writing = 0
+        # Set by `flush` to write the records queued without waiting.
+        self.requested = False
+        self.closed = False
+
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.blocked = 0
+
+        self.thread = threading.Thread(target=self._flusher, name="AuditLog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return "AuditLog({})".format(getattr(self.collection, "full_name", self.collection))
+
+    def log(self, record):
+        """Queue a record (a dictionary) to be written.
+
+        :return: True if the record was queued, False if it was dropped.
+        """
+        with self.cv:
+            if self.policy == "block" and len(self.records) >= self.max_queue:
+                self.blocked += 1
+                while not self.closed and len(self.records) >= self.max_queue:
+                    self.cv.wait()
+            if self.closed or len(self.records) >= self.max_queue:
+                self.dropped += 1
+                return False
+            self.records.append((monotonic(), record))
+            self.queued += 1
+            # The flusher waits for a first record or a full batch.
+            if len(self.records) == 1 or len(self.records) == self.flush_size:
+                self.cv.notify_all()
+            return True
+
+    def flush(self, timeout=None):
+        """Write the queued records now and wait until they are written.
+
+        :return: True if they were written (or failed to be) before `timeout`.
+        """
+        end = None if timeout is None else monotonic() + timeout
+        with self.cv:
+            self.requested = True
+            self.cv.notify_all()
+            while self.records or self.writing:
+                remaining = None if end is None else end - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cv.wait(remaining)
+            return True
+
+    def _next_batch(self):
+        # Must be called with cv held, returns None once closed and written.
+        while True:
+            if self.records:
+                if self.closed or self.requested or len(self.records) >= self.flush_size:
+                    break
+                remaining = self.records[0][0] + self.flush_interval - monotonic()
+                if remaining <= 0:
+                    break
+                self.cv.wait(remaining)
+            elif self.closed:
+                return None
+            else:
+                self.requested = False
+                self.cv.wait()
+        batch = []
+        while self.records and len(batch) < self.flush_size:
+            batch.append(self.records.popleft()[1])
+        self.writing = len(batch)
+        # Room for the callers waiting in log.
+        self.cv.notify_all()
+        return batch
+
+    def _flusher(self):
+        while True:
+            with self.cv:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except Exception as ex:  # pylint: disable=W0703
+                logger.warning("%s: Dropping %d records: %s", str(self), len(batch), str(ex))
+                with self.cv:
+                    self.failed += len(batch)
+            else:
+                with self.cv:
+                    self.flushed += len(batch)
+                    self.batches += 1
+            with self.cv:
+                self.writing = 0
+                if not self.records:
+                    self.requested = False
+                self.cv.notify_all()
+
+    def close(self):
+        """Write the queued records and stop the flusher."""
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def stats(self):
+        """Return a dictionary with a consistent copy of the counters."""
+        with self.cv:
+            return {
+                "queued": self.queued,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+                "pending": len(self.records) + self.writing,
+                "max-queue": self.max_queue,
+                "blocked": self.blocked,
+            }
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+from collections import OrderedDict
+import logging
+import threading
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ReplyCache(object):
+    """Versioned cache of rendered datastore subtrees.
+
+    Each datastore (collection) has a version counter that every write path
+    must bump with `invalidate`, invalidating all of them bumps a generation
+    counter instead. Entries are keyed by (name, generation, version) so a
+    write makes all older renderings unreachable; they are dropped eagerly.
+
+    The rendering is kept as serialized XML and a fresh element is parsed for
+    every hit, callers are free to prune or re-parent the returned element
+    (the filtering code does both).
+
+    :param max_entries: Maximum number of cached renderings.
+    :param max_bytes: Maximum total size of the cached renderings.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.versions = {}
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, name):
+        """Return the current (generation, version) of datastore `name`."""
+        with self.lock:
+            return self.generation, self.versions.get(name, 0)
+
+    def invalidate(self, name=None):
+        """Bump the version of datastore `name`, or the generation of all
+        datastores if `None`, including those never rendered yet."""
+        with self.lock:
+            if name is None:
+                self.generation += 1
+                self.versions.clear()
+                self.entries.clear()
+                self.nbytes = 0
+                return
+            self.versions[name] = self.versions.get(name, 0) + 1
+            for key in [k for k in self.entries if k[0] == name]:
+                self._remove(key)
+
+    def lookup(self, name, render):
+        """Return the rendering of datastore `name` calling `render` on a miss.
+
+        :param name: The datastore name.
+        :param render: A callable returning the rendered `lxml.Element` or None.
+        :return: A private copy of the rendered element or None.
+        """
+        with self.lock:
+            key = (name, self.generation, self.versions.get(name, 0))
+            xml = self.entries.get(key)
+            if xml is not None:
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if xml is not None:
+            return etree.fromstring(xml)
+
+        element = render()
+        if element is None:
+            return None
+        xml = etree.tostring(element, encoding="utf-8")
+        with self.lock:
+            # Don't store a rendering a write raced with.
+            current = (name, self.generation, self.versions.get(name, 0))
+            if key == current and key not in self.entries:
+                self.entries[key] = xml
+                self.nbytes += len(xml)
+                self._evict()
+        return element
+
+    def stats(self):
+        """Return a dictionary of the cache counters."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+            }
+
+    def _remove(self, key):
+        self.nbytes -= len(self.entries.pop(key))
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.nbytes > self.max_bytes):
+            key = next(iter(self.entries))
+            logger.debug("Evicting rendered datastore %s", str(key))
+            self._remove(key)
+            self.evictions += 1
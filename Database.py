@@ -0,0 +1,151 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import threading
+from monotonic import monotonic
+from pymongo import MongoClient, monitoring
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URI = "mongodb://localhost:27017/"
+DEFAULT_DATABASE = "netconfserver"
+DEFAULT_POOL_SIZE = 100
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_MAX_IDLE = 300.0
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool listener keeping running counters for a `MongoClient`.
+
+    pymongo emits the checkout events on the thread doing the checkout so the
+    start time of a pending checkout is kept thread local.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkins = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.created = 0
+        self.closed = 0
+        self.pools_cleared = 0
+
+    def snapshot(self):
+        """Return a dictionary with a consistent copy of the counters."""
+        with self.lock:
+            checkouts = self.checkouts
+            return {
+                "checkouts": checkouts,
+                "checkout-failures": self.checkout_failures,
+                "checkins": self.checkins,
+                "checked-out": checkouts - self.checkins,
+                "wait-total": self.wait_total,
+                "wait-max": self.wait_max,
+                "wait-avg": self.wait_total / checkouts if checkouts else 0.0,
+                "open-sockets": self.created - self.closed,
+                "sockets-created": self.created,
+                "sockets-closed": self.closed,
+                "pools-cleared": self.pools_cleared,
+            }
+
+    def _checkout_done(self):
+        start = getattr(self.local, "start", None)
+        self.local.start = None
+        if start is None:
+            return 0.0
+        return monotonic() - start
+
+    # ---------------------------------
+    # monitoring.ConnectionPoolListener
+    # ---------------------------------
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pools_cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        self.local.start = monotonic()
+
+    def connection_check_out_failed(self, event):
+        self._checkout_done()
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        waited = self._checkout_done()
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checkins += 1
+
+
+def connect(uri=DEFAULT_URI,
+            pool_size=DEFAULT_POOL_SIZE,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            max_idle=DEFAULT_MAX_IDLE,
+            stats=None):
+    """Create a long lived pooled `MongoClient`.
+
+    The client is meant to be created once and shared by all sessions, pymongo
+    clients are thread safe and connect lazily.
+
+    :param uri: The MongoDB connection URI.
+    :param pool_size: Maximum number of sockets kept in the pool.
+    :param connect_timeout: Connection timeout in fractional seconds.
+    :param max_idle: Seconds a pooled socket may be idle before being closed or
+                     `None` to keep them forever.
+    :param stats: An optional `PoolStats` listener to register with the client.
+    :return: The client.
+    :rtype: `pymongo.MongoClient`
+    """
+    kwargs = {
+        "maxPoolSize": pool_size,
+        "connectTimeoutMS": int(connect_timeout * 1000),
+    }
+    if max_idle is not None:
+        kwargs["maxIdleTimeMS"] = int(max_idle * 1000)
+    if stats is not None:
+        kwargs["event_listeners"] = [stats]
+    logger.debug("Creating MongoClient for %s: %s", uri, str(kwargs))
+    return MongoClient(uri, **kwargs)
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import copy
+import json
+import logging
+import mmap
+import os
+import threading
+from lxml import etree
+import Edit
+import Query
+import Serializer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import binding
+    import pyangbind.lib.serialise as serialise
+    import pyangbind.lib.pybindJSON as pybindJSON
+    have_pyangbind = True
+except ImportError:
+    have_pyangbind = False
+
+BACKENDS = ("mongo", "memory", "file")
+
+
+def datastore_name(tag):
+    """Return the datastore name for a top level element tag.
+
+    >>> datastore_name("{http://openconfig.net/yang/platform}components")
+    'openconfig-platform'
+    """
+    db_base = tag.split('}')[0].split('/')[-1]
+    db_source = tag.split('/')[2].split('.')[0]
+    return db_source + "-" + db_base
+
+
+def module_element(name, namespace):
+    """Return an empty module element for datastore `name`.
+
+    The module element is the unit the datastores read and write, its children
+    are the top level nodes of the module (e.g., <components> for
+    openconfig-platform). This is the same shape pyangbind serialises a module
+    object to.
+    """
+    return etree.Element("{" + namespace + "}" + name, nsmap={None: namespace})
+
+
+def split_modules(data):
+    """Group the top level elements of a <data> or <config> element by datastore.
+
+    :param data: The element whose children are top level nodes.
+    :return: A dictionary of datastore names to new module elements holding
+             copies of the top level nodes.
+    """
+    modules = {}
+    for top in data.iterchildren(tag=etree.Element):
+        name = datastore_name(top.tag)
+        if name not in modules:
+            modules[name] = module_element(name, etree.QName(top).namespace)
+        modules[name].append(copy.deepcopy(top))
+    return modules
+
+
+def module_schema(name):
+    """Return the compiled `Serializer.ModuleSerializer` of datastore `name` or None.
+
+    None is returned when pyangbind or the module bindings are unavailable.
+    """
+    if not have_pyangbind:
+        return None
+    try:
+        return Serializer.get_serializer(binding, name)
+    except AttributeError:
+        return None
+
+
+class Datastore(object):
+    """The storage interface used by the server.
+
+    A datastore holds a number of named datastores, one per YANG module. Each
+    is read and written as a module element (see `module_element`) whose
+    children are the module's top level nodes.
+
+    Elements returned by `read` belong to the caller and may be modified.
+    """
+
+    # Whether what is written outlives the process.
+    durable = True
+
+    def names(self):
+        """Return a list of the names of the stored datastores."""
+        raise NotImplementedError()
+
+    def read(self, name):
+        """Return the module element of datastore `name` or None if empty."""
+        raise NotImplementedError()
+
+    def write(self, name, element):
+        """Replace the contents of datastore `name` with module element `element`."""
+        raise NotImplementedError()
+
+    def edit(self, name, changes, current):
+        """Apply the `Edit.Change` list planned against the datastore to datastore `name`.
+
+        Backends that can change part of a datastore implement this, by
+        default `current` is written.
+
+        :param current: The module element of the datastore (see
+                        `module_element` if it was empty) with the changes
+                        applied. It belongs to the caller, a datastore keeping
+                        it must copy it.
+        """
+        self.write(name, current)
+
+    def sync(self):
+        """Wait until the writes and edits made by the calling thread are durable."""
+        pass
+
+    def read_subtree(self, name, filter_elm):
+        """Return the module element of datastore `name` pruned by a subtree filter.
+
+        Backends that can evaluate the filter closer to the data implement
+        this, the result is what `util.filter_results` would return for the
+        `read` result.
+
+        :raises: `Query.UnsupportedFilter` if the filter must be applied by the caller.
+        """
+        raise Query.UnsupportedFilter("{} can't evaluate filters".format(type(self).__name__))
+
+    def stats(self):
+        """Return a dictionary of backend specific counters."""
+        return {}
+
+    def close(self):
+        pass
+
+
+class MongoDatastore(Datastore):
+    """Datastores stored as pyangbind IETF JSON documents, one collection each.
+
+    Documents are rendered with the schema compiled `Serializer` of the module.
+
+    :param client: A `pymongo.MongoClient` owned by the datastore.
+    :param stats: The `Database.PoolStats` registered with the client or None.
+    :param database: Name of the MongoDB database holding the collections.
+    """
+
+    projection = {"_id": False}
+
+    def __init__(self, client, stats=None, database="netconfserver"):
+        assert have_pyangbind
+        self.client = client
+        self.pool_stats = stats
+        self.db = client[database]
+
+    def names(self):
+        return self.db.list_collection_names()
+
+    def read(self, name):
+        # The projection drops the MongoDB document id server side.
+        datastore_data = self.db[name].find_one({}, self.projection)
+        if datastore_data is None:
+            return None
+        return Serializer.get_serializer(binding, name).to_element(datastore_data)
+
+    def read_subtree(self, name, filter_elm):
+        module = Serializer.get_serializer(binding, name)
+        pipeline = Query.subtree_pipeline(module, filter_elm)
+        for datastore_data in self.db[name].aggregate(pipeline):
+            return module.to_element(datastore_data)
+        return None
+
+    def write(self, name, element):
+        data = etree.tostring(element, encoding="unicode")
+        database_data = serialise.pybindIETFXMLDecoder.decode(data, binding, name)
+        document = json.loads(pybindJSON.dumps(database_data, mode="ietf"))
+        self.db[name].replace_one({}, document, upsert=True)
+
+    def edit(self, name, changes, current):
+        try:
+            updates = Edit.mongo_updates(Serializer.get_serializer(binding, name), changes)
+        except Edit.UnsupportedEdit as ex:
+            logger.debug("Writing all of %s: %s", name, str(ex))
+            return super(MongoDatastore, self).edit(name, changes, current)
+        if not updates:
+            return
+        from pymongo import UpdateOne
+        requests = [
+            UpdateOne({}, update, upsert=True, array_filters=filters)
+            for update, filters in updates
+        ]
+        self.db[name].bulk_write(requests, ordered=True)
+
+    def stats(self):
+        if self.pool_stats is None:
+            return {}
+        return self.pool_stats.snapshot()
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryDatastore(Datastore):
+    """Datastores kept as in-process lxml trees.
+
+    :param initial: An optional element whose children are the initial
+                    top level nodes (e.g., a parsed <data> document).
+    """
+
+    durable = False
+
+    def __init__(self, initial=None):
+        self.lock = threading.Lock()
+        self.trees = {}
+        # The `Edit.Index` of the trees edited.
+        self.indexes = {}
+        if initial is not None:
+            self.trees = split_modules(initial)
+
+    def names(self):
+        with self.lock:
+            return list(self.trees)
+
+    def read(self, name):
+        with self.lock:
+            tree = self.trees.get(name)
+            if tree is None:
+                return None
+            return copy.deepcopy(tree)
+
+    def write(self, name, element):
+        element = copy.deepcopy(element)
+        with self.lock:
+            self.trees[name] = element
+            self.indexes.pop(name, None)
+
+    def edit(self, name, changes, current):
+        with self.lock:
+            tree = self.trees.get(name)
+            if tree is None:
+                self.trees[name] = copy.deepcopy(current)
+            else:
+                index = self.indexes.get(name)
+                if index is None:
+                    index = self.indexes[name] = Edit.Index()
+                Edit.apply(tree, changes, index)
+
+
+class FileDatastore(Datastore):
+    """Datastores stored one per file as `<path>/<name>.xml`.
+
+    Files are read through a memory map that is kept open while the file is
+    unchanged, writes replace the file atomically.
+
+    :param path: The directory holding the datastore files.
+    """
+
+    suffix = ".xml"
+    feed_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.maps = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, name):
+        return os.path.join(self.path, name + self.suffix)
+
+    def _map(self, name):
+        # Must be called with lock held.
+        filename = self._filename(name)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        cached = self.maps.get(name)
+        if cached is not None:
+            if cached[0] == key:
+                return cached[1]
+            cached[1].close()
+            del self.maps[name]
+        if not st.st_size:
+            return None
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[name] = (key, mapped)
+        return mapped
+
+    def names(self):
+        return [x[:-len(self.suffix)] for x in os.listdir(self.path) if x.endswith(self.suffix)]
+
+    def read(self, name):
+        with self.lock:
+            mapped = self._map(name)
+            if mapped is None:
+                return None
+            # Feed the parser straight from the mapped pages in slices.
+            parser = etree.XMLParser(remove_blank_text=True)
+            for offset in range(0, len(mapped), self.feed_size):
+                parser.feed(mapped[offset:offset + self.feed_size])
+            return parser.close()
+
+    def write(self, name, element):
+        filename = self._filename(name)
+        tmpname = filename + ".tmp"
+        with self.lock:
+            with open(tmpname, "wb") as f:
+                f.write(etree.tostring(element, encoding="utf-8", xml_declaration=True))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpname, filename)
+
+    def close(self):
+        with self.lock:
+            for unused, mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+
+
+class CandidateDatastore(Datastore):
+    """The candidate configuration, a copy-on-write snapshot of a running datastore.
+
+    Creating or discarding the candidate copies nothing: a datastore the
+    candidate hasn't changed is read from running. An edit keeps a private
+    module element and the `Edit.Change` list applied to it, `commit` replays
+    the changes on running so that only the changed subtrees are written and
+    the changes made to running meanwhile are kept.
+
+    :param running: The `Datastore` of the running configuration.
+    """
+
+    def __init__(self, running):
+        self.running = running
+        self.lock = threading.Lock()
+        # The module elements of the datastores changed since the last commit
+        # or discard and the changes applied to them, None once written whole.
+        self.changes = {}
+        self.edits = {}
+        # The `Edit.Index` of the module elements edited.
+        self.indexes = {}
+
+    def is_changed(self, name=None):
+        """Return True if datastore `name` (or any if None) differs from running."""
+        with self.lock:
+            if name is None:
+                return bool(self.changes)
+            return name in self.changes
+
+    def names(self):
+        names = self.running.names()
+        with self.lock:
+            return names + [x for x in self.changes if x not in names]
+
+    def read(self, name):
+        with self.lock:
+            element = self.changes.get(name)
+            if element is not None:
+                return copy.deepcopy(element)
+        return self.running.read(name)
+
+    def read_subtree(self, name, filter_elm):
+        if self.is_changed(name):
+            raise Query.UnsupportedFilter("candidate {} is changed".format(name))
+        return self.running.read_subtree(name, filter_elm)
+
+    def write(self, name, element):
+        element = copy.deepcopy(element)
+        with self.lock:
+            self.changes[name] = element
+            self.edits[name] = None
+            self.indexes.pop(name, None)
+
+    def edit(self, name, changes, current):
+        # The first edit keeps a copy of `current` read from running.
+        with self.lock:
+            element = self.changes.get(name)
+            if element is None:
+                self.changes[name] = copy.deepcopy(current)
+                self.edits[name] = list(changes)
+            else:
+                index = self.indexes.get(name)
+                if index is None:
+                    index = self.indexes[name] = Edit.Index()
+                Edit.apply(element, changes, index)
+                if self.edits[name] is not None:
+                    self.edits[name].extend(changes)
+
+    def _rebase(self, name, element, changes):
+        """Return the changes and module element of running after replaying `changes`.
+
+        :raises: `Edit.DataMissing` if running no longer has the parent of a change.
+        """
+        if changes is None:
+            return None, element
+        current = self.running.read(name)
+        if current is None:
+            current = module_element(name, etree.QName(element).namespace)
+        return Edit.rebase(current, changes, Edit.Index()), current
+
+    def commit(self, written=None):
+        """Replay the changes of the candidate on running and return the names
+        of the datastores changed.
+
+        Nothing is written if a change conflicts with running (e.g., its parent
+        was deleted from running since the candidate was edited).
+
+        :param written: Called with the name of each datastore once written
+                        (e.g., to invalidate a cache).
+        :raises: `Edit.DataMissing` on a conflict, the candidate is kept.
+        """
+        with self.lock:
+            changes, self.changes = self.changes, {}
+            edits, self.edits = self.edits, {}
+            self.indexes = {}
+        done = set()
+        try:
+            rebased = {}
+            for name, element in changes.items():
+                rebased[name] = self._rebase(name, element, edits[name])
+            for name, (name_changes, current) in rebased.items():
+                logger.info("Committing datastore %s", name)
+                if name_changes is None:
+                    self.running.write(name, current)
+                elif name_changes:
+                    self.running.edit(name, name_changes, current)
+                done.add(name)
+                if written is not None:
+                    written(name)
+        except Exception:
+            # Keep what wasn't written, unless changed again meanwhile.
+            with self.lock:
+                for name, element in changes.items():
+                    if name not in done and name not in self.changes:
+                        self.changes[name] = element
+                        self.edits[name] = edits[name]
+            raise
+        return list(changes)
+
+    def discard(self):
+        """Revert the candidate to running, return the names of the datastores changed."""
+        with self.lock:
+            changes, self.changes = self.changes, {}
+            self.edits = {}
+            self.indexes = {}
+        return list(changes)
+
+    def stats(self):
+        with self.lock:
+            return {"changed": len(self.changes)}
+
+
+def open_datastore(backend, path=None, **kwargs):
+    """Create the datastore backend selected at server start.
+
+    :param backend: One of "mongo", "memory" or "file".
+    :param path: For "file" the datastore directory, for "memory" an optional
+                 XML file with the initial <data> contents.
+    :param kwargs: For "mongo" the keyword arguments of `Database.connect`.
+    :return: The datastore.
+    :rtype: `Datastore`
+    """
+    if backend == "mongo":
+        import Database
+        stats = Database.PoolStats()
+        client = Database.connect(stats=stats, **kwargs)
+        return MongoDatastore(client, stats, Database.DEFAULT_DATABASE)
+    elif backend == "memory":
+        initial = None
+        if path:
+            parser = etree.XMLParser(remove_blank_text=True)
+            initial = etree.parse(path, parser).getroot()
+        return MemoryDatastore(initial)
+    elif backend == "file":
+        return FileDatastore(path or "configuration")
+    raise ValueError("Unknown datastore backend: {}".format(backend))
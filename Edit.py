@@ -0,0 +1,656 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""The <edit-config> engine (RFC 6241 7.2).
+
+An edit is first planned against the current module element of a datastore:
+the merge, replace, create, delete and remove operations (given by the
+default-operation or by the nc:operation attribute of a node, inherited by its
+descendants) are resolved into a list of `Change`, the nodes to set and the
+nodes to delete. List entries are found by their YANG keys and leaf-list
+entries by value, using the compiled module schema (see `Serializer`), an
+edit of a module without one fails with `UnknownSchema`. A merge only produces
+changes for the leaves whose values differ. A replace default-operation
+replaces the whole configuration, its new module elements are built by
+`replacement` without a schema.
+
+The changes are then applied to the planned against module element
+(`apply`), which is validated, and by the datastore as in-place edits of its
+own tree or as MongoDB updates of the affected paths (`mongo_updates`), so
+changing one leaf writes one leaf. A module element edited repeatedly keeps an
+`Index` of its list entries, so that finding an entry doesn't search its list,
+and `apply` can record how to `revert` the changes.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import copy
+import logging
+from lxml import etree
+import Query
+
+logger = logging.getLogger(__name__)
+
+NC_NAMESPACE = "urn:ietf:params:xml:ns:netconf:base:1.0"
+OPERATION_ATTR = "{" + NC_NAMESPACE + "}operation"
+OPERATIONS = ("merge", "replace", "create", "delete", "remove")
+DEFAULT_OPERATIONS = ("merge", "replace", "none")
+
+# A change of the datastore.
+#
+# op: "set" to create or replace the node, "delete" to remove it.
+# path: The steps from the module element to the node. A step is (tag, key)
+#       where key is None for a container or leaf, a tuple of (key tag, value)
+#       for a list entry and the value for a leaf-list entry.
+# element: For "set" the new node, without operation attributes.
+# exists: True if the node is present in the planned against module element.
+Change = collections.namedtuple("Change", "op path element exists")
+
+
+class EditError(Exception):
+    """The edit can't be applied.
+
+    :param message: The error message.
+    :param path: The steps of the node (see `Change`) or None.
+    """
+
+    def __init__(self, message, path=None):
+        super(EditError, self).__init__(message)
+        self.path = path
+
+
+class DataExists(EditError):
+    """A create operation on a node that is present."""
+    pass
+
+
+class DataMissing(EditError):
+    """A delete operation on a node that is absent."""
+    pass
+
+
+class BadOperation(EditError):
+    """An unknown operation attribute value.
+
+    :param element: The element with the attribute.
+    """
+
+    def __init__(self, message, element):
+        super(BadOperation, self).__init__(message)
+        self.element = element
+
+
+class UnknownSchema(EditError):
+    """The kind and keys of an element of the edit aren't known, without a
+    schema a list entry can't be told from a container.
+
+    :param element: The element of the edit or None if the module has no schema.
+    """
+
+    def __init__(self, message, path, element=None):
+        super(UnknownSchema, self).__init__(message, path)
+        self.element = element
+
+
+class UnsupportedEdit(Exception):
+    """The changes can't be translated for the backend, it must write the module."""
+    pass
+
+
+def path_string(path):
+    """Return a readable form of change path `path`.
+
+    >>> path_string([("{urn:x}a", None), ("{urn:x}b", (("{urn:x}name", "e0"),)),
+    ...              ("{urn:x}tags", "red")])
+    "/a/b[name='e0']/tags[.='red']"
+    """
+    parts = []
+    for tag, key in path:
+        part = "/" + etree.QName(tag).localname
+        if isinstance(key, tuple):
+            part += "".join("[{}='{}']".format(etree.QName(x).localname, v) for x, v in key)
+        elif key is not None:
+            part += "[.='{}']".format(key)
+        parts.append(part)
+    return "".join(parts)
+
+
+def _elements(elm):
+    return list(elm.iterchildren(tag=etree.Element))
+
+
+def _text(elm):
+    return (elm.text or "").strip()
+
+
+def _schema_child(node, tag):
+    """Return the schema child of `node` with `tag` or None if unknown."""
+    if node is None:
+        return None
+    qname = etree.QName(tag)
+    child = node.children.get(qname.localname)
+    if child is None or child.namespace != qname.namespace:
+        return None
+    return child
+
+
+def _step(elm, node, path):
+    """Return the path step (see `Change`) of an edit element of schema node `node`."""
+    if node.kind == "leaf-list":
+        return (elm.tag, _text(elm))
+    if node.kind != "list":
+        return (elm.tag, None)
+    values = []
+    for key in ["{" + node.namespace + "}" + x for x in node.keys]:
+        key_elm = elm.find(key)
+        if key_elm is None:
+            raise DataMissing(
+                "Missing key {} of {}".format(etree.QName(key).localname,
+                                              path_string(path + ((elm.tag, None), ))), path)
+        values.append((key, _text(key_elm)))
+    return (elm.tag, tuple(values))
+
+
+def _matches(elm, key):
+    if key is None:
+        return True
+    if isinstance(key, tuple):
+        for key_tag, value in key:
+            key_elm = elm.find(key_tag)
+            if key_elm is None or _text(key_elm) != value:
+                return False
+        return True
+    return _text(elm) == key
+
+
+def _compile(expr, tags):
+    """Return a compiled XPath, with {0}, {1}... in `expr` replaced by
+    prefixed names for `tags`."""
+    namespaces = {}
+    names = []
+    for tag in tags:
+        qname = etree.QName(tag)
+        prefix = namespaces.setdefault(qname.namespace, "n{}".format(len(namespaces)))
+        names.append(prefix + ":" + qname.localname)
+    return etree.XPath(expr.format(*names), namespaces=dict((v, k) for k, v in namespaces.items()))
+
+
+def _selector(tag, key_tags):
+    """Return the XPath selecting the children with `tag` whose `key_tags`
+    children (the child itself for None) have the values $v0, $v1..., ignoring
+    white space."""
+    selector = _selectors.get((tag, key_tags))
+    if selector is None:
+        if key_tags is None:
+            selector = _compile("{0}[normalize-space(.) = normalize-space($v0)]", [tag])
+        else:
+            predicates = "".join("[normalize-space({{{}}}) = normalize-space($v{})]".format(i + 1, i)
+                                 for i in range(len(key_tags)))
+            selector = _compile("{0}" + predicates, (tag, ) + key_tags)
+        _selectors[(tag, key_tags)] = selector
+    return selector
+
+
+def _last(parent, tag):
+    """Return the last child of `parent` with `tag` or None."""
+    if len(parent) and parent[-1].tag == tag:
+        # A list is usually the last child of its parent.
+        return parent[-1]
+    selector = _selectors.get((tag, "last"))
+    if selector is None:
+        selector = _selectors[(tag, "last")] = _compile("{0}[last()]", [tag])
+    found = selector(parent)
+    return found[0] if found else None
+
+
+# The compiled XPath of `_selector` and `_last`.
+_selectors = {}
+
+
+def _split_key(key):
+    """Return the (key tags, values) of the key of a path step, the key tags
+    are None for a leaf-list entry."""
+    if isinstance(key, tuple):
+        return tuple(x for x, unused in key), tuple(x for unused, x in key)
+    return None, key
+
+
+def _key_values(elm, key_tags):
+    """Return the values of `_split_key` of entry `elm` or None if a key is missing."""
+    if key_tags is None:
+        return _text(elm)
+    values = []
+    for key_tag in key_tags:
+        key_elm = elm.find(key_tag)
+        if key_elm is None:
+            return None
+        values.append(_text(key_elm))
+    return tuple(values)
+
+
+class Index(object):
+    """The list and leaf-list entries of a module element by key.
+
+    The entries of a list in a parent are indexed the first time one is
+    looked up, after which `plan`, `apply` and `find` given the index find
+    entries without searching. `apply` and `revert` keep the index of the
+    module element they change current, the index must be dropped if the
+    module element is changed otherwise.
+    """
+
+    def __init__(self):
+        # {parent: {(tag, key tags): {values: entry}}}
+        self.parents = {}
+
+    def _entries(self, parent, tag, key_tags):
+        lists = self.parents.get(parent)
+        if lists is None:
+            lists = self.parents[parent] = {}
+        entries = lists.get((tag, key_tags))
+        if entries is None:
+            entries = lists[(tag, key_tags)] = {}
+            for child in parent.iterchildren(tag=tag):
+                values = _key_values(child, key_tags)
+                if values is not None:
+                    entries.setdefault(values, child)
+        return entries
+
+    def find(self, parent, step):
+        """Return the child of `parent` at path step `step` or None."""
+        tag, key = step
+        key_tags, values = _split_key(key)
+        entries = self._entries(parent, tag, key_tags)
+        child = entries.get(values)
+        if child is not None and (child.getparent() is not parent or not _matches(child, key)):
+            logger.debug("Reindexing stale %s entries", tag)
+            del self.parents[parent][(tag, key_tags)]
+            child = self._entries(parent, tag, key_tags).get(values)
+        return child
+
+    def added(self, parent, step, elm):
+        """Record that `elm` was added to `parent` at path step `step`."""
+        tag, key = step
+        if key is None:
+            return
+        key_tags, values = _split_key(key)
+        entries = self.parents.get(parent, {}).get((tag, key_tags))
+        if entries is not None:
+            entries[values] = elm
+
+    def removed(self, parent, step, elm):
+        """Record that `elm` was removed from `parent` at path step `step`."""
+        tag, key = step
+        if key is not None:
+            key_tags, values = _split_key(key)
+            entries = self.parents.get(parent, {}).get((tag, key_tags))
+            if entries is not None and entries.get(values) is elm:
+                del entries[values]
+        if self.parents:
+            for sub in elm.iter(tag=etree.Element):
+                self.parents.pop(sub, None)
+
+
+def _find(parent, step, index=None):
+    """Return the child of `parent` at path step `step` or None.
+
+    The entries of large lists are looked up in `index` or else searched for
+    by XPath rather than by iterating over them.
+    """
+    if parent is None:
+        return None
+    tag, key = step
+    if key is None:
+        return parent.find(tag)
+    if index is not None:
+        return index.find(parent, step)
+    key_tags, values = _split_key(key)
+    if key_tags is None:
+        values = (values, )
+    variables = dict(("v{}".format(i), x) for i, x in enumerate(values))
+    for child in _selector(tag, key_tags)(parent, **variables):
+        if _matches(child, key):
+            return child
+    return None
+
+
+def find(module, path, index=None):
+    """Return the elements at the steps of change path `path` in module element
+    `module`, None from the first step absent.
+
+    :param index: The `Index` of `module` or None.
+    """
+    elms = []
+    elm = module
+    for step in path:
+        elm = _find(elm, step, index)
+        elms.append(elm)
+    return elms
+
+
+def _operation(elm, inherited):
+    operation = elm.get(OPERATION_ATTR)
+    if operation is None:
+        return inherited
+    if operation not in OPERATIONS:
+        raise BadOperation("Unknown operation {} on {}".format(operation, elm.tag), elm)
+    return operation
+
+
+def _new_node(elm, path):
+    """Return a copy of an edit element to set, without operation attributes.
+
+    Descendants to remove are dropped, descendants to delete don't exist.
+    """
+    elm = copy.deepcopy(elm)
+    for sub in list(elm.iter(tag=etree.Element)):
+        operation = _operation(sub, None)
+        if operation in ("delete", "remove") and sub is not elm:
+            if operation == "delete":
+                raise DataMissing("Delete of missing {} in {}".format(
+                    etree.QName(sub).localname, path_string(path)), path)
+            sub.getparent().remove(sub)
+        elif operation is not None:
+            del sub.attrib[OPERATION_ATTR]
+    etree.cleanup_namespaces(elm)
+    return elm
+
+
+def _plan_children(current, edit_parent, inherited, node, path, changes, index):
+    for elm in _elements(edit_parent):
+        child_node = _schema_child(node, elm.tag)
+        if child_node is None:
+            raise UnknownSchema(
+                "No schema for {}".format(path_string(path + ((elm.tag, None), ))), path, elm)
+        operation = _operation(elm, inherited)
+        step = _step(elm, child_node, path)
+        child_path = path + (step, )
+        existing = _find(current, step, index)
+
+        if operation in ("delete", "remove"):
+            if existing is not None:
+                changes.append(Change("delete", child_path, None, True))
+            elif operation == "delete":
+                raise DataMissing("Delete of missing {}".format(path_string(child_path)),
+                                  child_path)
+        elif operation == "create" and existing is not None:
+            raise DataExists("Create of existing {}".format(path_string(child_path)), child_path)
+        elif operation in ("create", "replace") or (operation == "merge" and existing is None):
+            changes.append(Change("set", child_path, _new_node(elm, child_path), existing
+                                  is not None))
+        elif existing is None:
+            # operation "none" only traverses what is present.
+            raise DataMissing("Missing {}".format(path_string(child_path)), child_path)
+        elif child_node.kind in ("leaf", "leaf-list"):
+            if operation == "merge" and _text(existing) != _text(elm):
+                changes.append(Change("set", child_path, _new_node(elm, child_path), True))
+        else:
+            _plan_children(existing, elm, operation, child_node, child_path, changes, index)
+
+
+def plan(current, config, default_operation="merge", schema=None, index=None):
+    """Return the changes of an edit of a datastore.
+
+    :param current: The module element of the datastore or None if empty.
+    :param config: The module element of the edit (see `Datastore.split_modules`).
+    :param default_operation: "merge" or "none", see `replacement` for "replace".
+    :param schema: The compiled `Serializer.ModuleSerializer`.
+    :param index: The `Index` of `current` or None.
+    :return: A list of `Change`.
+    :raises: `EditError`, `UnknownSchema` if `schema` is None or lacks an
+             element of the edit.
+    """
+    if default_operation not in ("merge", "none"):
+        raise ValueError("Can't plan default operation {}".format(default_operation))
+    if schema is None:
+        raise UnknownSchema("No schema for module {}".format(etree.QName(config).localname), ())
+    changes = []
+    _plan_children(current, config, default_operation, schema, (), changes, index)
+    return changes
+
+
+def replacement(current, config):
+    """Return the module element replacing a datastore for an edit with
+    default-operation replace, which replaces the whole configuration (RFC
+    6241 7.2).
+
+    No schema is needed: the top level nodes of the edit are kept, without
+    those deleted or removed, and the nodes deleted must be present.
+
+    :param current: The module element of the datastore or None if empty.
+    :param config: The module element of the edit.
+    :raises: `EditError`
+    """
+    module = etree.Element(config.tag, nsmap=config.nsmap)
+    for elm in _elements(config):
+        path = ((elm.tag, None), )
+        operation = _operation(elm, "replace")
+        present = current is not None and current.find(elm.tag) is not None
+        if operation == "delete" and not present:
+            raise DataMissing("Delete of missing {}".format(path_string(path)), path)
+        elif operation == "create" and present:
+            raise DataExists("Create of existing {}".format(path_string(path)), path)
+        elif operation not in ("delete", "remove"):
+            module.append(_new_node(elm, path))
+    return module
+
+
+def apply(module, changes, index=None, undo=None):
+    """Apply the changes planned against module element `module` to it in place.
+
+    :param index: The `Index` of `module`, kept current, or None.
+    :param undo: A list the steps to `revert` the changes are appended to, or None.
+    :return: A (parent, element) tuple for each change, the element is None
+             for a delete.
+    :raises: `DataMissing` if the parent of a change is absent.
+    """
+    located = []
+    # The parents found, the changes of a subtree look them up once.
+    parents = {(): module}
+    for change in changes:
+        parent = parents.get(change.path[:-1])
+        if parent is None:
+            parent = module
+            for i, step in enumerate(change.path[:-1]):
+                parent = _find(parent, step, index)
+                if parent is None:
+                    raise DataMissing("Missing {}".format(path_string(change.path)), change.path)
+                parents[change.path[:i + 1]] = parent
+        step = change.path[-1]
+        existing = _find(parent, step, index)
+        element = None
+        if change.op != "delete":
+            element = copy.deepcopy(change.element)
+        if existing is not None:
+            # The parents in the subtree are gone.
+            size = len(change.path)
+            for path in [x for x in parents if x[:size] == change.path]:
+                del parents[path]
+            if undo is not None:
+                undo.append((parent, step, existing.getprevious(), existing, element))
+            if index is not None:
+                index.removed(parent, step, existing)
+        elif element is not None and undo is not None:
+            undo.append((parent, step, None, None, element))
+        if change.op == "delete":
+            if existing is not None:
+                parent.remove(existing)
+        elif existing is not None:
+            parent.replace(existing, element)
+        else:
+            # Keep the entries of a list together.
+            last = _last(parent, step[0])
+            if last is not None:
+                last.addnext(element)
+            else:
+                parent.append(element)
+        if element is not None and index is not None:
+            index.added(parent, step, element)
+        located.append((parent, element))
+    return located
+
+
+def revert(undo, index=None):
+    """Undo the changes `apply` recorded in `undo`, in the reverse order.
+
+    :param index: The `Index` given to `apply` or None.
+    """
+    for parent, step, previous, existing, element in reversed(undo):
+        if element is not None:
+            parent.remove(element)
+            if index is not None:
+                index.removed(parent, step, element)
+        if existing is not None:
+            if previous is not None:
+                previous.addnext(existing)
+            else:
+                parent.insert(0, existing)
+            if index is not None:
+                index.added(parent, step, existing)
+    del undo[:]
+
+
+def rebase(module, changes, index=None):
+    """Apply changes planned against another version of module element `module` to it.
+
+    The `exists` of each change is recomputed for `module`, so that a backend
+    translating the changes (see `mongo_updates`) adds or replaces the nodes
+    as they are in `module`.
+
+    :param index: The `Index` of `module` or None.
+    :return: The list of `Change` as applied.
+    :raises: `DataMissing` if the parent of a change is absent.
+    """
+    rebased = []
+    for change in changes:
+        change = change._replace(exists=find(module, change.path, index)[-1] is not None)
+        apply(module, [change], index)
+        rebased.append(change)
+    return rebased
+
+
+def _leaf_json(node, elm):
+    """Return the IETF JSON value of leaf element `elm`."""
+    text = _text(elm)
+    if node.yang_type == "empty":
+        return [None]
+    if node.identities is not None:
+        identity = text.rpartition(":")[-1]
+        if identity in node.identities:
+            return node.identities[identity][0] + ":" + identity
+        return text
+    try:
+        return Query.leaf_values(node, text)[0]
+    except Query.UnsupportedFilter as ex:
+        raise UnsupportedEdit(str(ex))
+
+
+def _container_json(node, elm):
+    """Return the IETF JSON object of container or list entry element `elm`."""
+    value = {}
+    for sub in _elements(elm):
+        child = _schema_child(node, sub.tag)
+        if child is None:
+            raise UnsupportedEdit("{} not in schema of {}".format(sub.tag, node.name))
+        member = Query._member(child, node.module)
+        if child.kind == "leaf":
+            value[member] = _leaf_json(child, sub)
+        elif child.kind == "leaf-list":
+            value.setdefault(member, []).append(_leaf_json(child, sub))
+        elif child.kind == "list":
+            value.setdefault(member, []).append(_container_json(child, sub))
+        else:
+            value[member] = _container_json(child, sub)
+    return value
+
+
+def _json(node, elm):
+    if node.kind in ("leaf", "leaf-list"):
+        return _leaf_json(node, elm)
+    return _container_json(node, elm)
+
+
+def _key_filter(node, key, prefix):
+    """Return the filter matching the list entry with `key`, its fields prefixed by `prefix`."""
+    cond = {}
+    for key_tag, text in key:
+        child = node.children[etree.QName(key_tag).localname]
+        values = Query.leaf_values(child, text)
+        field = prefix + Query._member(child, node.module)
+        cond[field] = values[0] if len(values) == 1 else {"$in": values}
+    return cond
+
+
+def _mongo_update(module, change):
+    node = module
+    field = None
+    filters = []
+    for index, (tag, key) in enumerate(change.path):
+        child = _schema_child(node, tag)
+        if child is None:
+            raise UnsupportedEdit("{} not in schema of {}".format(tag, node.name))
+        if field is None:
+            field = module.module + ":" + child.name
+        else:
+            field += "." + Query._member(child, node.module)
+        node = child
+        if index == len(change.path) - 1:
+            break
+        if node.kind == "list":
+            var = "e{}".format(index)
+            field += ".$[" + var + "]"
+            filters.append(_key_filter(node, key, var + "."))
+        elif node.kind != "container":
+            raise UnsupportedEdit("path through {} {}".format(node.kind, node.name))
+
+    if change.op == "delete":
+        if node.kind == "list":
+            update = {"$pull": {field: _key_filter(node, key, "")}}
+        elif node.kind == "leaf-list":
+            update = {"$pull": {field: {"$in": Query.leaf_values(node, key)}}}
+        else:
+            update = {"$unset": {field: ""}}
+        return update, filters
+
+    value = _json(node, change.element)
+    if node.kind == "list" and change.exists:
+        var = "e{}".format(len(change.path) - 1)
+        filters.append(_key_filter(node, key, var + "."))
+        update = {"$set": {field + ".$[" + var + "]": value}}
+    elif node.kind == "list":
+        update = {"$push": {field: value}}
+    elif node.kind == "leaf-list":
+        update = {"$addToSet": {field: value}}
+    else:
+        update = {"$set": {field: value}}
+    return update, filters
+
+
+def mongo_updates(module, changes):
+    """Translate changes into updates of the IETF JSON document of a datastore.
+
+    List entries on the path of a change are selected with array filters,
+    a list entry is added with `$push` and deleted with `$pull`.
+
+    :param module: The compiled `Serializer.ModuleSerializer` of the datastore.
+    :param changes: A list of `Change`.
+    :return: A list of (update document, array filters or None), one per change.
+    :raises: `UnsupportedEdit`
+    """
+    updates = []
+    for change in changes:
+        try:
+            update, filters = _mongo_update(module, change)
+        except (KeyError, Query.UnsupportedFilter) as ex:
+            raise UnsupportedEdit("{}: {}".format(path_string(change.path), ex))
+        updates.append((update, filters or None))
+    return updates
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A write-ahead journal in front of a datastore.
+
+Writes and edits are appended to a journal file as one line of JSON each (an
+edit record holds only the `Edit.Change` list) and applied to an in-memory
+copy of the modules changed since the last checkpoint. A flusher thread
+writes the records appended while it waited, and during a short window after
+the first of them, with a single fsync; `sync` returns once the records of
+the calling thread are synced.
+
+Every `checkpoint_interval` seconds or `checkpoint_bytes` of journal, the
+changed modules are written to the base datastore and the journal files
+before the checkpoint are removed. The journal left by a crash is replayed
+into the base datastore when the `JournalDatastore` is created, records are
+idempotent so replaying one already checkpointed is harmless.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from lxml import etree
+from monotonic import monotonic
+import Datastore
+import Edit
+import Query
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 0.002
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+DEFAULT_CHECKPOINT_BYTES = 16 * 1024 * 1024
+
+
+def _encode_change(change):
+    """Return the JSON form of an `Edit.Change`.
+
+    >>> _encode_change(Edit.Change("delete", (("{urn:x}a", None), ("{urn:x}b", "v")), None, True))
+    ['delete', [['{urn:x}a', None], ['{urn:x}b', 'v']], None, True]
+    """
+    element = None
+    if change.element is not None:
+        element = etree.tostring(change.element, encoding="unicode")
+    path = [[tag, [list(x) for x in key] if isinstance(key, tuple) else key]
+            for tag, key in change.path]
+    return [change.op, path, element, change.exists]
+
+
+def _decode_change(value):
+    """Return the `Edit.Change` of a JSON form made by `_encode_change`.
+
+    >>> _decode_change(['delete', [['{urn:x}a', None], ['{urn:x}b', [['{urn:x}k', '1']]]],
+    ...                 None, True]).path
+    (('{urn:x}a', None), ('{urn:x}b', (('{urn:x}k', '1'),)))
+    """
+    op, path, element, exists = value
+    if element is not None:
+        element = etree.fromstring(element)
+    path = tuple((tag, tuple(tuple(x) for x in key) if isinstance(key, list) else key)
+                 for tag, key in path)
+    return Edit.Change(op, path, element, exists)
+
+
+class JournalDatastore(Datastore.Datastore):
+    """A datastore whose writes are made durable by a write-ahead journal.
+
+    :param base: The `Datastore` the journal is checkpointed into, the journal
+                 files are removed once it is written so it must be durable.
+    :param path: The directory holding the journal files.
+    :param window: Seconds the flusher waits for more records before syncing.
+    :param checkpoint_interval: Seconds between checkpoints of a changed journal.
+    :param checkpoint_bytes: Journal size starting a checkpoint.
+    """
+
+    prefix = "journal-"
+    suffix = ".log"
+
+    def __init__(self,
+                 base,
+                 path,
+                 window=DEFAULT_WINDOW,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES):
+        if not base.durable:
+            raise ValueError("{} isn't durable, it can't be journaled".format(type(base).__name__))
+        self.base = base
+        self.path = path
+        self.window = window
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_bytes = checkpoint_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.cv = threading.Condition()
+        # The last record appended by each thread.
+        self.local = threading.local()
+        # The module elements changed since the last checkpoint and a version
+        # bumped by each change.
+        self.trees = {}
+        self.versions = {}
+        self.dirty = set()
+        # The `Edit.Index` of the trees edited.
+        self.indexes = {}
+        # Records appended and not yet written.
+        self.pending = []
+        self.appended = 0
+        self.synced = 0
+        self.error = None
+        self.closed = False
+        self.requested = False
+
+        self.records = 0
+        self.syncs = 0
+        self.sync_max = 0
+        self.nbytes = 0
+        self.checkpoints = 0
+        self.checkpoint_runs = 0
+        self.checkpoint_failures = 0
+        self.replayed = 0
+
+        self.generation = self._recover()
+        self.file = self._open_file(self.generation)
+        self.retired = []
+        self.journal_bytes = 0
+        self.last_checkpoint = monotonic()
+
+        self.thread = threading.Thread(target=self._flusher, name="JournalDatastore")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return "JournalDatastore({})".format(self.path)
+
+    def _filename(self, generation):
+        return os.path.join(self.path, "{}{:08d}{}".format(self.prefix, generation, self.suffix))
+
+    def _journal_files(self):
+        """Return the (generation, filename) of the journal files, oldest first."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.startswith(self.prefix) and name.endswith(self.suffix):
+                try:
+                    generation = int(name[len(self.prefix):-len(self.suffix)])
+                except ValueError:
+                    continue
+                files.append((generation, os.path.join(self.path, name)))
+        return sorted(files)
+
+    def _open_file(self, generation):
+        f = open(self._filename(generation), "ab")
+        # Make the new file itself durable.
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return f
+
+    def _recover(self):
+        """Replay the journal files into the base datastore and remove them.
+
+        :return: The generation of the next journal file.
+        """
+        files = self._journal_files()
+        if not files:
+            return 1
+        for unused, filename in files:
+            with open(filename, "rb") as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        # The write of the last record was cut short.
+                        logger.warning("%s: Ignoring torn record %s:%d", str(self), filename,
+                                       lineno)
+                        break
+                    self._replay(record)
+        logger.info("%s: Replayed %d records, checkpointing %s", str(self), self.replayed,
+                    ", ".join(sorted(self.trees)))
+        for name, tree in self.trees.items():
+            self.base.write(name, tree)
+        self.trees = {}
+        self.versions = {}
+        self.dirty = set()
+        self.indexes = {}
+        for unused, filename in files:
+            os.unlink(filename)
+        return files[-1][0] + 1
+
+    def _replay(self, record):
+        name = record["n"]
+        if "w" in record:
+            self.trees[name] = etree.fromstring(record["w"])
+            self.indexes.pop(name, None)
+        else:
+            tree = self.trees.get(name)
+            if tree is None:
+                tree = self.base.read(name)
+                if tree is None:
+                    tree = Datastore.module_element(name, record["ns"])
+                self.trees[name] = tree
+            index = self._index(name)
+            for value in record["c"]:
+                try:
+                    Edit.apply(tree, [_decode_change(value)], index)
+                except Edit.DataMissing as ex:
+                    # Expected when superseded by a later record already
+                    # checkpointed, but it may also be a base datastore that
+                    # diverged from the journal.
+                    logger.warning("%s: Skipping replayed change: %s", str(self), str(ex))
+        self.replayed += 1
+
+    def _index(self, name):
+        # Must be called with cv held.
+        index = self.indexes.get(name)
+        if index is None:
+            index = self.indexes[name] = Edit.Index()
+        return index
+
+    def _append(self, record):
+        # Must be called with cv held.
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise ValueError("{} is closed".format(self))
+        line = json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+        self.pending.append(line)
+        self.appended += 1
+        self.records += 1
+        self.cv.notify_all()
+        return self.appended
+
+    def _wait_synced(self, seq):
+        with self.cv:
+            while self.synced < seq:
+                if self.error is not None:
+                    raise self.error
+                self.cv.wait()
+
+    def names(self):
+        names = self.base.names()
+        with self.cv:
+            return names + [x for x in self.trees if x not in names]
+
+    def read(self, name):
+        with self.cv:
+            tree = self.trees.get(name)
+            if tree is not None:
+                return copy.deepcopy(tree)
+        return self.base.read(name)
+
+    def read_subtree(self, name, filter_elm):
+        with self.cv:
+            if name in self.trees:
+                raise Query.UnsupportedFilter("{} has journaled changes".format(name))
+        return self.base.read_subtree(name, filter_elm)
+
+    def write(self, name, element):
+        element = copy.deepcopy(element)
+        record = {"n": name, "w": etree.tostring(element, encoding="unicode")}
+        with self.cv:
+            self.local.seq = self._append(record)
+            self.trees[name] = element
+            self.indexes.pop(name, None)
+            self._changed(name)
+
+    def edit(self, name, changes, current):
+        record = {"n": name, "ns": etree.QName(current).namespace, "c": []}
+        with self.cv:
+            tree = self.trees.get(name)
+            applied = record["c"]
+            if tree is None:
+                # Read from the base datastore with the changes applied.
+                tree = copy.deepcopy(current)
+                applied.extend(_encode_change(x) for x in changes)
+                changes = ()
+            index = self._index(name)
+            try:
+                for change in changes:
+                    Edit.apply(tree, [change], index)
+                    applied.append(_encode_change(change))
+            finally:
+                # The journal holds what was applied, even if not all of it.
+                if applied:
+                    self.local.seq = self._append(record)
+                    self.trees[name] = tree
+                    self._changed(name)
+
+    def sync(self):
+        """Wait until the records appended by the calling thread are synced."""
+        seq = getattr(self.local, "seq", 0)
+        if seq:
+            self._wait_synced(seq)
+
+    def _changed(self, name):
+        # Must be called with cv held.
+        self.versions[name] = self.versions.get(name, 0) + 1
+        self.dirty.add(name)
+
+    def _checkpoint_due(self):
+        # Must be called with cv held.
+        if self.requested:
+            return True
+        if not self.dirty:
+            return False
+        return self.journal_bytes >= self.checkpoint_bytes or \
+            monotonic() - self.last_checkpoint >= self.checkpoint_interval
+
+    def _flusher(self):
+        while True:
+            with self.cv:
+                while not self.pending and not self.closed and not self._checkpoint_due():
+                    timeout = None
+                    if self.dirty:
+                        timeout = self.last_checkpoint + self.checkpoint_interval - monotonic()
+                    self.cv.wait(timeout)
+                closed = self.closed
+            try:
+                if self.pending and self.window and not closed:
+                    # Let concurrent writers join this sync.
+                    time.sleep(self.window)
+                self._flush()
+                with self.cv:
+                    due = self._checkpoint_due() or (closed and self.dirty)
+                if due:
+                    self._checkpoint()
+            except Exception as error:
+                logger.error("%s: Journal failed: %s: %s", str(self), str(error),
+                             traceback.format_exc())
+                with self.cv:
+                    self.error = error
+                    self.cv.notify_all()
+                return
+            if closed:
+                return
+
+    def _flush(self):
+        """Write and sync the pending records (flusher thread only)."""
+        with self.cv:
+            lines, self.pending = self.pending, []
+            seq = self.appended
+        if not lines:
+            return
+        data = b"".join(lines)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with self.cv:
+            self.journal_bytes += len(data)
+            self.synced = seq
+            self.syncs += 1
+            self.sync_max = max(self.sync_max, len(lines))
+            self.nbytes += len(data)
+            self.cv.notify_all()
+
+    def _checkpoint(self):
+        """Write the changed modules to the base datastore (flusher thread only)."""
+        with self.cv:
+            snapshot = dict((name, (self.versions[name], copy.deepcopy(self.trees[name])))
+                            for name in self.dirty)
+            self.dirty = set()
+            self.requested = False
+            # Records appended from now on go to the next journal file.
+            self.file.close()
+            self.retired.append(self._filename(self.generation))
+            self.generation += 1
+            self.file = self._open_file(self.generation)
+            self.journal_bytes = 0
+            self.last_checkpoint = monotonic()
+
+        try:
+            for name, (unused, tree) in snapshot.items():
+                self.base.write(name, tree)
+        except Exception as error:
+            logger.error("%s: Checkpoint failed: %s", str(self), str(error))
+            with self.cv:
+                self.checkpoint_failures += 1
+                self.checkpoint_runs += 1
+                self.dirty.update(snapshot)
+                self.cv.notify_all()
+            return
+
+        with self.cv:
+            for name, (version, unused) in snapshot.items():
+                # Unchanged since the snapshot, the base datastore is current.
+                if self.versions.get(name) == version:
+                    del self.trees[name]
+                    del self.versions[name]
+                    self.indexes.pop(name, None)
+            retired, self.retired = self.retired, []
+            self.checkpoints += 1
+            self.checkpoint_runs += 1
+            self.cv.notify_all()
+        for filename in retired:
+            os.unlink(filename)
+
+    def checkpoint(self):
+        """Checkpoint the journal into the base datastore now.
+
+        :return: True if the changed modules were written to the base datastore.
+        """
+        with self.cv:
+            runs = self.checkpoint_runs
+            failures = self.checkpoint_failures
+            self.requested = True
+            self.cv.notify_all()
+            while self.checkpoint_runs == runs:
+                if self.error is not None:
+                    raise self.error
+                self.cv.wait()
+            return self.checkpoint_failures == failures
+
+    def stats(self):
+        stats = dict(self.base.stats())
+        with self.cv:
+            stats.update({
+                "journal-records": self.records,
+                "journal-syncs": self.syncs,
+                "journal-bytes": self.nbytes,
+                "journal-group-max": self.sync_max,
+                "journal-group-avg": self.records / self.syncs if self.syncs else 0.0,
+                "journal-pending": self.appended - self.synced,
+                "journal-modules": len(self.trees),
+                "checkpoints": self.checkpoints,
+                "checkpoint-failures": self.checkpoint_failures,
+                "replayed": self.replayed,
+            })
+        return stats
+
+    def close(self):
+        """Sync and checkpoint the journal, then close the base datastore."""
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        self.thread.join()
+        self.file.close()
+        self.base.close()
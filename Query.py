@@ -0,0 +1,374 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Translate NETCONF filters into MongoDB aggregation stages.
+
+A datastore is stored as a single IETF JSON document, so selecting part of it
+means projecting that document: lists are pruned with `$filter`, list entries
+and containers are reshaped with `$map` and object expressions. The compiled
+module schema (see `Serializer`) tells which nodes are lists and how the JSON
+members are qualified. XPath filters of the common shapes (absolute paths,
+key predicates and unions of them) are first rewritten as subtree filters.
+
+Filters that can't be expressed raise `UnsupportedFilter` and the caller
+falls back to filtering the rendered XML in memory.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import re
+from collections import OrderedDict
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# Types stored as JSON numbers in IETF JSON (RFC7951 6.1), 64 bit values are strings.
+INT_TYPES = set(["int8", "int16", "int32", "uint8", "uint16", "uint32"])
+
+_NAME = r"([A-Za-z_][\w.-]*)"
+_XPATH_STEP = re.compile(r"\s*/\s*" + _NAME + ":" + _NAME)
+_XPATH_PREDICATE = re.compile(r"\s*\[\s*" + _NAME + ":" + _NAME +
+                              r"\s*=\s*(?:'([^']*)'|\"([^\"]*)\"|(-?\d+))\s*\]")
+_XPATH_UNION = re.compile(r"\s*\|")
+
+
+class UnsupportedFilter(Exception):
+    """The filter can't be evaluated by the database."""
+    pass
+
+
+def _elements(elm):
+    return list(elm.iterchildren(tag=etree.Element))
+
+
+def _is_content_match(felm):
+    return felm.text is not None and felm.text.strip() != "" and not len(felm)
+
+
+def _member(node, parent_module):
+    """Return the IETF JSON member name of schema node `node`."""
+    if node.module is None or node.module == parent_module:
+        return node.name
+    return node.module + ":" + node.name
+
+
+def _schema_child(node, felm):
+    """Return the schema child of `node` a filter element refers to."""
+    qname = etree.QName(felm)
+    child = node.children.get(qname.localname)
+    if child is None or (qname.namespace is not None and qname.namespace != child.namespace):
+        raise UnsupportedFilter("{} not in schema of {}".format(felm.tag, node.name))
+    if felm.attrib:
+        raise UnsupportedFilter("attribute match on {}".format(felm.tag))
+    return child
+
+
+def leaf_values(node, text):
+    """Return the IETF JSON values a leaf `node` with XML text `text` may be stored as.
+
+    >>> class Leaf(object):
+    ...     yang_type = "uint32"
+    ...     identities = None
+    >>> leaf_values(Leaf(), " 42 ")
+    [42]
+    >>> Leaf.yang_type = "leafref"
+    >>> leaf_values(Leaf(), "42")
+    ['42', 42]
+    """
+    text = text.strip()
+    yang_type = node.yang_type
+    if node.identities is not None or yang_type == "empty":
+        raise UnsupportedFilter("content match on {} leaf {}".format(yang_type, node.name))
+    if yang_type == "boolean":
+        if text not in ("true", "false"):
+            raise UnsupportedFilter("bad boolean {}".format(text))
+        return [text == "true"]
+    if yang_type in INT_TYPES:
+        try:
+            return [int(text)]
+        except ValueError:
+            raise UnsupportedFilter("bad integer {}".format(text))
+    values = [text]
+    if yang_type in ("leafref", "union"):
+        # The stored form depends on the target or member type.
+        try:
+            values.append(int(text))
+        except ValueError:
+            if text in ("true", "false"):
+                values.append(text == "true")
+    return values
+
+
+def _leaf_match(path, node, text):
+    values = leaf_values(node, text)
+    if len(values) == 1:
+        return {"$eq": [path, values[0]]}
+    return {"$in": [path, values]}
+
+
+def _siblings(node, felms, expr, depth):
+    """Translate a filter sibling set applied to the value of `node` at `expr`.
+
+    :return: (condition expression or None, pruned value expression)
+    """
+    conds = []
+    members = {}
+    groups = []
+    for felm in felms:
+        child = _schema_child(node, felm)
+        key = _member(child, node.module)
+        path = expr + "." + key
+        if _is_content_match(felm):
+            if child.kind != "leaf":
+                raise UnsupportedFilter("content match on {} {}".format(child.kind, child.name))
+            if key in members:
+                raise UnsupportedFilter("repeated sibling {}".format(felm.tag))
+            conds.append(_leaf_match(path, child, felm.text))
+            members[key] = path
+        elif key in members:
+            # Several filters for the same list select a union of entries.
+            if child.kind != "list" or not isinstance(members[key], list):
+                raise UnsupportedFilter("repeated sibling {}".format(felm.tag))
+            members[key].append(felm)
+        else:
+            members[key] = [felm]
+            groups.append((key, child, path))
+
+    for key, child, path in groups:
+        if child.kind == "list":
+            members[key] = _select_list(child, members[key], path, depth)
+        else:
+            members[key] = _select(child, members[key][0], path, depth)
+
+    if not conds:
+        cond = None
+    elif len(conds) == 1:
+        cond = conds[0]
+    else:
+        cond = {"$and": conds}
+
+    # Only content match nodes selects the whole subtree (RFC6241 6.2.5).
+    if not groups:
+        return cond, expr
+    return cond, members
+
+
+def _entry_keys(node, felm):
+    """Return the key values a list entry filter matches or None."""
+    values = {}
+    for sub in _elements(felm):
+        name = etree.QName(sub).localname
+        if name in node.keys and _is_content_match(sub):
+            values[name] = sub.text.strip()
+    if len(values) != len(node.keys):
+        return None
+    return tuple(values[x] for x in node.keys)
+
+
+def _select_list(node, felms, expr, depth):
+    """Return the expression for list `node` at `expr` pruned by filter entries `felms`.
+
+    Several entries are accepted when each matches a different set of key
+    values, an instance then matches at most one of them.
+    """
+    var = "e{}".format(depth)
+    this = "$$" + var
+    entries = {"$ifNull": [expr, []]}
+    alternatives = []
+    for felm in felms:
+        sub = _elements(felm)
+        if not sub:
+            if felm.text is not None and felm.text.strip():
+                raise UnsupportedFilter("content match on {}".format(felm.tag))
+            # A selection node selects all entries.
+            return entries
+        alternatives.append(_siblings(node, sub, this, depth + 1))
+
+    if len(alternatives) > 1:
+        keys = [_entry_keys(node, felm) for felm in felms]
+        if None in keys or len(set(keys)) != len(keys):
+            raise UnsupportedFilter("overlapping entries of list {}".format(node.name))
+        cond = {"$or": [x[0] for x in alternatives]}
+    else:
+        cond = alternatives[0][0]
+    if cond is not None:
+        entries = {"$filter": {"input": entries, "as": var, "cond": cond}}
+    if not all(x[1] == this for x in alternatives):
+        inner = {}
+        for acond, ainner in reversed(alternatives):
+            inner = ainner if acond is None else {"$cond": [acond, ainner, inner]}
+        # Drop entries where nothing was selected.
+        entries = {"$map": {"input": entries, "as": var, "in": inner}}
+        entries = {"$filter": {"input": entries, "as": var, "cond": {"$ne": [this, {}]}}}
+    # A list without selected entries isn't selected either.
+    var = "l{}".format(depth)
+    return {
+        "$let": {
+            "vars": {var: entries},
+            "in": {"$cond": [{"$gt": [{"$size": "$$" + var}, 0]}, "$$" + var, "$$REMOVE"]}
+        }
+    }
+
+
+def _select(node, felm, expr, depth):
+    """Return the expression for the value of `node` at `expr` pruned by `felm`."""
+    if node.kind == "list":
+        return _select_list(node, [felm], expr, depth)
+    felms = _elements(felm)
+    if not felms:
+        if felm.text is not None and felm.text.strip():
+            raise UnsupportedFilter("content match on {}".format(felm.tag))
+        # Selection node
+        return expr
+    if node.kind != "container":
+        raise UnsupportedFilter("containment on {} {}".format(node.kind, node.name))
+
+    cond, inner = _siblings(node, felms, expr, depth)
+    # Objects sort after null, missing and null do not.
+    present = {"$gt": [expr, None]}
+    if cond is not None:
+        present = {"$and": [present, cond]}
+    if inner != expr:
+        # A container where nothing was selected isn't selected either.
+        var = "c{}".format(depth)
+        inner = {
+            "$let": {
+                "vars": {var: inner},
+                "in": {"$cond": [{"$eq": ["$$" + var, {}]}, "$$REMOVE", "$$" + var]}
+            }
+        }
+    return {"$cond": [present, inner, "$$REMOVE"]}
+
+
+def subtree_projection(module, filter_elm):
+    """Translate a subtree filter into a `$project` stage for a module document.
+
+    :param module: The compiled `Serializer.ModuleSerializer` of the datastore.
+    :param filter_elm: The nc:filter element of type subtree.
+    :return: The projection document for a `$project` stage.
+    :raises: `UnsupportedFilter`
+    """
+    felms = _elements(filter_elm)
+    if not felms:
+        raise UnsupportedFilter("empty filter")
+
+    projection = {"_id": 0}
+    for felm in felms:
+        top = _schema_child(module, felm)
+        if _is_content_match(felm):
+            raise UnsupportedFilter("content match on top level {}".format(felm.tag))
+        key = module.module + ":" + top.name
+        if key in projection:
+            raise UnsupportedFilter("repeated top level {}".format(felm.tag))
+        projection[key] = _select(top, felm, "$" + key, 0)
+    return projection
+
+
+def subtree_pipeline(module, filter_elm):
+    """Return the aggregation pipeline evaluating subtree filter `filter_elm`.
+
+    :raises: `UnsupportedFilter`
+    """
+    projection = subtree_projection(module, filter_elm)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Subtree filter projection: %s", str(projection))
+    return [{"$project": projection}]
+
+
+def _xpath_qname(prefix, name, nsmap):
+    if prefix not in nsmap:
+        raise UnsupportedFilter("unknown prefix {}".format(prefix))
+    return "{" + nsmap[prefix] + "}" + name
+
+
+def xpath_paths(select, nsmap):
+    """Parse the XPath expressions the database can evaluate.
+
+    Only unions of absolute location paths with prefixed child steps and
+    equality predicates on child leaves are recognised, anything else
+    raises `UnsupportedFilter`.
+
+    >>> xpath_paths("/p:a/p:b[p:k='x'][p:n=2] | /p:c", {"p": "urn:p"})
+    [[('{urn:p}a', ()), ('{urn:p}b', (('{urn:p}k', 'x'), ('{urn:p}n', '2')))], [('{urn:p}c', ())]]
+
+    :param select: The select attribute of the filter.
+    :param nsmap: The namespace prefixes in scope.
+    :return: A list of paths, each a list of (tag, ((leaf tag, value), ...)) steps.
+    """
+    paths = []
+    pos = 0
+    while True:
+        steps = []
+        while True:
+            m = _XPATH_STEP.match(select, pos)
+            if m is None:
+                break
+            pos = m.end()
+            predicates = []
+            while True:
+                p = _XPATH_PREDICATE.match(select, pos)
+                if p is None:
+                    break
+                pos = p.end()
+                value = [x for x in p.groups()[2:] if x is not None][0]
+                predicates.append((_xpath_qname(p.group(1), p.group(2), nsmap), value))
+            steps.append((_xpath_qname(m.group(1), m.group(2), nsmap), tuple(predicates)))
+        if not steps:
+            raise UnsupportedFilter("xpath {}".format(select))
+        paths.append(steps)
+        m = _XPATH_UNION.match(select, pos)
+        if m is None:
+            break
+        pos = m.end()
+    if select[pos:].strip():
+        raise UnsupportedFilter("xpath {}".format(select))
+    return paths
+
+
+def xpath_subtree(select, nsmap):
+    """Return the subtree filter selecting the same nodes as an XPath expression.
+
+    Each predicate becomes a content match node, so the keys of the selected
+    list entries are returned along with the selected nodes.
+
+    >>> felm = xpath_subtree("/p:a/p:b[p:k='x']/p:c | /p:a/p:b[p:k='y']", {"p": "urn:p"})
+    >>> etree.tounicode(felm)
+    '<filter><ns0:a xmlns:ns0="urn:p"><ns0:b><ns0:k>x</ns0:k><ns0:c/></ns0:b><ns0:b><ns0:k>y</ns0:k></ns0:b></ns0:a></filter>'
+
+    :param select: The select attribute of the filter.
+    :param nsmap: The namespace prefixes in scope.
+    :return: A filter element whose children are the top level filter nodes.
+    :raises: `UnsupportedFilter`
+    """
+    # (tag, predicates) -> [children, True if the whole subtree is selected]
+    root = [OrderedDict(), False]
+    for steps in xpath_paths(select, nsmap):
+        node = root
+        for step in steps:
+            node = node[0].setdefault(step, [OrderedDict(), False])
+            if node[1]:
+                break
+        else:
+            node[0].clear()
+            node[1] = True
+
+    def build(parent, node):
+        for (tag, predicates), child in node[0].items():
+            felm = etree.SubElement(parent, tag)
+            for leaf, value in predicates:
+                etree.SubElement(felm, leaf).text = value
+            build(felm, child)
+
+    felm = etree.Element("filter")
+    build(felm, root)
+    return felm
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Serialize stored IETF JSON documents straight to XML.
+
+The schema of a YANG module (namespaces, node kinds, list keys, schema
+ordering and leaf types) is compiled once from the generated pyangbind
+`binding` module. A stored document is then rendered in a single pass into
+lxml elements or into an `etree.xmlfile` stream, instead of being decoded
+into pyangbind objects, serialised to a string and parsed again.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import threading
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+try:
+    from pyangbind.lib.yangtypes import safe_name
+except ImportError:
+
+    def safe_name(name):
+        return name.replace("-", "_").replace(".", "_")
+
+
+def _localname(key):
+    """Strip the module qualifier of an IETF JSON member name."""
+    return key.rpartition(":")[-1]
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return "{}".format(value)
+
+
+class _Node(object):
+    kind = None
+    module = None
+
+    def __init__(self, name, namespace):
+        self.name = name
+        self.namespace = namespace
+        self.tag = "{" + namespace + "}" + name
+
+    def _nsmap(self, parent_ns):
+        if self.namespace != parent_ns:
+            return {None: self.namespace}
+        return None
+
+    def element(self, parent, value):
+        """Append the XML for `value` to `parent`."""
+        raise NotImplementedError()
+
+    def write(self, xf, value, parent_ns):
+        """Write the XML for `value` to `etree.xmlfile` `xf`."""
+        raise NotImplementedError()
+
+
+class _Leaf(_Node):
+    kind = "leaf"
+
+    def __init__(self, name, namespace, yang_type, identities=None):
+        super(_Leaf, self).__init__(name, namespace)
+        self.yang_type = yang_type
+        self.identities = identities
+
+    def _value(self, value, parent_ns):
+        """Return the (nsmap, text) of the leaf element for `value`."""
+        nsmap = self._nsmap(parent_ns)
+        if value == [None] or value is None:
+            # type empty
+            return nsmap, None
+        text = _text(value)
+        if self.identities and text in self.identities:
+            # As pybindIETFXMLEncoder: an identity of the leaf's own module is
+            # rendered bare, one of another module as "module:identity" with
+            # the module namespace in scope.
+            module, namespace = self.identities[text]
+            text = text.rpartition(":")[-1]
+            if module != self.module:
+                nsmap = dict(nsmap or {})
+                nsmap[module] = namespace
+                text = module + ":" + text
+        return nsmap, text
+
+    def element(self, parent, value):
+        nsmap, text = self._value(value, etree.QName(parent).namespace)
+        etree.SubElement(parent, self.tag, nsmap=nsmap).text = text
+
+    def write(self, xf, value, parent_ns):
+        nsmap, text = self._value(value, parent_ns)
+        with xf.element(self.tag, nsmap=nsmap):
+            if text is not None:
+                xf.write(text)
+
+
+class _LeafList(_Leaf):
+    kind = "leaf-list"
+
+    def element(self, parent, value):
+        for item in value:
+            super(_LeafList, self).element(parent, item)
+
+    def write(self, xf, value, parent_ns):
+        for item in value:
+            super(_LeafList, self).write(xf, item, parent_ns)
+
+
+class _Container(_Node):
+    kind = "container"
+
+    def __init__(self, name, namespace):
+        super(_Container, self).__init__(name, namespace)
+        self.children = {}
+        self.order = []
+
+    def _members(self, value):
+        """Yield (schema-node, value) for the members of `value` in schema order."""
+        if not value:
+            return
+        present = {}
+        unknown = []
+        for key, member in value.items():
+            name = _localname(key)
+            if name in self.children:
+                present[name] = member
+            else:
+                unknown.append((key, member))
+        for name in self.order:
+            if name in present:
+                yield self.children[name], present[name]
+        for key, member in unknown:
+            logger.debug("%s: member %s not in schema", self.name, key)
+            yield _Any(_localname(key), self.namespace), member
+
+    def _fill(self, elm, value):
+        for node, member in self._members(value):
+            node.element(elm, member)
+
+    def element(self, parent, value):
+        elm = etree.SubElement(parent, self.tag, nsmap=self._nsmap(etree.QName(parent).namespace))
+        self._fill(elm, value)
+
+    def _write_members(self, xf, value):
+        for node, member in self._members(value):
+            node.write(xf, member, self.namespace)
+
+    def write(self, xf, value, parent_ns):
+        with xf.element(self.tag, nsmap=self._nsmap(parent_ns)):
+            self._write_members(xf, value)
+
+
+class _List(_Container):
+    kind = "list"
+
+    def __init__(self, name, namespace, keys):
+        super(_List, self).__init__(name, namespace)
+        self.keys = keys
+
+    def _finish(self):
+        # Keys must be the first children of a list entry.
+        self.order = self.keys + [x for x in self.order if x not in self.keys]
+
+    def element(self, parent, value):
+        for entry in value:
+            super(_List, self).element(parent, entry)
+
+    def write(self, xf, value, parent_ns):
+        for entry in value:
+            super(_List, self).write(xf, entry, parent_ns)
+
+
+class _Any(_Node):
+    """A member not found in the schema, rendered from its JSON shape."""
+
+    def element(self, parent, value):
+        if isinstance(value, list):
+            for item in value:
+                self.element(parent, item)
+            return
+        elm = etree.SubElement(parent, self.tag)
+        if isinstance(value, dict):
+            for key, member in value.items():
+                _Any(_localname(key), self.namespace).element(elm, member)
+        elif value is not None:
+            elm.text = _text(value)
+
+    def write(self, xf, value, parent_ns):
+        if isinstance(value, list):
+            for item in value:
+                self.write(xf, item, parent_ns)
+            return
+        with xf.element(self.tag):
+            if isinstance(value, dict):
+                for key, member in value.items():
+                    _Any(_localname(key), self.namespace).write(xf, member, self.namespace)
+            elif value is not None:
+                xf.write(_text(value))
+
+
+class ModuleSerializer(_Container):
+    """The compiled schema of one YANG module.
+
+    :param name: The module name (e.g., "openconfig-platform").
+    :param namespace: The module namespace.
+    """
+    kind = "module"
+
+    def element(self, parent=None, value=None):
+        raise TypeError("use to_element")
+
+    def to_element(self, document):
+        """Render a stored IETF JSON document as the module element.
+
+        :param document: The document, e.g. {"openconfig-platform:components": {...}}.
+        :return: The module element whose children are the top level nodes.
+        :rtype: `lxml.Element`
+        """
+        elm = etree.Element(self.tag, nsmap={None: self.namespace})
+        self._fill(elm, document)
+        return elm
+
+    def write(self, xf, document, parent_ns=None):
+        """Write the module element for `document` into `etree.xmlfile` `xf`."""
+        with xf.element(self.tag, nsmap={None: self.namespace}):
+            self._write_members(xf, document)
+
+    def write_members(self, xf, document, parent_ns=None):
+        """Write only the top level nodes for `document` into `etree.xmlfile` `xf`."""
+        for node, member in self._members(document):
+            node.write(xf, member, parent_ns)
+
+
+def _compile_children(node, obj):
+    """Add the schema children of pyangbind object `obj` to compiled `node`."""
+    for attr in obj._pyangbind_elements:
+        child = getattr(obj, attr)
+        name = child._yang_name
+        namespace = child._namespace
+        kind = getattr(child, "_is_container", False)
+        if kind == "container":
+            cnode = _Container(name, namespace)
+            _compile_children(cnode, child)
+        elif kind == "list":
+            keys = child._keyval.split() if child._keyval else []
+            cnode = _List(name, namespace, keys)
+            _compile_children(cnode, child._contained_class())
+            cnode._finish()
+        else:
+            identities = None
+            yang_type = getattr(child, "_yang_type", None)
+            if yang_type == "identityref":
+                identities = dict((k, (v["@module"], v["@namespace"]))
+                                  for k, v in child._enumeration_dict.items())
+            if getattr(child, "_is_leaf", False):
+                cnode = _Leaf(name, namespace, yang_type, identities)
+            else:
+                cnode = _LeafList(name, namespace, yang_type, identities)
+        cnode.module = child._defining_module
+        node.children[name] = cnode
+        node.order.append(name)
+
+
+def compile_module(bindings, name):
+    """Compile the schema of module `name` from the generated pyangbind bindings.
+
+    :param bindings: The generated `binding` module.
+    :param name: The module name (e.g., "openconfig-platform").
+    :rtype: `ModuleSerializer`
+    """
+    obj = getattr(bindings, safe_name(name))(path_helper=False)
+    module = ModuleSerializer(obj._yang_name, obj._yang_namespace)
+    module.module = obj._yang_name
+    _compile_children(module, obj)
+    return module
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def get_serializer(bindings, name):
+    """Return the compiled `ModuleSerializer` for module `name`, compiling it once."""
+    with _compiled_lock:
+        module = _compiled.get(name)
+        if module is None:
+            logger.debug("Compiling serializer for module %s", name)
+            module = compile_module(bindings, name)
+            _compiled[name] = module
+        return module
@@ -24,18 +24,21 @@ import os
 import platform
 import socket
 import sys
+import threading
 import time
-from netconf import error, server, util
+from netconf import dispatch, error, server, util, workers
 from netconf import nsmap_add, NSMAP
-from pymongo import MongoClient
 from lxml import etree
 import xml.etree.ElementTree as ET
 from lxml import objectify
+import Audit
+import Cache
+import Database
+import Datastore
+import Edit
+import Journal
+import Query
 import Validation
-import pyangbind.lib.serialise as serialise
-import pyangbind.lib.pybindJSON as pybindJSON
-from pyangbind.lib.serialise import pybindJSONDecoder
-import binding
 import json
 
 nsmap_add("sys", "urn:ietf:params:xml:ns:yang:ietf-system")
@@ -60,196 +63,503 @@ def date_time_string(dt):
     return s
 
 
+# The <test-option> values of <edit-config> (RFC 6241 8.6.4).
+TEST_OPTIONS = ("test-then-set", "set", "test-only")
+
+
 class SystemServer(object):
-    def __init__(self, port, host_key, auth, debug):
-        self.server = server.NetconfSSHServer(auth, self, port, host_key, debug)
+    def __init__(self,
+                 port,
+                 host_key,
+                 auth,
+                 debug,
+                 datastore=None,
+                 cache_entries=Cache.DEFAULT_MAX_ENTRIES,
+                 cache_bytes=Cache.DEFAULT_MAX_BYTES,
+                 engine=None,
+                 pool=None,
+                 compact=False):
+        # The datastore is shared by all sessions, it must exist before the
+        # server starts accepting connections.
+        if datastore is None:
+            datastore = Datastore.open_datastore("mongo")
+        self.datastore = datastore
+        self.candidate = Datastore.CandidateDatastore(datastore)
+        # Edits are planned against the data they change, one at a time.
+        self.edit_lock = threading.Lock()
+        # The working trees of the datastores edited, see `_working_tree`.
+        self.working = {}
+        self.cache = Cache.ReplyCache(cache_entries, cache_bytes)
+        self.pool = pool
+        self.server = server.NetconfSSHServer(auth, self, port, host_key, debug, engine, pool,
+                                              compact)
 
     def close(self):
         self.server.close()
+        if self.pool is not None:
+            # The RPCs accepted run before the datastore is closed.
+            self.pool.drain()
+        self.datastore.close()
+
+    def pool_stats(self):
+        """Return the datastore backend (e.g., MongoDB connection pool) counters."""
+        return self.datastore.stats()
+
+    def cache_stats(self):
+        """Return the rendered reply cache counters as a dictionary."""
+        return self.cache.stats()
+
+    def audit_stats(self):
+        """Return the validation audit log counters (queued, flushed, dropped records) as a dictionary."""
+        audit_log = Validation.get_audit_log()
+        if audit_log is None:
+            return {}
+        return audit_log.stats()
+
+    def worker_stats(self):
+        """Return the RPC worker pool counters (queue depth, wait times) as a dictionary."""
+        if self.pool is None:
+            return {}
+        return self.pool.stats()
 
     def nc_append_capabilities(self, capabilities):  # pylint: disable=W0613
         """The server should append any capabilities it supports to capabilities"""
         util.subelm(capabilities,
                     "capability").text = "urn:ietf:params:netconf:capability:xpath:1.0"
+        util.subelm(capabilities,
+                    "capability").text = "urn:ietf:params:netconf:capability:candidate:1.0"
+        if Validation.get_schema() is not None:
+            util.subelm(capabilities,
+                        "capability").text = "urn:ietf:params:netconf:capability:validate:1.1"
         util.subelm(capabilities, "capability").text = NSMAP["sys"]
 
-    def rpc_get(self, session, rpc, filter_or_none):  # pylint: disable=W0613
-        if rpc[0].find('{*}filter') is None:
+    def _get_store(self, rpc, param_elm):
+        """Return the datastore named by a <source> or <target> parameter."""
+        if param_elm is None or not len(param_elm):
+            return self.datastore
+        name = etree.QName(param_elm[0]).localname
+        if name == "running":
+            return self.datastore
+        if name == "candidate":
+            return self.candidate
+        raise error.InvalidValueProtoError(rpc, message="Unsupported datastore: {}".format(name))
+
+    def _read_module(self, store, name):
+        """Return a private copy of a module element of the running or candidate datastore.
+
+        Running and the datastores the candidate shares with it are read
+        through the reply cache.
+        """
+        if store is self.candidate and not self.candidate.is_changed(name):
+            store = self.datastore
+        if store is self.datastore:
+            return self.cache.lookup(name, lambda: self.datastore.read(name))
+        return store.read(name)
+
+    def _working_tree(self, store, name, namespace):
+        """Return the working tree edits of datastore `name` are planned against.
+
+        It is read once and then changed by each edit as the datastore is, so
+        an edit doesn't read the datastore. Must be called with `edit_lock`
+        held, `_drop_working_trees` when the datastore is changed otherwise.
+
+        :return: A list of the module element, its `Edit.Index` and its
+                 `Validation.Index`.
+        """
+        key = ("candidate" if store is self.candidate else "running", name)
+        working = self.working.get(key)
+        if working is None:
+            current = self._read_module(store, name)
+            if current is None:
+                current = Datastore.module_element(name, namespace)
+            working = self.working[key] = [current, Edit.Index(), Validation.Index()]
+        return working
+
+    def _drop_working_trees(self, target=None, names=None):
+        """Drop the working trees of `target` ("running", "candidate" or None
+        for both) for datastores `names` (None for all)."""
+        for key in list(self.working):
+            if (target is None or key[0] == target) and (names is None or key[1] in names):
+                del self.working[key]
+
+    def _plan_edit(self, store, config, default_operation, test_option):
+        """Apply an edit to the working trees of `store` and validate them.
+
+        :return: A list of (datastore name, `Edit.Change` list or None to
+                 write the working tree, working tree) and the undo steps of
+                 each working tree changed.
+        :raises: `Edit.EditError` or `Validation.ValidationError`, the
+                 working trees are left unchanged.
+        """
+        if default_operation == "replace":
+            return self._plan_replace(store, config, test_option)
+        edits = []
+        undos = []
+        try:
+            for db_name, module in Datastore.split_modules(config).items():
+                working = self._working_tree(store, db_name, etree.QName(module).namespace)
+                current, index = working[:2]
+                changes = Edit.plan(current, module, default_operation,
+                                    Datastore.module_schema(db_name), index)
+                if not changes:
+                    continue
+                undo = []
+                undos.append((working, undo))
+                located = Edit.apply(current, changes, index, undo)
+                if test_option != "set":
+                    # The datastores hold state too, it isn't checked as configuration.
+                    Validation.validate_rpc(current, "edit-config", changes, located, working[2])
+                else:
+                    # The unique values of the unvalidated changes aren't indexed.
+                    working[2] = Validation.Index()
+                edits.append((db_name, changes, current))
+        except Exception:
+            self._revert_edit(undos)
+            raise
+        return edits, undos
+
+    def _plan_replace(self, store, config, test_option):
+        """Replace the working trees of `store` for an edit with
+        default-operation replace, which replaces the whole configuration:
+        the datastores the edit has no node of are emptied (see `_plan_edit`).
+        """
+        modules = Datastore.split_modules(config)
+        edits = []
+        undos = []
+        try:
+            for db_name in set(modules) | set(store.names()):
+                module = modules.get(db_name)
+                if module is None:
+                    current = self._read_module(store, db_name)
+                    if current is None or not len(current):
+                        continue
+                    module = Datastore.module_element(db_name, etree.QName(current).namespace)
+                working = self._working_tree(store, db_name, etree.QName(module).namespace)
+                current = Edit.replacement(working[0], module)
+                if test_option != "set":
+                    Validation.validate_rpc(current, "edit-config")
+                undos.append((working, list(working)))
+                working[:] = [current, Edit.Index(), Validation.Index()]
+                edits.append((db_name, None, current))
+        except Exception:
+            self._revert_edit(undos)
+            raise
+        return edits, undos
+
+    @staticmethod
+    def _revert_edit(undos):
+        for working, undo in reversed(undos):
+            if undo and not isinstance(undo[0], tuple):
+                # The working tree replaced (see `_plan_replace`).
+                working[:] = undo
+                continue
+            Edit.revert(undo, working[1])
+            working[2] = Validation.Index()
+
+    def _check_lock(self, session, rpc, target):
+        """Raise lock-denied if another session holds the lock of target."""
+        locksid = self.server.is_target_locked(target)
+        if locksid and locksid != session.session_id:
+            raise error.LockDeniedProtoError(rpc, locksid)
+
+    def _read_datastores(self, filter_or_none, store=None):
+        """Return the rendered datastores a request is interested in.
+
+        With a subtree filter only the module element of the datastore matching
+        the namespace of the top filter element is rendered, otherwise the top
+        level nodes of all of them are returned in a data element.
+
+        :param store: The running (default) or candidate datastore.
+        :return: (The data, True if the filter has already been applied)
+        """
+        if store is None:
+            store = self.datastore
+        if filter_or_none is not None and filter_or_none.get('type') == "xpath":
+            try:
+                return self._read_xpath(filter_or_none, store), True
+            except Query.UnsupportedFilter as ex:
+                logging.debug("Filtering xpath in memory: %s", str(ex))
+
+        if filter_or_none is None or not len(filter_or_none):
             # All configuration files should be appended
-            dbclient = MongoClient()
-            db = dbclient.netconfserver
             data_elm = etree.Element('data', nsmap={None: 'urn:ietf:params:xml:ns:netconf:base:1.0'})
-            i = 1
-            logging.info(db.list_collections())
-            for collection_name in db.list_collection_names():
-                collection = getattr(db, collection_name)
-                collection_data = collection.find_one()
-                collection_data_1 = dict(collection_data)
-                for element in collection_data:
-                    if "id" in element:
-                        del collection_data_1[element]
-                collection_data = collection_data_1
-
-                collection_binding = pybindJSONDecoder.load_ietf_json(collection_data, binding, collection_name)
-                xml_data_string = serialise.pybindIETFXMLEncoder.serialise(collection_binding)
-                xml_data = etree.XML(xml_data_string)
-                data_elm.insert(i, xml_data)
-                i += 1
-            xml_response = data_elm
-
-        # Only supportedd datastore so far is platform
-        else:
-            # Parsing the database name form the rpc tag namespace
-            db_base = rpc[0][1][0].tag.split('}')[0].split('/')[-1]
-            db_source = rpc[0][1][0].tag.split('/')[2].split('.')[0]
-            db_name = db_source + "-" + db_base
-            # logging.info(db_name)
-
-            # Finding the datastore requested
-            dbclient = MongoClient()
-            db = dbclient.netconfserver
-            names = db.list_collection_names()
-            # logging.info(names)
-
-            if db_name in names:
-
-                logging.info("Found the datastore requested")
-
-                # Retrieving the data from the datastore
-                datastore_name = db_name + ":" + rpc[0][1][0].tag.split('}')[1]
-                datastore_data = db[db_name].find_one()
-
-                datastore_data_1 = dict(datastore_data)
-                for element in datastore_data:
-                    if "id" in element:
-                        del datastore_data_1[element]
-                datastore_data = datastore_data_1
-
-                database_data_binding = pybindJSONDecoder.load_ietf_json(datastore_data, binding, db_name)
-                logging.info(database_data_binding)
+            for collection_name in store.names():
+                xml_data = self._read_module(store, collection_name)
+                if xml_data is not None:
+                    data_elm.extend(xml_data)
+            return data_elm, False
+
+        # Parsing the database name form the filter tag namespace
+        db_name = Datastore.datastore_name(filter_or_none[0].tag)
+
+        if filter_or_none.get('type') == "subtree":
+            # Let the backend prune the data before it is rendered.
+            try:
+                xml_response = store.read_subtree(db_name, filter_or_none)
+            except Query.UnsupportedFilter as ex:
+                logging.debug("Filtering %s in memory: %s", db_name, str(ex))
+            else:
+                if xml_response is None:
+                    raise AttributeError("The requested datastore is not supported")
+                return xml_response, True
+
+        xml_response = self._read_module(store, db_name)
+        if xml_response is None:
+            raise AttributeError("The requested datastore is not supported")
+        logging.info("Found the datastore requested")
+        return xml_response, False
+
+    def _read_xpath(self, filter_elm, store):
+        """Return the data selected by an xpath filter evaluated by the datastores.
+
+        The expression is rewritten as a subtree filter, only the datastores
+        of the modules it refers to are read.
+
+        :raises: `Query.UnsupportedFilter` if the filter must be applied in memory.
+        """
+        select = filter_elm.get('select')
+        if select is None:
+            raise Query.UnsupportedFilter("no select attribute")
+        nsmap = dict(NSMAP)
+        nsmap.update((k, v) for k, v in filter_elm.nsmap.items() if k)
+        subtree = Query.xpath_subtree(select, nsmap)
+
+        data_elm = etree.Element('data', nsmap={None: 'urn:ietf:params:xml:ns:netconf:base:1.0'})
+        for db_name, module_filter in Datastore.split_modules(subtree).items():
+            xml_data = store.read_subtree(db_name, module_filter)
+            if xml_data is not None:
+                data_elm.extend(xml_data)
+        return data_elm
+
+    def _stream_datastores(self, trim_state, store=None):
+        """Return a reply writing the top level nodes of all datastores.
+
+        Each datastore is rendered and sent before the next one is read, so
+        only one of them is held in memory at a time.
+        """
+        if store is None:
+            store = self.datastore
+
+        def write(xf):
+            with xf.element("{" + NSMAP['nc'] + "}data", nsmap={None: NSMAP['nc']}):
+                for collection_name in store.names():
+                    xml_data = self._read_module(store, collection_name)
+                    if xml_data is None:
+                        continue
+                    if trim_state:
+                        util.trimstate(xml_data)
+                    for top in xml_data:
+                        xf.write(top)
+
+        return server.StreamingReply(write)
 
-                # Parsing the data to xml
-                xml_data = serialise.pybindIETFXMLEncoder.serialise(database_data_binding)
-                xml_response = etree.XML(xml_data)
+    def rpc_get(self, session, rpc, filter_or_none):  # pylint: disable=W0613
+        if filter_or_none is None:
+            return self._stream_datastores(False)
 
-            else:
-                raise AttributeError("The requested datastore is not supported")
+        xml_response, filtered = self._read_datastores(filter_or_none)
 
-        # Validation.validate_rpc(response, "get-config")
-        toreturn = util.filter_results(rpc, xml_response, filter_or_none, self.server.debug)
+        if filtered:
+            toreturn = xml_response
+        else:
+            toreturn = util.filter_results(rpc, xml_response, filter_or_none, self.server.debug)
 
         if "data" not in toreturn.tag:
             logging.info("data not header")
-            nsmap = {None: 'urn:ietf:params:xml:ns:netconf:base:1.0'}
             data_elm = etree.Element('data', nsmap={None: 'urn:ietf:params:xml:ns:netconf:base:1.0'})
             data_elm.insert(1, toreturn)
-            logging.info(etree.tostring(data_elm, pretty_print=True))
             toreturn = data_elm
 
         return toreturn
 
     def rpc_get_config(self, session, rpc, source_elm, filter_or_none):  # pylint: disable=W0613
+        store = self._get_store(rpc, source_elm)
+        if filter_or_none is None:
+            return self._stream_datastores(True, store)
 
-        # logging.info(etree.tostring(rpc, pretty_print=True))
-        # Empty filter
-        if rpc[0].find('{*}filter') is None:
-            # All configuration files should be appended
-            dbclient = MongoClient()
-            db = dbclient.netconfserver
-            data_elm = etree.Element('data', nsmap={None: 'urn:ietf:params:xml:ns:netconf:base:1.0'})
-            i = 1
-            logging.info(db.list_collections())
-            for collection_name in db.list_collection_names():
-                collection = getattr(db,collection_name)
-                collection_data = collection.find_one()
-                collection_data_1 = dict(collection_data)
-                for element in collection_data:
-                    if "id" in element:
-                        del collection_data_1[element]
-                collection_data = collection_data_1
-
-                collection_binding = pybindJSONDecoder.load_ietf_json(collection_data, binding, collection_name)
-                xml_data_string = serialise.pybindIETFXMLEncoder.serialise(collection_binding)
-                xml_data = etree.XML(xml_data_string)
-                data_elm.insert(i,xml_data)
-                i += 1
-            xml_response = data_elm
-
-        # Only supportedd datastore so far is platform
-        else:
-            # Parsing the database name form the rpc tag namespace
-            db_base = rpc[0][1][0].tag.split('}')[0].split('/')[-1]
-            db_source = rpc[0][1][0].tag.split('/')[2].split('.')[0]
-            db_name = db_source + "-" + db_base
-            #logging.info(db_name)
-
-            # Finding the datastore requested
-            dbclient = MongoClient()
-            db = dbclient.netconfserver
-            names = db.list_collection_names()
-            #logging.info(names)
-
-            if db_name in names:
-
-                logging.info("Found the datastore requested")
-
-                # Retrieving the data from the datastore
-                datastore_name = db_name + ":" + rpc[0][1][0].tag.split('}')[1]
-                datastore_data = db[db_name].find_one()
-
-                datastore_data_1 = dict(datastore_data)
-                for element in datastore_data:
-                    if "id" in element:
-                        del datastore_data_1[element]
-                datastore_data = datastore_data_1
+        xml_response, filtered = self._read_datastores(filter_or_none, store)
 
-                database_data_binding = pybindJSONDecoder.load_ietf_json(datastore_data, binding, db_name)
-                logging.info(database_data_binding)
-
-                # Parsing the data to xml
-                xml_data = serialise.pybindIETFXMLEncoder.serialise(database_data_binding)
-                xml_response = etree.XML(xml_data)
-
-            else:
-                raise AttributeError("The requested datastore is not supported")
-
-        # Validation.validate_rpc(response, "get-config")
-        toreturn = util.filter_results(rpc, xml_response, filter_or_none, self.server.debug)
+        if filtered:
+            toreturn = xml_response
+        else:
+            toreturn = util.filter_results(rpc, xml_response, filter_or_none, self.server.debug)
         util.trimstate(toreturn)
 
         if "data" not in toreturn.tag:
             logging.info("data not header")
-            nsmap = {None : 'urn:ietf:params:xml:ns:netconf:base:1.0'}
-            data_elm = etree.Element('data',nsmap={None : 'urn:ietf:params:xml:ns:netconf:base:1.0'})
-            data_elm.insert(1,toreturn)
-            logging.info(etree.tostring(data_elm,pretty_print=True))
+            data_elm = etree.Element('data', nsmap={None: 'urn:ietf:params:xml:ns:netconf:base:1.0'})
+            data_elm.insert(1, toreturn)
             toreturn = data_elm
 
         return toreturn
 
-    def rpc_edit_config(self, unused_session, rpc, *unused_params):
-        """XXX API subject to change -- unfinished"""
-
-        data_response = util.elm("ok")
-        data_to_insert = rpc[0][1]
-
-        # Validation.validate_rpc(data_to_insert,"edit-config")
-
-        # data_to_insert = data_to_insert.find("{http://openconfig.net/yang/platform}data")
-        data_to_insert_string = etree.tostring(data_to_insert, pretty_print=True, encoding='unicode')
-        parser = etree.XMLParser(remove_blank_text=True)
-        data_to_insert = etree.fromstring(data_to_insert_string, parser=parser)
-        data_to_insert_string = etree.tostring(data_to_insert, pretty_print=True)
-
-        logging.info(data_to_insert_string)
-
-        open("configuration/platform.xml", "w").write(data_to_insert_string)
-
-        return data_response
-
+    @staticmethod
+    def _validation_error(rpc, ex):
+        """Return the rpc-error reporting a `Validation.ValidationError`."""
+        issue = ex.issues[0]
+        message = issue.message
+        if len(ex.issues) > 1:
+            message += " (and {} more errors)".format(len(ex.issues) - 1)
+        return error.RPCServerError(rpc, error.RPCERR_TYPE_APPLICATION, issue.tag,
+                                    path=issue.path, message=message)
+
+    def rpc_edit_config(self, session, rpc, *unused_params):
+        """Apply the RFC 6241 operations of an <edit-config> to the target datastore.
+
+        All the datastores are planned, against working trees kept between
+        edits (see `_working_tree`), before any is changed, so an edit in
+        error changes nothing. Only the nodes the edit sets or deletes are
+        written (see `Edit`) and validated (see `Validation`), the validation
+        is skipped with a "set" test-option and the datastore is left
+        unchanged with "test-only". A "replace" default-operation replaces
+        the whole configuration and writes every datastore, it is the only
+        edit of a module without a compiled schema.
+        """
+        method = rpc[0]
+        store = self._get_store(rpc, method.find("nc:target", namespaces=NSMAP))
+        target = "candidate" if store is self.candidate else "running"
+
+        default_operation = "merge"
+        default_elm = method.find("nc:default-operation", namespaces=NSMAP)
+        if default_elm is not None:
+            default_operation = (default_elm.text or "").strip()
+            if default_operation not in Edit.DEFAULT_OPERATIONS:
+                raise error.InvalidValueProtoError(
+                    rpc, message="Unknown default-operation: {}".format(default_operation))
+
+        test_option = "test-then-set"
+        test_elm = method.find("nc:test-option", namespaces=NSMAP)
+        if test_elm is not None:
+            test_option = (test_elm.text or "").strip()
+            if test_option not in TEST_OPTIONS:
+                raise error.InvalidValueProtoError(
+                    rpc, message="Unknown test-option: {}".format(test_option))
+
+        data_to_insert = method.find("nc:config", namespaces=NSMAP)
+        if data_to_insert is None:
+            data_to_insert = method[-1]
+
+        with self.edit_lock:
+            # Under the edit lock, an edit checked isn't made once the target is locked.
+            self._check_lock(session, rpc, target)
+            try:
+                edits, undos = self._plan_edit(store, data_to_insert, default_operation,
+                                               test_option)
+            except Edit.DataExists as ex:
+                raise error.DataExistsAppError(rpc, message=str(ex))
+            except Edit.DataMissing as ex:
+                raise error.DataMissingAppError(rpc, message=str(ex))
+            except Edit.BadOperation as ex:
+                raise error.BadAttributeProtoError(rpc, ex.element, "operation", message=str(ex))
+            except Edit.UnknownSchema as ex:
+                if ex.element is not None:
+                    raise error.UnknownElementAppError(rpc, ex.element, message=str(ex))
+                raise error.OperationNotSupportedAppError(
+                    rpc,
+                    message="{}, it can only be edited with default-operation replace".format(
+                        str(ex)))
+            except Validation.ValidationError as ex:
+                raise self._validation_error(rpc, ex)
+            if test_option == "test-only":
+                self._revert_edit(undos)
+                return util.elm("ok")
+
+            try:
+                for db_name, changes, current in edits:
+                    try:
+                        if changes is None:
+                            logging.info("Replacing datastore %s", db_name)
+                            store.write(db_name, current)
+                        else:
+                            logging.info("Editing datastore %s: %d changes", db_name,
+                                         len(changes))
+                            store.edit(db_name, changes, current)
+                    finally:
+                        # Even an edit that raised may have been partly written.
+                        if store is self.datastore:
+                            self.cache.invalidate(db_name)
+                            if not self.candidate.is_changed(db_name):
+                                # The candidate shares it with running.
+                                self._drop_working_trees("candidate", [db_name])
+            except Exception:
+                # The working trees may be ahead of the datastore.
+                self._drop_working_trees(target)
+                raise
+
+        # Outside the lock, so concurrent edits are made durable together.
+        store.sync()
+        return util.elm("ok")
+
+    def rpc_validate(self, session, rpc, *unused_params):  # pylint: disable=W0613
+        """Validate the running or candidate datastore or an inline <config> (RFC 6241 8.6)."""
+        source = rpc[0].find("nc:source", namespaces=NSMAP)
+        if source is None or not len(source):
+            raise error.MissingElementProtoError(rpc, util.qname("nc:source"))
+        if etree.QName(source[0]).localname == "config":
+            data = source[0]
+        else:
+            data, unused = self._read_datastores(None, self._get_store(rpc, source))
+        try:
+            Validation.validate_rpc(data, "validate")
+        except Validation.ValidationError as ex:
+            raise self._validation_error(rpc, ex)
+        return util.elm("ok")
+
+    def rpc_commit(self, session, rpc, *params):
+        """Replay the changes made to the candidate on running.
+
+        The :confirmed-commit parameters (RFC 6241 8.4) aren't supported.
+        """
+        for param in params:
+            if param is not None:
+                raise error.OperationNotSupportedProtoError(
+                    rpc, message="Commit parameter {} isn't supported".format(
+                        etree.QName(param).localname))
+        with self.edit_lock:
+            self._check_lock(session, rpc, "running")
+            self._check_lock(session, rpc, "candidate")
+            try:
+                names = self.candidate.commit(self.cache.invalidate)
+            except Edit.DataMissing as ex:
+                # Running was changed under the candidate, nothing is committed.
+                raise error.DataMissingAppError(rpc, message="Commit conflicts with running: " +
+                                                str(ex))
+            finally:
+                self._drop_working_trees()
+        self.datastore.sync()
+        logging.info("Committed datastores %s", ", ".join(names))
+        return util.elm("ok")
+
+    def rpc_discard_changes(self, session, rpc, *unused_params):
+        """Revert the candidate to running."""
+        with self.edit_lock:
+            self._check_lock(session, rpc, "candidate")
+            self.candidate.discard()
+            self._drop_working_trees("candidate")
+        return util.elm("ok")
+
+    def rpc_lock(self, session, rpc, target):  # pylint: disable=W0613
+        """Refuse to lock a candidate holding changes (RFC 6241 7.5)."""
+        if target == "candidate":
+            with self.edit_lock:
+                if self.candidate.is_changed():
+                    raise error.LockDeniedProtoError(rpc, 0)
+        return util.elm("ok")
+
+    def rpc_unlock(self, session, rpc, target):  # pylint: disable=W0613
+        # The candidate was unchanged when locked (see `rpc_lock`), so its
+        # changes were all made under the lock and go with it.
+        if target == "candidate":
+            with self.edit_lock:
+                self.candidate.discard()
+                self._drop_working_trees("candidate")
+        return util.elm("ok")
+
+    @dispatch.rpc(namespace=NSMAP["sys"])
     def rpc_system_restart(self, session, rpc, *params):
         raise error.AccessDeniedAppError(rpc)
 
+    @dispatch.rpc(namespace=NSMAP["sys"])
     def rpc_system_shutdown(self, session, rpc, *params):
         raise error.AccessDeniedAppError(rpc)
 
@@ -261,7 +571,114 @@ def main(*margs):
         "--password", default="admin", help='Use "env:" or "file:" prefix to specify source')
     parser.add_argument('--port', type=int, default=8300, help='Netconf server port')
     parser.add_argument("--username", default="admin", help='Netconf username')
+    parser.add_argument(
+        "--datastore",
+        default="mongo",
+        choices=Datastore.BACKENDS,
+        help='Datastore backend')
+    parser.add_argument(
+        "--datastore-path",
+        default=None,
+        help='Directory for the file datastore or initial XML for the memory datastore')
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help='Directory of a write-ahead journal in front of the mongo or file datastore')
+    parser.add_argument(
+        "--journal-window",
+        type=float,
+        default=Journal.DEFAULT_WINDOW,
+        help='Seconds concurrent journal writes are gathered into one fsync')
+    parser.add_argument(
+        "--journal-checkpoint-interval",
+        type=float,
+        default=Journal.DEFAULT_CHECKPOINT_INTERVAL,
+        help='Seconds between checkpoints of the journal into the datastore')
+    parser.add_argument(
+        "--journal-checkpoint-bytes",
+        type=int,
+        default=Journal.DEFAULT_CHECKPOINT_BYTES,
+        help='Journal size in bytes starting a checkpoint')
+    parser.add_argument(
+        "--yang-path",
+        default=None,
+        help='Directories of the YANG modules edits are validated with, none by default')
+    parser.add_argument(
+        "--audit-max-queue",
+        type=int,
+        default=Audit.DEFAULT_MAX_QUEUE,
+        help='Maximum validation audit records queued and not yet written')
+    parser.add_argument(
+        "--audit-flush-size",
+        type=int,
+        default=Audit.DEFAULT_FLUSH_SIZE,
+        help='Validation audit records written per batch')
+    parser.add_argument(
+        "--audit-flush-interval",
+        type=float,
+        default=Audit.DEFAULT_FLUSH_INTERVAL,
+        help='Seconds a validation audit record waits to be written with others')
+    parser.add_argument(
+        "--audit-policy",
+        default="drop",
+        choices=Audit.POLICIES,
+        help='Drop records or make the RPC wait when the validation audit queue is full')
+    parser.add_argument("--mongo-uri", default=Database.DEFAULT_URI, help='MongoDB connection URI')
+    parser.add_argument(
+        "--mongo-pool-size",
+        type=int,
+        default=Database.DEFAULT_POOL_SIZE,
+        help='Maximum MongoDB connections kept in the pool')
+    parser.add_argument(
+        "--mongo-connect-timeout",
+        type=float,
+        default=Database.DEFAULT_CONNECT_TIMEOUT,
+        help='MongoDB connect timeout in fractional seconds')
+    parser.add_argument(
+        "--mongo-max-idle",
+        type=float,
+        default=Database.DEFAULT_MAX_IDLE,
+        help='Seconds an idle MongoDB connection is kept in the pool')
+    parser.add_argument(
+        "--cache-entries",
+        type=int,
+        default=Cache.DEFAULT_MAX_ENTRIES,
+        help='Maximum number of rendered datastores cached')
+    parser.add_argument(
+        "--cache-bytes",
+        type=int,
+        default=Cache.DEFAULT_MAX_BYTES,
+        help='Maximum size in bytes of the rendered datastore cache')
+    parser.add_argument(
+        "--session-engine",
+        default="thread",
+        choices=("asyncio", "thread"),
+        help='Read sessions with one asyncio event loop or with a thread each')
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help=('Maximum threads of the asyncio session engine handling the messages '
+              'received, they run the RPCs only with --rpc-workers 0'))
+    parser.add_argument(
+        "--rpc-workers",
+        type=int,
+        default=workers.DEFAULT_WORKERS,
+        help=('Threads running the RPCs of all sessions with either session engine, '
+              '0 to run them in the session reader thread or on the --workers threads'))
+    parser.add_argument(
+        "--rpc-max-pending",
+        type=int,
+        default=workers.DEFAULT_MAX_PENDING,
+        help='Maximum RPCs queued or running on the RPC workers over all sessions')
+    parser.add_argument(
+        "--pretty-xml",
+        action="store_true",
+        help='Send indented XML replies instead of compact UTF-8')
     args = parser.parse_args(*margs)
+    if args.journal and args.datastore == "memory":
+        # Checkpoints would retire the journal into memory only.
+        parser.error("--journal needs a durable --datastore, not memory")
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
@@ -269,7 +686,37 @@ def main(*margs):
     host_key = "/home/marcos/Documents/netconf/example/server-key"
 
     auth = server.SSHUserPassController(username=args.username, password=args.password)
-    s = SystemServer(args.port, host_key, auth, args.debug)
+    audit_client = None
+    if args.yang_path:
+        Validation.load(args.yang_path.split(os.pathsep))
+        audit_client = Database.connect(
+            args.mongo_uri, pool_size=1, connect_timeout=args.mongo_connect_timeout)
+        collection = audit_client[Validation.AUDIT_DATABASE][Validation.AUDIT_COLLECTION]
+        Validation.set_audit_log(
+            Audit.AuditLog(collection, args.audit_max_queue, args.audit_flush_size,
+                           args.audit_flush_interval, args.audit_policy))
+    if args.datastore == "mongo":
+        datastore = Datastore.open_datastore(
+            "mongo",
+            uri=args.mongo_uri,
+            pool_size=args.mongo_pool_size,
+            connect_timeout=args.mongo_connect_timeout,
+            max_idle=args.mongo_max_idle)
+    else:
+        datastore = Datastore.open_datastore(args.datastore, args.datastore_path)
+    if args.journal:
+        datastore = Journal.JournalDatastore(datastore, args.journal, args.journal_window,
+                                             args.journal_checkpoint_interval,
+                                             args.journal_checkpoint_bytes)
+    engine = None
+    if args.session_engine == "asyncio":
+        from netconf import aio
+        engine = aio.SessionEngine(args.workers)
+    pool = None
+    if args.rpc_workers > 0:
+        pool = workers.WorkerPool(args.rpc_workers, args.rpc_max_pending)
+    s = SystemServer(args.port, host_key, auth, args.debug, datastore, args.cache_entries,
+                     args.cache_bytes, engine, pool, not args.pretty_xml)
 
     if sys.stdout.isatty():
         print("^C to quit server")
@@ -280,6 +727,13 @@ def main(*margs):
         print("quitting server")
 
     s.close()
+    if audit_client is not None:
+        Validation.get_audit_log().close()
+        audit_client.close()
+    if pool is not None:
+        pool.close()
+    if engine is not None:
+        engine.close()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,117 @@
-from lxml import etree
-import pymongo
-import os
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""YANG validation of datastore contents.
+
+The YANG modules are parsed once by pyang into a `Schema`, a tree of the data
+nodes with their keys, types, mandatory and min/max-elements, unique, must
+and when statements. Validating a tree walks it once against the schema:
+leaf values are checked with the pyang type specifications, must and when
+expressions and leafref paths are evaluated with lxml XPath (expressions using
+functions that aren't supported are skipped).
+
+An edit is validated incrementally (`Schema.validate_changes`): only the
+changed subtrees are walked, along with the siblings constraints of the
+changed nodes and the expressions that refer to them. The expressions
+referring to a node are found in an index of the data node names each must,
+when and leafref path uses, built when the modules are loaded. The instances
+re-evaluated are those under the closest ancestor of the change an expression
+can reach with its ".." steps.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
 import datetime
+import logging
+import os
+import re
+import threading
+from lxml import etree
+import Edit
+
+logger = logging.getLogger(__name__)
+
+try:
+    from pyang import context, repository, xpath_lexer
+    from pyang import error as pyang_error
+    from pyang import types as pyang_types
+    from pyang import xpath as pyang_xpath
+    have_pyang = True
+except ImportError:
+    have_pyang = False
+
+# A validation error.
+#
+# path: The path of the data node, e.g. "/components/component[name='a']/config".
+# message: What is wrong.
+# tag: The NETCONF error-tag of the error.
+Issue = collections.namedtuple("Issue", "path message tag")
+
+_DATA_KEYWORDS = ("container", "list", "leaf", "leaf-list", "anydata", "anyxml")
+
+# Axes and functions reaching nodes other than the descendants of the
+# ancestors the ".." steps of an expression go to.
+_UNBOUNDED_AXES = ("ancestor", "ancestor-or-self", "parent", "preceding", "preceding-sibling",
+                   "following", "following-sibling")
+_UNBOUNDED_FUNCTIONS = ("deref", "id")
+
+# The lookups of an absolute leafref path in a validation before the values
+# it selects are collected once for the following lookups.
+_MAX_LOOKUPS = 16
+
+# An expression to evaluate again when a node it refers to changes.
+#
+# node: The `_Node` with the expression.
+# kind: "must", "when" or "leafref".
+# xpath: The `_XPath`.
+# on_self: False if the context node of the expression is the parent of the node.
+_Dependent = collections.namedtuple("_Dependent", "node kind xpath on_self")
+
+
+class ValidationError(Exception):
+    """The data isn't valid.
+
+    :param issues: A list of `Issue`.
+    """
+
+    def __init__(self, issues):
+        super(ValidationError, self).__init__("; ".join(
+            "{}: {}".format(x.path, x.message) for x in issues))
+        self.issues = issues
+
+
+# Where the validation results are logged (see `set_audit_log`).
+AUDIT_DATABASE = "mydatabase"
+AUDIT_COLLECTION = "log_validation"
+
+_audit_log = None
+
+
+def set_audit_log(audit_log):
+    """Set the `Audit.AuditLog` the validation results are queued to, None for none."""
+    global _audit_log
+    _audit_log = audit_log
+
+
+def get_audit_log():
+    """Return the `Audit.AuditLog` set by `set_audit_log` or None."""
+    return _audit_log
 
 
 def register(operation, status, info):
-    myclient = pymongo.MongoClient("mongodb://localhost:27017/")
-    mydb = myclient["mydatabase"]
-    collection = mydb["log_validation"]
+    """Queue the result of a validation to the audit log, without waiting for it to be written."""
+    if _audit_log is None:
+        return
 
     rpc = {
         "datetime" : datetime.datetime.utcnow(),
@@ -18,30 +122,881 @@ def register(operation, status, info):
     if info:
         rpc["info"] = info
 
-    collection.insert_one(rpc)
+    _audit_log.log(rpc)
+
+
+def _namespace(module):
+    return module.search_one("namespace").arg
+
+
+def _whens(stmt):
+    """Return the when statements of a schema statement and of the uses and
+    augment it comes from."""
+    whens = list(stmt.search("when"))
+    for uses in getattr(stmt, "i_uses", None) or ():
+        whens.extend(uses.search("when"))
+    augment = getattr(stmt, "i_augment", None)
+    if augment is not None:
+        whens.extend(augment.search("when"))
+    return whens
+
+
+def _data_children(stmt, whens=(), in_choice=False):
+    """Yield (data node statement, when statements of its choices and cases,
+    True if it is in a case)."""
+    for child in getattr(stmt, "i_children", None) or ():
+        if child.keyword in ("choice", "case"):
+            for item in _data_children(child, list(whens) + _whens(child), True):
+                yield item
+        elif child.keyword in _DATA_KEYWORDS:
+            yield child, whens, in_choice
+
+
+def _at_start(previous):
+    """Return True if a "/" after lexer token `previous` starts an absolute location path."""
+    return previous is None or previous.type == "COMMA" or (xpath_lexer._is_special(previous) and
+                                                            previous.type not in ("SLASH",
+                                                                                  "DOUBLESLASH"))
+
+
+def _absolute(expr):
+    """Make the absolute location paths of a YANG XPath expression start at the
+    children of the validated element instead of at the document root.
+
+    >>> _absolute("/a:x/a:y = ../a:z or count(/a:w) > 0")
+    '/*/a:x/a:y = ../a:z or count(/*/a:w) > 0'
+    """
+    tokens = xpath_lexer.scan(expr)
+    previous = None
+    for tok in tokens:
+        if tok.type == "_whitespace":
+            continue
+        if tok.type == "SLASH" and _at_start(previous):
+            tok.value = "/*/"
+        previous = tok
+    return "".join(tok.value for tok in tokens)
+
+
+def _dependencies(expr, prefixes):
+    """Return what a prefixed YANG XPath expression refers to.
+
+    :param prefixes: The prefix to namespace map of the expression.
+    :return: (the tags of the data nodes it names, with "*" if it selects
+             nodes of any name; the number of ".." steps it takes, None if it
+             reaches nodes outside of the ancestor they go to; the namespaces of
+             the top level nodes its absolute paths start at)
+
+    >>> tags, climb, tops = _dependencies("../a:x[a:y = current()/../a:z]", {"a": "urn:a"})
+    >>> sorted(tags), climb, sorted(tops)
+    (['{urn:a}x', '{urn:a}y', '{urn:a}z'], 2, [])
+    >>> tags, climb, tops = _dependencies("count(/a:x/*) > 0", {"a": "urn:a"})
+    >>> sorted(tags), climb, sorted(tops)
+    (['*', '{urn:a}x'], None, ['urn:a'])
+    """
+    tags = set()
+    climb = 0
+    tops = set()
+    previous = None
+    top = False
+    for tok in xpath_lexer.scan(expr):
+        if tok.type == "_whitespace":
+            continue
+        if tok.type in ("SLASH", "DOUBLESLASH") and _at_start(previous):
+            climb = None
+            top = tok.type == "SLASH"
+        elif tok.type == "name":
+            prefix, unused, name = tok.value.rpartition(":")
+            namespace = prefixes.get(prefix, "")
+            tags.add("{" + namespace + "}" + name)
+            if top:
+                tops.add(namespace)
+            top = False
+        elif tok.type in ("wildcard", "prefix_test") or (tok.type == "node_type" and
+                                                         tok.value == "node"):
+            tags.add("*")
+            top = False
+        elif tok.type == "DOTDOT":
+            if climb is not None:
+                climb += 1
+        elif (tok.type == "axis" and tok.value in _UNBOUNDED_AXES) or (
+                tok.type == "function_name" and tok.value in _UNBOUNDED_FUNCTIONS):
+            climb = None
+        previous = tok
+    return tags, climb, tops
+
+
+class _XPath(object):
+    """A compiled must, when or leafref path expression.
+
+    :param text: The expression as written in the module.
+    :param message: The error-message of a must statement or None.
+    :param dependencies: What `_dependencies` returns for the expression.
+    """
+
+    def __init__(self, xpath, text, message=None, absolute=False, dependencies=(set(), 0, set())):
+        self.xpath = xpath
+        self.text = text
+        self.message = message
+        # True if the result doesn't depend on the context node.
+        self.absolute = absolute
+        self.tags, self.climb, self.tops = dependencies
+        self.supported = True
+        # For a leafref path, tests if it selects the value $value.
+        self.exists = None
+
+
+class _Node(object):
+    """A data node of the compiled schema."""
+
+    def __init__(self, schema, stmt, whens, in_choice=False, parent=None):
+        self.kind = stmt.keyword
+        self.name = stmt.arg
+        self.namespace = _namespace(stmt.i_module)
+        self.tag = "{" + self.namespace + "}" + self.name
+        self.parent = parent
+        # The tags from the top level node to the node.
+        self.tags = (parent.tags if parent is not None else []) + [self.tag]
+        self.config = getattr(stmt, "i_config", True) is not False
+        mandatory = stmt.search_one("mandatory")
+        # mandatory and min-elements are only checked outside of choices, the
+        # case present isn't known.
+        self.mandatory = mandatory is not None and mandatory.arg == "true" and not in_choice
+        min_elements = stmt.search_one("min-elements")
+        self.min_elements = 0
+        if min_elements is not None and not in_choice:
+            self.min_elements = int(min_elements.arg)
+        max_elements = stmt.search_one("max-elements")
+        self.max_elements = None
+        if max_elements is not None and max_elements.arg != "unbounded":
+            self.max_elements = int(max_elements.arg)
+
+        self.type = stmt.search_one("type")
+        self.leafref = None
+        if self.type is not None:
+            self.leafref = schema._leafref(self.type)
+        # Whens of the node itself have the node as context node, the others its parent.
+        self.whens = [(schema._xpath(x), True) for x in stmt.search("when")]
+        self.whens.extend((schema._xpath(x), False) for x in list(whens) + _whens(stmt)
+                          if x.parent is not stmt)
+        self.musts = [schema._xpath(x) for x in stmt.search("must")]
+
+        self.keys = []
+        self.unique = []
+        # (unique, XPath counting the entries of a parent with the values $v0... of unique)
+        self.unique_counts = []
+        if self.kind == "list":
+            self.keys = ["{" + self.namespace + "}" + x.arg for x in getattr(stmt, "i_key", ())]
+            for unused, leafs in getattr(stmt, "i_unique", ()):
+                self.unique.append([self._relative(stmt, x) for x in leafs])
+            self.unique_counts = [(x, self._count_xpath(x)) for x in self.unique]
+        # Counts the instances in a parent.
+        self.count = None
+        if self.mandatory or self.min_elements or self.max_elements is not None:
+            self.count = self._count_xpath([])
+        # The `_Dependent` list of the node and its descendants, see `Schema._dependents`.
+        self.dependents = None
+
+        self.children = {}
+        for child, child_whens, in_choice in _data_children(stmt):
+            node = _Node(schema, child, child_whens, in_choice, self)
+            self.children[node.tag] = node
+        # The children checked even when absent.
+        self.constrained = [
+            x for x in self.children.values()
+            if x.mandatory or x.min_elements or x.max_elements is not None or
+            x.kind in ("list", "leaf-list")
+        ]
+
+    def __repr__(self):
+        return "_Node({} {})".format(self.kind, self.name)
+
+    def iter(self):
+        """Yield the node and its descendants."""
+        yield self
+        for child in self.children.values():
+            for node in child.iter():
+                yield node
+
+    def contains(self, node):
+        """Return True if `node` is this node or one of its descendants."""
+        while node is not None and node is not self:
+            node = node.parent
+        return node is self
+
+    def _count_xpath(self, unique):
+        prefixes = {}
+
+        def name(tag):
+            qname = etree.QName(tag)
+            prefix = prefixes.setdefault(qname.namespace, "n{}".format(len(prefixes)))
+            return prefix + ":" + qname.localname
+
+        predicates = "".join("[{} = $v{}]".format("/".join(name(x) for x in tags), i)
+                             for i, tags in enumerate(unique))
+        expr = "count({}{})".format(name(self.tag), predicates)
+        return etree.XPath(expr, namespaces=dict((v, k) for k, v in prefixes.items()))
+
+    @staticmethod
+    def _relative(list_stmt, leaf):
+        """Return the child tags from a list entry to a descendant leaf."""
+        tags = []
+        while leaf is not None and leaf is not list_stmt:
+            if leaf.keyword in _DATA_KEYWORDS:
+                tags.append("{" + _namespace(leaf.i_module) + "}" + leaf.arg)
+            leaf = leaf.parent
+        return list(reversed(tags))
+
+
+def _unique_values(entry, unique):
+    """Return the values of the leafs of unique statement `unique` in a list
+    entry or None if one is missing."""
+    values = []
+    for tags in unique:
+        value_elm = entry
+        for tag in tags:
+            value_elm = value_elm.find(tag) if value_elm is not None else None
+        if value_elm is None:
+            return None
+        values.append((value_elm.text or "").strip())
+    return tuple(values)
+
+
+class Index(object):
+    """The unique values of the list entries of a data tree.
+
+    Kept by the caller across the `Schema.validate_changes` of the same tree,
+    so that checking a unique statement of a changed entry doesn't count all
+    the entries of its list. It must be replaced by a new one when the tree is
+    changed without being validated.
+    """
+
+    def __init__(self):
+        # {(parent, list tag, unique position): (entries to values, values to
+        # entries, entries when indexed)}, entries no longer in the tree are
+        # dropped when their values are looked up.
+        self.uniques = {}
+
+    def _table(self, node, position, parent):
+        key = (parent, node.tag, position)
+        table = self.uniques.get(key)
+        if table is None or len(table[0]) > 2 * table[2] + 64:
+            entries = {}
+            by_values = collections.defaultdict(set)
+            for entry in parent.iterchildren(tag=node.tag):
+                values = entries[entry] = _unique_values(entry, node.unique[position])
+                if values is not None:
+                    by_values[values].add(entry)
+            table = self.uniques[key] = (entries, by_values, len(entries))
+        return table
+
+    def duplicated(self, node, position, elm, values):
+        """Return True if another entry of the parent of list entry `elm` has
+        the `values` of unique statement `position` of `node`."""
+        parent = elm.getparent()
+        entries, by_values, unused = self._table(node, position, parent)
+        old = entries.get(elm)
+        if elm not in entries or old != values:
+            if old is not None:
+                by_values[old].discard(elm)
+            entries[elm] = values
+            if values is not None:
+                by_values[values].add(elm)
+        if values is None:
+            return False
+        others = by_values[values]
+        for entry in list(others):
+            if entry is elm:
+                continue
+            if entry.getparent() is parent and _unique_values(entry,
+                                                              node.unique[position]) == values:
+                return True
+            others.discard(entry)
+            entries.pop(entry, None)
+        return False
+
+
+class _Run(object):
+    """The state of one validation.
+
+    :param root: The element whose children are the top level nodes validated.
+    :param max_lookups: The lookups of an absolute leafref path before the
+                        values it selects are collected.
+    :param index: The `Index` of `root` or None.
+    """
+
+    def __init__(self, config, root, max_lookups=0, index=None):
+        self.config = config
+        self.index = index
+        self.issues = []
+        self.reported = set()
+        # Absolute paths to other top level nodes can't be evaluated.
+        self.namespaces = set(etree.QName(x).namespace for x in root.iterchildren(tag=etree.Element))
+        # The values selected by absolute leafref paths.
+        self.targets = {}
+        self.lookups = collections.Counter()
+        self.max_lookups = max_lookups
+        # The (element, `_Dependent`) checked.
+        self.checked = set()
+
+    def error(self, path, message, tag="invalid-value"):
+        issue = Issue(path or "/", message, tag)
+        if issue not in self.reported:
+            self.reported.add(issue)
+            self.issues.append(issue)
+
+
+class Schema(object):
+    """The compiled data nodes of a set of YANG modules.
+
+    :param paths: The directories searched for the modules and their imports.
+    :param modules: The names of the modules to load, by default all the
+                    modules of the .yang files in `paths`.
+    """
+
+    def __init__(self, paths, modules=None):
+        assert have_pyang
+        if isinstance(paths, str):
+            paths = paths.split(os.pathsep)
+        repo = repository.FileRepository(os.pathsep.join(paths), use_env=False)
+        self.ctx = context.Context(repo)
+        if modules is None:
+            modules = sorted(
+                set(
+                    re.sub(r"@.*", "", x[:-5]) for path in paths for x in os.listdir(path)
+                    if x.endswith(".yang")))
+        loaded = []
+        for name in modules:
+            module = self.ctx.search_module(None, name)
+            if module is None:
+                raise ValueError("YANG module {} not found in {}".format(name, paths))
+            loaded.append(module)
+        self.ctx.validate()
+        for pos, tag, args in self.ctx.errors:
+            if pyang_error.is_error(pyang_error.err_level(tag)):
+                logger.warning("%s: %s", str(pos), pyang_error.err_to_str(tag, args))
+
+        self.local = threading.local()
+        self.modules = dict((x.arg, x) for x in self.ctx.modules.values())
+        self.namespaces = dict((_namespace(x), x) for x in self.modules.values()
+                               if x.keyword == "module")
+        self.top = {}
+        for module in loaded:
+            for stmt, whens, in_choice in _data_children(module):
+                node = _Node(self, stmt, whens, in_choice)
+                self.top[node.tag] = node
+
+        # The `_Dependent` list of each tag, with "*" for expressions selecting any node.
+        self.index = collections.defaultdict(list)
+        for top in self.top.values():
+            for node in top.iter():
+                dependents = [_Dependent(node, "when", x, on_self) for x, on_self in node.whens]
+                dependents.extend(_Dependent(node, "must", x, True) for x in node.musts)
+                if node.leafref is not None:
+                    dependents.append(_Dependent(node, "leafref", node.leafref, True))
+                for dependent in dependents:
+                    if dependent.xpath is not None:
+                        for tag in dependent.xpath.tags:
+                            self.index[tag].append(dependent)
+        logger.info("Loaded YANG modules %s, %d top level nodes", ", ".join(modules),
+                    len(self.top))
+
+    def _prefixes(self, module):
+        """Return the prefix to namespace map of the expressions of a module."""
+        prefixes = {module.i_prefix: _namespace(module)}
+        for prefix, (name, revision) in module.i_prefixes.items():
+            imported = self.ctx.get_module(name, revision) or self.ctx.get_module(name)
+            if imported is not None and imported.keyword == "module":
+                prefixes[prefix] = _namespace(imported)
+        return prefixes
+
+    def _compile(self, text, stmt, message=None):
+        module = getattr(stmt, "i_orig_module", None) or stmt.i_module
+        if module.keyword == "submodule":
+            module = self.ctx.get_module(module.i_including_modulename) or module
+        prefixes = self._prefixes(module)
+        try:
+            prefixed = pyang_xpath.add_prefix(module.i_prefix, text)
+            expr = _absolute(prefixed)
+            extensions = {
+                (None, "current"): self._current,
+                (None, "derived-from"): lambda ctx, nodes, identity: self._derived_from(
+                    prefixes, nodes, identity, False),
+                (None, "derived-from-or-self"): lambda ctx, nodes, identity: self._derived_from(
+                    prefixes, nodes, identity, True),
+                (None, "re-match"): self._re_match,
+            }
+            xpath = etree.XPath(expr, namespaces=prefixes, extensions=extensions)
+            absolute = expr.startswith("/") and "current()" not in expr
+            compiled = _XPath(xpath, text, message, absolute, _dependencies(prefixed, prefixes))
+            if absolute:
+                compiled.exists = etree.XPath("boolean((" + expr + ")[. = $value])",
+                                              namespaces=prefixes,
+                                              extensions=extensions)
+        except (etree.XPathError, SyntaxError, xpath_lexer.XPathError) as ex:
+            logger.debug("Skipping XPath %s: %s", text, str(ex))
+            return None
+        return compiled
+
+    def _xpath(self, stmt):
+        message = stmt.search_one("error-message")
+        return self._compile(stmt.arg, stmt, message.arg if message is not None else None)
+
+    def _leafref(self, type_stmt):
+        """Return the compiled path of a leafref requiring an instance or None."""
+        spec = getattr(type_stmt, "i_type_spec", None)
+        if not isinstance(spec, pyang_types.PathTypeSpec) or not spec.require_instance:
+            return None
+        return self._compile(spec.path_.arg, spec.path_)
+
+    def _current(self, unused_ctx):
+        return [self.local.current]
+
+    def _identity(self, text, nsmap, namespace):
+        prefix, unused, name = text.strip().rpartition(":")
+        namespace = nsmap.get(prefix or None, namespace) if prefix else namespace
+        module = self.namespaces.get(namespace)
+        if module is None:
+            return None
+        return module.i_identities.get(name)
+
+    def _derived_from(self, prefixes, nodes, identity, or_self):
+        prefix, unused, name = identity.rpartition(":")
+        module = self.namespaces.get(prefixes.get(prefix))
+        base = module.i_identities.get(name) if module is not None else None
+        if base is None:
+            return False
+        for node in nodes:
+            value = self._identity(node.text or "", node.nsmap, etree.QName(node).namespace)
+            if value is not None and ((or_self and value is base) or
+                                      pyang_types.is_derived_from(value, base)):
+                return True
+        return False
+
+    @staticmethod
+    def _re_match(unused_ctx, value, pattern):
+        if isinstance(value, list):
+            value = value[0].text if value else ""
+        return re.match("(?:" + pattern + r")\Z", value or "") is not None
+
+    def _evaluate(self, run, xpath, elm, compiled=None, **variables):
+        """Return the result of a compiled expression or None if it can't be evaluated.
+
+        :param compiled: The lxml XPath to evaluate for `xpath`, by default `xpath.xpath`.
+        """
+        if xpath is None or not xpath.supported or not xpath.tops <= run.namespaces:
+            return None
+        self.local.current = elm
+        try:
+            return (compiled or xpath.xpath)(elm, **variables)
+        except etree.XPathError as ex:
+            logger.info("Skipping XPath %s: %s", xpath.text, str(ex))
+            xpath.supported = False
+            return None
+
+    def _true(self, run, xpath, elm):
+        result = self._evaluate(run, xpath, elm)
+        return True if result is None else bool(result)
+
+    def _value_error(self, type_stmt, elm):
+        """Return what is wrong with the value of a leaf element or None."""
+        spec = getattr(type_stmt, "i_type_spec", None)
+        if spec is None:
+            return None
+        text = elm.text or ""
+        if isinstance(spec, pyang_types.PathTypeSpec):
+            target = getattr(spec, "i_target_node", None)
+            if target is None:
+                return None
+            return self._value_error(target.search_one("type"), elm)
+        if isinstance(spec, pyang_types.UnionTypeSpec):
+            for member in spec.types:
+                if self._value_error(member, elm) is None:
+                    return None
+            return "\"{}\" matches no member type of union".format(text)
+        if isinstance(spec, pyang_types.IdentityrefTypeSpec):
+            identity = self._identity(text, elm.nsmap, etree.QName(elm).namespace)
+            if identity is None:
+                return "unknown identity \"{}\"".format(text)
+            for base in spec.idbases:
+                if not pyang_types.is_derived_from(identity, base.i_identity):
+                    return "identity \"{}\" not derived from {}".format(text, base.arg)
+            return None
+        if isinstance(spec, pyang_types.EmptyTypeSpec):
+            return "empty leaf has a value" if text.strip() else None
+        errors = []
+        value = spec.str_to_val(errors, type_stmt.pos, text, type_stmt.i_module)
+        if value is not None and not errors:
+            spec.validate(errors, type_stmt.pos, value, type_stmt.i_module)
+        if errors:
+            unused, tag, args = errors[0]
+            return pyang_error.err_to_str(tag, args)
+        if value is None:
+            return "invalid value \"{}\"".format(text)
+        return None
+
+    def _leafref_error(self, run, node, elm):
+        xpath = node.leafref
+        text = (elm.text or "").strip()
+        if xpath.absolute:
+            targets = run.targets.get(xpath)
+            if targets is None and run.lookups[xpath] < run.max_lookups:
+                run.lookups[xpath] += 1
+                if self._evaluate(run, xpath, elm, xpath.exists, value=text) is False:
+                    return "leafref target \"{}\" of {} doesn't exist".format(text, xpath.text)
+                return None
+            if targets is None:
+                result = self._evaluate(run, xpath, elm)
+                if result is None:
+                    return None
+                targets = run.targets[xpath] = set((x.text or "").strip() for x in result)
+        else:
+            result = self._evaluate(run, xpath, elm)
+            if result is None:
+                return None
+            targets = set((x.text or "").strip() for x in result)
+        if text not in targets:
+            return "leafref target \"{}\" of {} doesn't exist".format(text, xpath.text)
+        return None
+
+    def _check_expression(self, run, dependent, elm, path):
+        """Evaluate a must, when or leafref expression of a node instance.
+
+        :param path: The path of `elm` or None to find it if it is in error.
+        """
+        xpath = dependent.xpath
+        if xpath is None:
+            return
+        if dependent.kind == "leafref":
+            message, tag = self._leafref_error(run, dependent.node, elm), "invalid-value"
+        elif dependent.kind == "when":
+            context_elm = elm if dependent.on_self else elm.getparent()
+            message, tag = None, "unknown-element"
+            if context_elm is not None and not self._true(run, xpath, context_elm):
+                message = "when condition \"{}\" is false".format(xpath.text)
+        else:
+            message, tag = None, "operation-failed"
+            if not self._true(run, xpath, elm):
+                message = xpath.message or "must condition \"{}\" is false".format(xpath.text)
+        if message is not None:
+            run.error(path if path is not None else self._element_path(elm), message, tag)
+
+    def _check_node(self, run, node, elm, path):
+        for xpath, on_self in node.whens:
+            self._check_expression(run, _Dependent(node, "when", xpath, on_self), elm, path)
+        for xpath in node.musts:
+            self._check_expression(run, _Dependent(node, "must", xpath, True), elm, path)
+
+        if node.kind in ("leaf", "leaf-list"):
+            message = self._value_error(node.type, elm)
+            if message is None and node.leafref is not None:
+                message = self._leafref_error(run, node, elm)
+            if message is not None:
+                run.error(path, message)
+            return
+        if node.kind not in ("container", "list"):
+            return
+        for key in node.keys:
+            if elm.find(key) is None:
+                run.error(path, "missing key {}".format(etree.QName(key).localname),
+                          "missing-element")
+        self._check_children(run, node.children, node.constrained, elm, path)
+
+    def _element_path(self, elm):
+        """Return the path of a data element from the top level node."""
+        elms = []
+        while elm.getparent() is not None:
+            elms.append(elm)
+            elm = elm.getparent()
+        path = ""
+        children = self.top
+        for elm in reversed(elms):
+            node = children.get(elm.tag)
+            path += "/" + etree.QName(elm).localname
+            if node is None:
+                children = {}
+                continue
+            if node.kind == "list":
+                path = self._entry_path(node, elm, path)
+            children = node.children
+        return path
+
+    @staticmethod
+    def _entry_path(node, elm, path):
+        for key in node.keys:
+            key_elm = elm.find(key)
+            if key_elm is not None:
+                path += "[{}='{}']".format(etree.QName(key).localname, (key_elm.text or "").strip())
+        return path
+
+    def _check_children(self, run, children, constrained, elm, path):
+        present = {}
+        for child in elm.iterchildren(tag=etree.Element):
+            node = children.get(child.tag)
+            child_path = path + "/" + etree.QName(child).localname
+            if node is None:
+                if children is self.top and etree.QName(child).namespace not in self.namespaces:
+                    # A module that isn't loaded.
+                    continue
+                run.error(child_path, "unknown element", "unknown-element")
+                continue
+            if run.config and not node.config:
+                run.error(child_path, "state data in configuration", "invalid-value")
+                continue
+            present.setdefault(node.tag, []).append(child)
+            if node.kind == "list":
+                child_path = self._entry_path(node, child, child_path)
+            self._check_node(run, node, child, child_path)
+        for node in constrained:
+            self._check_instances(run, node, present.get(node.tag, ()), path)
+
+    @staticmethod
+    def _check_count(run, node, count, node_path):
+        if node.mandatory and not count and not node.whens:
+            run.error(node_path, "missing mandatory node", "data-missing")
+        if count < node.min_elements:
+            run.error(node_path, "too few elements ({} < {})".format(count, node.min_elements),
+                      "operation-failed")
+        if node.max_elements is not None and count > node.max_elements:
+            run.error(node_path, "too many elements ({} > {})".format(count, node.max_elements),
+                      "operation-failed")
+
+    def _check_instances(self, run, node, instances, path):
+        """Check the constraints on all instances of a node in a parent."""
+        if run.config and not node.config:
+            return
+        node_path = path + "/" + node.name
+        count = len(instances)
+        self._check_count(run, node, count, node_path)
+        if count < 2:
+            return
+        if node.kind == "leaf-list" and node.config:
+            values = [(x.text or "").strip() for x in instances]
+            if len(set(values)) != len(values):
+                run.error(node_path, "duplicate leaf-list values", "operation-failed")
+        elif node.kind == "list":
+            uniques = [node.keys] if node.keys else []
+            uniques.extend(node.unique)
+            for leafs in uniques:
+                seen = set()
+                for entry in instances:
+                    value = []
+                    for tags in leafs:
+                        if not isinstance(tags, list):
+                            tags = [tags]
+                        value_elm = entry
+                        for tag in tags:
+                            value_elm = value_elm.find(tag) if value_elm is not None else None
+                        value.append(None if value_elm is None else (value_elm.text or "").strip())
+                    if None in value and leafs is not node.keys:
+                        # unique ignores entries without all the leafs.
+                        continue
+                    value = tuple(value)
+                    if value in seen:
+                        run.error(node_path, "duplicate {} {}".format(
+                            "key" if leafs is node.keys else "unique value", value),
+                                  "operation-failed")
+                    seen.add(value)
+
+    def validate(self, root, config=False):
+        """Return the `Issue` list of a data tree.
+
+        :param root: An element whose children are top level data nodes (e.g.,
+                     a module element or a <data> element).
+        :param config: True if the tree holds only configuration.
+        """
+        run = _Run(config, root)
+        self._check_children(run, self.top, (), root, "")
+        return run.issues
+
+    def _dependents(self, node):
+        """Return the `_Dependent` list of the expressions referring to a node
+        or to one of its descendants."""
+        if node.dependents is None:
+            dependents = collections.OrderedDict()
+            for tag in set(x.tag for x in node.iter()) | set(["*"]):
+                for dependent in self.index.get(tag, ()):
+                    dependents[id(dependent)] = dependent
+            node.dependents = list(dependents.values())
+        return node.dependents
+
+    @staticmethod
+    def _scope(dependent, nodes):
+        """Return the depth of the ancestor of a change whose descendants hold
+        the instances of an expression that may refer to it, 0 for all.
+
+        :param nodes: The schema nodes of the steps of the change.
+        """
+        climb = dependent.xpath.climb
+        if climb is None:
+            return 0
+        if not dependent.on_self:
+            climb += 1
+        owner = dependent.node.tags
+        common = 0
+        while common < len(owner) and common < len(nodes) and owner[common] == nodes[common].tag:
+            common += 1
+        return max(0, min(common, len(owner) - climb))
+
+    @staticmethod
+    def _located(module, change, parent, elm):
+        """Return the instances of the steps of a change from where `Edit.apply` put it.
+
+        :return: The elements from `module` to the changed node or None if the
+                 change was undone by a later change of the same edit.
+        """
+        elms = [elm]
+        while parent is not None and parent is not module:
+            elms.append(parent)
+            parent = parent.getparent()
+        if parent is None or len(elms) != len(change.path):
+            return None
+        elms.append(module)
+        elms.reverse()
+        return elms
+
+    def _check_change(self, run, module, change, located=None):
+        nodes = []
+        children = self.top
+        for tag, unused in change.path:
+            node = children.get(tag)
+            if node is None:
+                if nodes or etree.QName(tag).namespace in self.namespaces:
+                    run.error(
+                        Edit.path_string(change.path[:len(nodes) + 1]), "unknown element",
+                        "unknown-element")
+                return
+            nodes.append(node)
+            children = node.children
+        # elms[i] is the instance of nodes[i - 1], the module element for 0.
+        if located is not None:
+            elms = self._located(module, change, *located)
+        else:
+            elms = [module] + Edit.find(module, change.path)
+        if elms is None:
+            return
+        node, elm, parent = nodes[-1], elms[-1], elms[-2]
+        if parent is None or (change.op == "set" and elm is None):
+            return
+        path = Edit.path_string(change.path)
+
+        if change.op == "set":
+            if run.config and not node.config:
+                run.error(path, "state data in configuration", "invalid-value")
+                return
+            self._check_node(run, node, elm, path)
+        if not run.config or node.config:
+            parent_path = Edit.path_string(change.path[:-1])
+            if node.count is not None:
+                count = int(node.count(parent))
+                self._check_count(run, node, count, parent_path + "/" + node.name)
+        for i, ancestor in enumerate(nodes):
+            ancestor_path = Edit.path_string(change.path[:i + 1])
+            if elms[i + 1] is not None:
+                # The values of unique may be in the changed subtree.
+                self._check_unique(run, ancestor, elms[i + 1], ancestor_path)
+            if ancestor is not node:
+                for xpath in ancestor.musts:
+                    self._check_expression(run, _Dependent(ancestor, "must", xpath, True),
+                                           elms[i + 1], ancestor_path)
+
+        adding = change.op == "set" and not change.exists
+        for dependent in self._dependents(node):
+            if adding and dependent.kind == "leafref" and not node.contains(dependent.node):
+                # Adding nodes doesn't remove leafref targets.
+                continue
+            depth = self._scope(dependent, nodes)
+            if depth >= len(elms) or elms[depth] is None:
+                continue
+            tags = dependent.node.tags[depth:]
+            instances = elms[depth].iterfind("/".join(tags)) if tags else [elms[depth]]
+            for instance in instances:
+                if (instance, dependent) not in run.checked:
+                    run.checked.add((instance, dependent))
+                    self._check_expression(run, dependent, instance, None)
+
+    @staticmethod
+    def _check_unique(run, node, elm, path):
+        """Check that a list entry has no unique values of another entry."""
+        for position, (unique, count) in enumerate(node.unique_counts):
+            values = _unique_values(elm, unique)
+            if run.index is not None:
+                duplicated = run.index.duplicated(node, position, elm, values)
+            elif values is not None:
+                variables = dict(("v{}".format(i), x) for i, x in enumerate(values))
+                duplicated = count(elm.getparent(), **variables) > 1
+            else:
+                duplicated = False
+            if duplicated:
+                run.error(path, "duplicate unique value {}".format(values), "operation-failed")
+
+    def validate_changes(self, module, changes, located=None, config=False, index=None):
+        """Return the `Issue` list of the nodes changed by an edit.
+
+        Only the changed subtrees, the constraints on the instances of the
+        changed nodes and the expressions referring to them are checked, so the
+        time taken depends on the size of the edit, not of the datastore.
+
+        :param module: The module element of a datastore (see
+                       `Datastore.module_element`) with the changes applied.
+        :param changes: The `Edit.Change` list applied.
+        :param located: What `Edit.apply` returned, to not look the changes up again.
+        :param config: True if the tree holds only configuration.
+        :param index: The `Index` of `module` or None.
+        """
+        run = _Run(config, module, _MAX_LOOKUPS, index)
+        for i, change in enumerate(changes):
+            self._check_change(run, module, change, located[i] if located is not None else None)
+        return run.issues
+
+    def check(self, root, config=False):
+        """Validate a data tree.
+
+        :raises: `ValidationError` if the tree isn't valid.
+        """
+        issues = self.validate(root, config)
+        if issues:
+            raise ValidationError(issues)
+
+
+_schema = None
+
+
+def load(paths, modules=None):
+    """Load the YANG modules used by `validate_rpc`, once at server start.
 
+    :return: The `Schema`.
+    """
+    global _schema
+    _schema = Schema(paths, modules)
+    return _schema
 
-def validate_rpc(rpc, operation):
 
-    # Writing data to file
-    data_to_insert_string = etree.tostring(rpc, pretty_print=True)
-    file = open('validation.xml', 'w+')
-    file.write(data_to_insert_string)
-    file.close()
+def get_schema():
+    """Return the `Schema` loaded by `load` or None."""
+    return _schema
 
-    modules = os.popen('cat validation.xml | grep http | cut -d\'"\' -f2 | grep http | cut -d\'"\' -f2').read()
-    dependencies = os.popen("python dependencies.py "+modules).read()
 
-    o = os.popen("pyang -f xmlverifier "+''.join(dependencies.splitlines()) +
-                 " -o example.tree -p all/ --xmlverifier-xml validation.xml --xmlverifier-operation "
-                 + operation + "| grep Issues -A100").read()
+def validate_rpc(rpc, operation, changes=None, located=None, index=None):
+    """Validate a data tree with the modules given to `load` and log the result.
 
-    file = open('res.txt', 'w+')
-    file.write(o)
-    file.close
+    Nothing is checked if no modules were loaded.
 
-    if not o == "":
-        register(operation, "error", o)
-        raise Exception("the model in the system is not syntactically valid")
+    :param rpc: An element whose children are top level data nodes.
+    :param operation: The operation logged (e.g., "edit-config").
+    :param changes: The `Edit.Change` list applied to module element `rpc`
+                    to validate only what they changed, None to validate all.
+    :param located: What `Edit.apply` returned for the changes.
+    :param index: The `Index` of `rpc` kept across its edits or None.
+    :raises: `ValidationError`
+    """
+    if _schema is None:
+        return
+    if changes is None:
+        issues = _schema.validate(rpc)
     else:
-        register(operation, "success", o)
+        issues = _schema.validate_changes(rpc, changes, located, index=index)
+    if issues:
+        info = "\n".join("{}: {}".format(x.path, x.message) for x in issues)
+        register(operation, "error", info)
+        raise ValidationError(issues)
+    register(operation, "success", "")
@@ -48,6 +48,16 @@ def main(*margs):
         help=("Perform <edit-config>. arg value is the method ('merge' or 'replace') " +
               " 'merge' if not specified. New config is in 'infile' or stdin"))
     parser.add_argument('--host', default="localhost", help='Netconf server hostname')
+    parser.add_argument(
+        '--targets',
+        help=('Run on each "[user@]host[:port]" listed in this file ("-" for stdin) ' +
+              'and write a JSON result line per target as they complete'))
+    parser.add_argument(
+        '--concurrency', type=int, default=32, help="Maximum targets run at a time with --targets")
+    parser.add_argument(
+        '--host-timeout',
+        type=float,
+        help="Timeout in fractional seconds for all of a target's work with --targets")
     parser.add_argument(
         '--get',
         const="",
@@ -99,6 +109,11 @@ def main(*margs):
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    if args.targets:
+        # Python 3 only.
+        from . import fanout
+        sys.exit(1 if fanout.main(args) else 0)
+
     session = client.NetconfSSHSession(
         args.host, args.port, args.username, args.password, debug=args.debug)
 
@@ -120,7 +135,7 @@ def main(*margs):
             sys.exit(1)
 
         if args.edit_config is None:
-            result = session.send_rpc(xml)[2]
+            result = session.send_rpc(xml, reply=client.REPLY_RAW).decode('utf-8')
         else:
             result = session.edit_config(args.source, args.edit_config, xml, args.timeout)
             result = etree.tounicode(result, pretty_print=True)
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""An asyncio engine reading netconf sessions without a thread per session.
+
+A `SessionEngine` runs one event loop thread that waits on the channels of
+all its sessions. Received data is split into messages (1.0 or 1.1 framing)
+and, for sessions with `parse_messages`, parsed as it arrives. Messages of a
+session are handled one at a time in arrival order: the blocking
+`_reader_handle_message` (and so the rpc_* methods) runs in an executor, rpc_*
+methods that are coroutine functions are run on the loop.
+
+Sessions are handed to an engine with the `engine` argument of
+`NetconfSSHServer`, `NetconfClientSession` and `NetconfSSHSession`. This
+module requires Python 3.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import socket
+import threading
+import traceback
+from lxml import etree
+
+from netconf import MAXSSHBUF
+from netconf.error import ChannelClosed, FramingError, SessionError
+
+logger = logging.getLogger(__name__)
+
+
+class FramingParser(object):
+    """Split a received byte stream into netconf messages.
+
+    :param parse: True to parse the messages as the data arrives, messages are
+                  then root elements instead of text.
+    :param new_parser: Returns the feed parser of a message when parsing,
+                       messages are then what its close() returns.
+    """
+
+    def __init__(self, parse, new_parser=etree.XMLParser):
+        self.parse = parse
+        self.new_parser = new_parser
+        self.buffer = bytearray()
+        # 1.0: bytes of buffer scanned for the end marker, 1.1: bytes left of the chunk.
+        self.scan = 0
+        self.chunk_left = 0
+        self.fed = 0
+        self.msg = bytearray()
+        self.msglen = 0
+        self.parser = None
+
+    def _append(self, start, end):
+        # Add buffer[start:end] to the message. Views of the buffer are kept
+        # to temporaries so a traceback held by the parser doesn't pin it.
+        self.msglen += end - start
+        if not self.parse:
+            self.msg += memoryview(self.buffer)[start:end]
+            return
+        if self.parser is None:
+            self.parser = self.new_parser()
+        try:
+            self.parser.feed(bytes(memoryview(self.buffer)[start:end]))
+        except etree.XMLSyntaxError as error:
+            logger.warning("Closing session due to malformed message")
+            raise SessionError("Invalid XML received: {}".format(error))
+
+    def _finish(self):
+        # Return the message, None if empty.
+        msglen, self.msglen = self.msglen, 0
+        if not self.parse:
+            msg, self.msg = self.msg, bytearray()
+            return msg.decode('utf-8') if msglen else None
+        parser, self.parser = self.parser, None
+        if not msglen:
+            return None
+        try:
+            return parser.close()
+        except etree.XMLSyntaxError as error:
+            logger.warning("Closing session due to malformed message")
+            raise SessionError("Invalid XML received: {}".format(error))
+
+    def feed(self, data, new_framing):
+        """Add received data.
+
+        :param data: The received bytes.
+        :param new_framing: True if the session uses 1.1 chunked framing.
+        :return: A list of the messages completed by the data.
+        :raises: `FramingError`, `SessionError`
+        """
+        self.buffer += data
+        messages = []
+        if new_framing:
+            self._feed_11(messages)
+        else:
+            self._feed_10(messages)
+        return messages
+
+    def _feed_10(self, messages):
+        while True:
+            eomidx = self.buffer.find(b"]]>]]>", self.scan)
+            if eomidx == -1:
+                # Anything that can't be part of the end marker is message data.
+                self.scan = max(0, len(self.buffer) - 5)
+                if self.scan > self.fed:
+                    self._append(self.fed, self.scan)
+                    self.fed = self.scan
+                del self.buffer[:self.fed]
+                self.scan -= self.fed
+                self.fed = 0
+                return
+            self._append(self.fed, eomidx)
+            del self.buffer[:eomidx + 6]
+            self.scan = self.fed = 0
+            messages.append(self._finish())
+
+    def _feed_11(self, messages):
+        pos = 0
+        buflen = len(self.buffer)
+        while pos < buflen:
+            if self.chunk_left:
+                nbytes = min(self.chunk_left, buflen - pos)
+                self._append(pos, pos + nbytes)
+                pos += nbytes
+                self.chunk_left -= nbytes
+                continue
+
+            if buflen - pos < 4:
+                break
+            if self.buffer[pos:pos + 2] != b"\n#":
+                raise FramingError(bytes(self.buffer[pos:]))
+            idx = self.buffer.find(b"\n", pos + 2, pos + 14)
+            if idx == -1:
+                if buflen - pos > 13:
+                    raise FramingError(bytes(self.buffer[pos:]))
+                break
+            lenstr = bytes(self.buffer[pos + 2:idx])
+            pos = idx + 1
+            if lenstr == b"#":
+                messages.append(self._finish())
+                continue
+            try:
+                chunklen = int(lenstr)
+            except ValueError:
+                raise FramingError("Frame length not integer: {}".format(lenstr))
+            if not (4294967295 >= chunklen > 0):
+                raise FramingError("Unacceptable chunk length: {}".format(chunklen))
+            self.chunk_left = chunklen
+        del self.buffer[:pos]
+
+
+def _fileno(stream):
+    """Return the file descriptor signalling data to read on stream."""
+    try:
+        return stream.fileno()
+    except AttributeError:
+        # sshutil client sessions wrap a paramiko channel.
+        return stream.chan.fileno()
+
+
+class _SessionState(object):
+    def __init__(self, session, stream, fileno):
+        self.session = session
+        self.stream = stream
+        self.fileno = fileno
+        self.framing = FramingParser(session.parse_messages, session._message_parser)
+        self.queue = collections.deque()
+        self.busy = False
+
+
+class SessionEngine(object):
+    """An event loop thread reading any number of netconf sessions.
+
+    :param max_workers: Maximum number of threads running blocking handlers.
+    :param executor: An optional `concurrent.futures.Executor` for the blocking
+                     handlers, `max_workers` is then ignored.
+    :param max_chunk: Maximum bytes read from a channel at a time.
+    """
+
+    def __init__(self, max_workers=None, executor=None, max_chunk=MAXSSHBUF):
+        self.max_chunk = max_chunk
+        self.own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers, thread_name_prefix="NetconfWorker")
+        self.executor = executor
+        self.sessions = {}
+        self.local = threading.local()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="NetconfSessionEngine")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return "SessionEngine(sessions:{})".format(len(self.sessions))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _in_loop(self, func, *args):
+        """Call func in the loop thread and return its result."""
+        if threading.current_thread() is self.thread:
+            return func(*args)
+        if not self.loop.is_running() or self.loop.is_closed():
+            return None
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(func(*args))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result()
+
+    def close(self):
+        """Stop reading all sessions and stop the loop thread."""
+        for session in list(self.sessions):
+            self.detach(session)
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+            # The sessions handling a message when stopped.
+            tasks = _all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    def attach(self, session):
+        """Start reading an opened session, called in place of starting a reader thread.
+
+        Data already received by the session's transport (e.g., a message
+        sent right after the hello) is handled first.
+        """
+        pkt_stream = session.pkt_stream
+        state = _SessionState(session, pkt_stream.stream, _fileno(pkt_stream.stream))
+        pending = pkt_stream.take_buffered()
+        self._in_loop(self._attach, state, pending)
+        if session.debug:
+            logger.debug("%s: Attached %s", str(self), str(session))
+
+    def _attach(self, state, pending):
+        self.sessions[state.session] = state
+        self.loop.add_reader(state.fileno, self._readable, state)
+        if pending:
+            self._received(state, pending)
+
+    def detach(self, session):
+        """Stop reading a session, must be called before its stream is closed."""
+        self._in_loop(self._detach, session)
+
+    def _detach(self, session):
+        state = self.sessions.pop(session, None)
+        if state is not None:
+            self.loop.remove_reader(state.fileno)
+        return state
+
+    def _readable(self, state):
+        stream = state.stream
+        recv_ready = getattr(stream, "recv_ready", None)
+        try:
+            if recv_ready is not None and not recv_ready() and not _at_eof(stream):
+                return
+            data = stream.recv(self.max_chunk)
+        except (socket.error, EOFError, AttributeError) as error:
+            logger.debug("%s: Error reading %s: %s", str(self), str(state.session), str(error))
+            data = b""
+        if not data:
+            if state.session.debug:
+                logger.debug("%s: Remote closed %s", str(self), str(state.session))
+            self._closed(state)
+            return
+        self._received(state, data)
+
+    def _received(self, state, data):
+        try:
+            messages = state.framing.feed(data, state.session.new_framing)
+        except (FramingError, SessionError) as error:
+            logger.error("%s Session error [closing session]: %s", str(state.session), str(error))
+            self._closed(state)
+            return
+        for msg in messages:
+            if msg is None:
+                # Same as the reader thread, an empty message ends the session.
+                self._closed(state)
+                return
+            state.queue.append(msg)
+        self._schedule(state)
+
+    def _closed(self, state):
+        self._detach(state.session)
+        state.queue.append(None)
+        self._schedule(state)
+
+    def _schedule(self, state):
+        if state.queue and not state.busy:
+            state.busy = True
+            self.loop.create_task(self._drain(state))
+
+    async def _drain(self, state):
+        # Handle the queued messages of a session in order.
+        try:
+            while state.queue:
+                msg = state.queue.popleft()
+                if msg is None:
+                    state.queue.clear()
+                    await self.loop.run_in_executor(self.executor, _session_closed, state.session)
+                    return
+                deferred = await self.loop.run_in_executor(self.executor, self._handle, state, msg)
+                for coro, callback in deferred:
+                    # A coroutine rpc_* method, await it before the next message.
+                    await self._complete(coro, callback)
+        finally:
+            state.busy = False
+
+    async def _complete(self, coro, callback):
+        try:
+            reply, error = await coro, None
+        except Exception as ex:
+            reply, error = None, ex
+        await self.loop.run_in_executor(self.executor, callback, reply, error)
+
+    def _handle(self, state, msg):
+        # Called in the executor, mirrors the reader thread error handling.
+        # Returns the coroutines deferred while handling the message.
+        session = state.session
+        self.local.deferred = deferred = []
+        try:
+            session._reader_handle_message(msg)
+            return deferred
+        except (ChannelClosed, socket.error, EOFError) as error:
+            logger.debug("%s: Session channel closed: %s", str(session), str(error))
+        except SessionError as error:
+            logger.error("%s Session error [closing session]: %s", str(session), str(error))
+        except Exception as error:
+            logger.error("Unexpected exception handling message [disconnecting]: %s: %s",
+                         str(error), traceback.format_exc())
+        finally:
+            self.local.deferred = None
+        self.loop.call_soon_threadsafe(self._closed, state)
+        return []
+
+    def defer(self, reply, callback):
+        """Run the reply of an rpc_* method on the loop if it's a coroutine.
+
+        When called while the engine handles a message the coroutine is
+        awaited on the loop once the handling returns, without holding an
+        executor thread, and before the next message of the session is
+        handled. Otherwise (e.g., from a `workers.WorkerPool` thread) it's
+        started on the loop right away and this returns without waiting.
+
+        :param reply: The value returned by the rpc_* method.
+        :param callback: Called in the executor with (reply, exception or None)
+                         when the coroutine completes.
+        :return: True if `reply` is a coroutine and was deferred.
+        """
+        if not asyncio.iscoroutine(reply):
+            return False
+        deferred = getattr(self.local, "deferred", None)
+        if deferred is not None:
+            deferred.append((reply, callback))
+            return True
+        asyncio.run_coroutine_threadsafe(self._complete(reply, callback), self.loop)
+        return True
+
+
+def _all_tasks(loop):
+    """Return the tasks of `loop` not done."""
+    if hasattr(asyncio, "all_tasks"):
+        return asyncio.all_tasks(loop)
+    return set(x for x in asyncio.Task.all_tasks(loop) if not x.done())
+
+
+def _at_eof(stream):
+    chan = getattr(stream, "chan", stream)
+    return getattr(chan, "closed", False) or getattr(chan, "eof_received", False)
+
+
+def _session_closed(session):
+    try:
+        session.close()
+    except Exception as error:
+        logger.debug("%s: Exception while closing: %s", str(session), str(error))
+    finally:
+        session._reader_exits()
+
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""An asyncio netconf client.
+
+An `AsyncNetconfSession` is read by the event loop it's opened on, replies
+are parsed as they arrive and resolve the awaiting RPC by message-id, so a
+single loop can drive thousands of sessions::
+
+    async def poll(host):
+        async with await aioclient.connect_ssh(host, username="admin") as session:
+            return await session.get_config(select="/sys:system")
+
+The SSH connection is set up in the loop's default executor, after that the
+session uses no thread of its own. This module requires Python 3.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import asyncio
+import functools
+import logging
+import socket
+import threading
+from lxml import etree
+
+import sshutil.conn
+from netconf import NSMAP, MAXSSHBUF
+from netconf import util
+from netconf.aio import FramingParser, _at_eof, _fileno
+from netconf.base import NC_BASE_10, NC_BASE_11, XML_HEADER_BYTES, MIN_SEND
+from netconf.client import _get_selection
+from netconf.error import FramingError, ReplyTimeoutError, RPCError, SessionError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncNetconfSession(object):
+    """A netconf client session driven by an asyncio event loop.
+
+    Use `open` (or `connect_ssh`) to create an opened session.
+
+    :param stream: The connected stream (e.g., `sshutil.conn.SSHClientSession`).
+    :param debug: Enable debug logging.
+    :param compact: True to send requests as compact UTF-8 instead of indented text.
+    :param max_chunk: Maximum bytes read from the stream at a time.
+    """
+
+    def __init__(self, stream, debug=False, compact=False, max_chunk=MAXSSHBUF):
+        self.stream = stream
+        self.debug = debug
+        self.compact = compact
+        self.max_chunk = max_chunk
+        self.loop = asyncio.get_event_loop()
+        self.fileno = _fileno(stream)
+        self.framing = FramingParser(True)
+        self.new_framing = False
+        self.capabilities = set()
+        self.session_id = None
+        self.message_id = 0
+        # The future of the hello, then of the RPCs awaiting a reply by message-id.
+        self.hello = self.loop.create_future()
+        self.rpc_out = {}
+        self.write_lock = asyncio.Lock()
+        self.closed = False
+
+    def __str__(self):
+        return "AsyncNetconfSession(sid:{})".format(self.session_id)
+
+    @classmethod
+    async def open(cls, stream, debug=False, compact=False, timeout=None):
+        """Exchange hellos on a connected stream and return the opened session.
+
+        :param timeout: Seconds to wait for the server hello or None.
+        :raises: SessionError, ReplyTimeoutError
+        """
+        session = cls(stream, debug, compact)
+        try:
+            await session._open_session(timeout)
+        except BaseException:
+            session._closed(SessionError("Session open failed"))
+            raise
+        return session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def is_active(self):
+        return not self.closed
+
+    async def _open_session(self, timeout):
+        self.loop.add_reader(self.fileno, self._readable)
+
+        msg = util.elm("hello", attrib={'xmlns': NSMAP['nc']})
+        caps = util.subelm(msg, "capabilities")
+        for cap in (NC_BASE_10, NC_BASE_11):
+            util.subelm(caps, "capability").text = cap
+        if self.debug:
+            logger.debug("%s: Sending HELLO", str(self))
+        await self._send_message(etree.tostring(msg, encoding="utf-8"))
+
+        root = await self._wait(self.hello, timeout, "Timeout ({}s) while waiting for HELLO")
+        if self.debug:
+            logger.debug("Received HELLO")
+
+        for cap in root.xpath("//nc:hello/nc:capabilities/nc:capability", namespaces=NSMAP):
+            self.capabilities.add(cap.text.strip())
+        if NC_BASE_11 in self.capabilities:
+            self.new_framing = True
+        elif NC_BASE_10 not in self.capabilities:
+            raise SessionError("Server doesn't implement 1.0 or 1.1 of netconf")
+
+        session_id = root.xpath("//nc:hello/nc:session-id", namespaces=NSMAP)
+        if not session_id:
+            raise SessionError("Server didn't supply session-id")
+        try:
+            self.session_id = int(session_id[0].text)
+        except (TypeError, ValueError):
+            raise SessionError("Server supplied non integer session-id: {}".format(
+                session_id[0].text))
+
+        if self.debug:
+            logger.debug("%s: Opened version %s session.", str(self), "1.1"
+                         if self.new_framing else "1.0")
+
+    async def close(self):
+        """Send a <close-session> and close the stream."""
+        if self.closed:
+            return
+        if self.debug:
+            logger.debug("%s: Closing session.", str(self))
+        if self.session_id is not None:
+            try:
+                await self.send_rpc_async("<close-session/>", noreply=True)
+            except (socket.error, SessionError, EOFError) as error:
+                if self.debug:
+                    logger.debug("Got error sending close-session request, ignoring: %s",
+                                 str(error))
+        self._closed(SessionError("Session closed while waiting for reply"))
+
+    # ----------------
+    # Sending
+    # ----------------
+
+    async def _send_message(self, msg):
+        # Frame and send msg, bytes without the XML declaration.
+        msg = XML_HEADER_BYTES + msg
+        if self.new_framing:
+            frame = "\n#{}\n".format(len(msg)).encode('utf-8') + msg + b"\n##\n"
+        else:
+            frame = msg + b"]]>]]>"
+        if len(frame) < MIN_SEND:
+            frame += b"\n" * (MIN_SEND - len(frame))
+        async with self.write_lock:
+            await self._write(memoryview(frame))
+
+    async def _write(self, view):
+        # Write on the loop while the peer's channel window is open, a write
+        # that would block on the window finishes in the executor.
+        chan = getattr(self.stream, "chan", self.stream)
+        while view:
+            if self.closed:
+                raise SessionError("Session closed")
+            if (getattr(chan, "out_window_size", 0) or 0) <= 0:
+                await self.loop.run_in_executor(None, self.stream.sendall, view)
+                return
+            view = view[chan.send(view):]
+
+    async def send_rpc_async(self, rpc, noreply=False):
+        """Send a generic RPC to the server without waiting for the reply.
+
+        :param rpc: The XML of the netconf RPC, not including the <rpc> tag.
+        :type rpc: str or `lxml.Element`
+        :param noreply: True if no reply is required.
+        :return: An `asyncio.Future` of the (tree, reply, message) of the
+                 reply, None if `noreply`.
+        :raises: SessionError
+        """
+        if hasattr(rpc, "nsmap"):
+            rpc = etree.tostring(rpc, encoding="utf-8")
+        elif not isinstance(rpc, bytes):
+            rpc = rpc.encode('utf-8')
+        if self.closed:
+            raise SessionError("Session closed")
+
+        msg_id = self.message_id
+        self.message_id += 1
+        future = None
+        if not noreply:
+            future = self.loop.create_future()
+            future.msg_id = msg_id
+            self.rpc_out[msg_id] = future
+
+        if self.debug:
+            logger.debug("%s: Sending RPC message-id: %s", str(self), str(msg_id))
+        if self.compact:
+            msg = '<rpc message-id="{}" xmlns="{}">'.format(msg_id, NSMAP['nc']).encode(
+                'utf-8') + rpc + b"</rpc>"
+        else:
+            msg = '<rpc message-id="{}"\n     xmlns="{}">'.format(msg_id, NSMAP['nc']).encode(
+                'utf-8') + rpc + b"</rpc>"
+        try:
+            await self._send_message(msg)
+        except Exception:
+            self.rpc_out.pop(msg_id, None)
+            raise
+        return future
+
+    async def _wait(self, future, timeout, message):
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise ReplyTimeoutError(message.format(timeout))
+
+    async def wait_reply(self, future, timeout=None):
+        """Wait for the reply returned by `send_rpc_async`.
+
+        :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
+        :rtype: (lxml.etree, lxml.Element, lxml.Element)
+        :raises: RPCError, SessionError, ReplyTimeoutError
+        """
+        return await self._wait(
+            future, timeout,
+            "Timeout ({{}}s) while waiting for RPC reply to msg-id: {}".format(future.msg_id))
+
+    async def send_rpc(self, rpc, timeout=None):
+        """Send a generic RPC to the server and await the reply.
+
+        :param rpc: The XML of the netconf RPC, not including the <rpc> tag.
+        :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
+        :rtype: (lxml.etree, lxml.Element, lxml.Element)
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        future = await self.send_rpc_async(rpc)
+        return await self.wait_reply(future, timeout)
+
+    async def get(self, select=None, timeout=None):
+        """Get operational state from the server.
+
+        :param select: A XML subtree filter or XPATH expression to select a subsection of state.
+        :param timeout: Seconds to wait for the reply or `None` for no timeout.
+        :return: The Parsed XML state (i.e., "<data>...</data>".)
+        :rtype: lxml.Element
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        getelm = util.elm("get")
+        _get_selection(getelm, select)
+        _, reply, _ = await self.send_rpc(getelm, timeout)
+        return reply.find("nc:data", namespaces=NSMAP)
+
+    async def get_config(self, source="running", select=None, timeout=None):
+        """Get config for a given source from the server.
+
+        :param source: the source of the config, defaults to "running".
+        :param select: An XML subtree filter or XPATH expression to select a subsection of config.
+        :param timeout: Seconds to wait for the reply or `None` for no timeout.
+        :return: The Parsed XML config (i.e., "<config>...</config>".)
+        :rtype: lxml.Element
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        getelm = util.elm("get-config")
+        if not hasattr(source, "nsmap"):
+            source = util.elm(source)
+        util.subelm(util.subelm(getelm, "source"), source)
+        _get_selection(getelm, select)
+        _, reply, _ = await self.send_rpc(getelm, timeout)
+        return reply.find("nc:data", namespaces=NSMAP)
+
+    async def edit_config(self, target="running", method="", newconf="", timeout=None):
+        """Operate on ~config~ in ~target~ using ~newconf~ according to ~method~.
+
+        :param target: the target of the config, defaults to "running".
+        :param method: "merge" (netconf default), "replace" or "none".
+        :param newconf: The new configuration as XML text or an element.
+        :param timeout: Seconds to wait for the reply or `None` for no timeout.
+        :return: The result of the edit operation
+        :rtype: lxml.Element
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        editelm = util.elm("edit-config")
+        if not hasattr(target, "nsmap"):
+            target = util.elm(target)
+        util.subelm(util.subelm(editelm, "target"), target)
+        if method:
+            util.subelm(editelm, "default-operation").text = method
+        if hasattr(newconf, "nsmap"):
+            editelm.append(newconf)
+        elif newconf:
+            # Parse as the children of an nc element, as the threaded client sends it.
+            wrapper = etree.fromstring('<w xmlns="{}">{}</w>'.format(NSMAP['nc'], newconf))
+            editelm.extend(wrapper)
+        _, reply, _ = await self.send_rpc(editelm, timeout)
+        return reply
+
+    async def lock(self, target="running", timeout=None):
+        """Lock target datastore.
+
+        :param target: A string specifying the config datastore to lock.
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        lockelm = util.elm("lock")
+        if not hasattr(target, "nsmap"):
+            target = util.elm(target)
+        util.subelm(util.subelm(lockelm, "target"), target)
+        _, reply, _ = await self.send_rpc(lockelm, timeout)
+        return reply.find("nc:data", namespaces=NSMAP)
+
+    async def unlock(self, target="running", timeout=None):
+        """Unlock target datastore.
+
+        :param target: A string specifying the config datastore to unlock.
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        unlockelm = util.elm("unlock")
+        if not hasattr(target, "nsmap"):
+            target = util.elm(target)
+        util.subelm(util.subelm(unlockelm, "target"), target)
+        _, reply, _ = await self.send_rpc(unlockelm, timeout)
+        return reply.find("nc:data", namespaces=NSMAP)
+
+    # ----------------
+    # Receiving
+    # ----------------
+
+    def _readable(self):
+        stream = self.stream
+        recv_ready = getattr(stream, "recv_ready", None)
+        try:
+            if recv_ready is not None and not recv_ready() and not _at_eof(stream):
+                return
+            data = stream.recv(self.max_chunk)
+        except (socket.error, EOFError, AttributeError) as error:
+            logger.debug("%s: Error reading: %s", str(self), str(error))
+            data = b""
+        if not data:
+            if self.debug:
+                logger.debug("%s: Remote closed", str(self))
+            self._closed(SessionError("Session closed while waiting for reply"))
+            return
+        try:
+            messages = self.framing.feed(data, self.new_framing)
+            for root in messages:
+                if root is None:
+                    raise SessionError("Empty message received")
+                self._handle_message(root)
+        except (FramingError, SessionError) as error:
+            logger.error("%s Session error [closing session]: %s", str(self), str(error))
+            self._closed(error)
+
+    def _handle_message(self, root):
+        if not self.hello.done():
+            self.hello.set_result(root)
+            return
+        if root.tag != util.qname("nc:rpc-reply").text:
+            raise SessionError(etree.tounicode(root), "No rpc-reply found")
+        try:
+            msg_id = int(root.get('message-id'))
+        except (TypeError, ValueError):
+            raise SessionError(etree.tounicode(root), "No valid message-id attribute found")
+
+        future = self.rpc_out.pop(msg_id, None)
+        if future is None or future.done():
+            if self.debug:
+                logger.debug("Ignoring unwanted reply for message-id %s", str(msg_id))
+            return
+        if self.debug:
+            logger.debug("%s: Received rpc-reply message-id: %s", str(self), str(msg_id))
+        tree = root.getroottree()
+        error = root.find("nc:rpc-error", namespaces=NSMAP)
+        if error is not None:
+            future.set_exception(RPCError(etree.tounicode(root), tree, error))
+        else:
+            future.set_result((tree, root, root))
+
+    def _closed(self, error):
+        # Stop reading, close the stream and fail what's waiting.
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fileno)
+        try:
+            self.stream.close()
+        except Exception as ex:
+            logger.debug("%s: Exception while closing: %s", str(self), str(ex))
+        pending = list(self.rpc_out.values())
+        self.rpc_out.clear()
+        if not self.hello.done():
+            pending.append(self.hello)
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+
+async def connect_ssh(host,
+                      port=830,
+                      username=None,
+                      password=None,
+                      debug=False,
+                      cache=None,
+                      proxycmd=None,
+                      compact=False,
+                      timeout=None,
+                      executor=None):
+    """Open an `AsyncNetconfSession` over SSH.
+
+    The SSH connection is made in `executor`, see `client.NetconfSSHSession`
+    for the connection parameters. If the caller is cancelled meanwhile the
+    connection is closed once made.
+
+    :param timeout: Seconds to wait for the server hello or None.
+    :param executor: The `concurrent.futures.Executor` or None for the loop's default.
+    :raises: SessionError, ReplyTimeoutError
+    """
+    if username is None:
+        import getpass
+        username = getpass.getuser()
+    connect = _Connect(
+        functools.partial(sshutil.conn.SSHClientSession, host, port, "netconf", username,
+                          password, debug, cache=cache, proxycmd=proxycmd))
+    try:
+        stream = await asyncio.get_event_loop().run_in_executor(executor, connect)
+    except asyncio.CancelledError:
+        connect.abandon()
+        raise
+    return await AsyncNetconfSession.open(stream, debug, compact, timeout)
+
+
+class _Connect(object):
+    """Make a connection in an executor thread, closing it if abandoned.
+
+    :param func: Called to make the connection, returns the stream.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+        self.stream = None
+        self.abandoned = False
+
+    def __call__(self):
+        stream = self.func()
+        with self.lock:
+            if not self.abandoned:
+                self.stream = stream
+                return stream
+        self._close(stream)
+
+    def abandon(self):
+        """The caller is gone, close the connection now or once it's made."""
+        with self.lock:
+            self.abandoned = True
+            stream, self.stream = self.stream, None
+        if stream is not None:
+            self._close(stream)
+
+    @staticmethod
+    def _close(stream):
+        try:
+            stream.close()
+        except Exception as ex:
+            logger.debug("Exception while closing abandoned connection: %s", str(ex))
@@ -19,7 +19,6 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 import logging
-import io
 import socket
 import sys
 import threading
@@ -35,6 +34,9 @@ logger = logging.getLogger(__name__)
 NC_BASE_10 = "urn:ietf:params:netconf:base:1.0"
 NC_BASE_11 = "urn:ietf:params:netconf:base:1.1"
 XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>"""
+XML_HEADER_BYTES = XML_HEADER.encode('utf-8')
+# Apparently ssh has a bug that requires minimum of 64 bytes?
+MIN_SEND = 64
 
 if sys.version_info[0] >= 3:
 
@@ -46,6 +48,10 @@ if sys.version_info[0] >= 3:
             yield last, False
             last = e
         yield last, True
+
+    def _decode(buf, start, end):
+        """Decode the UTF-8 text in buf[start:end] without copying it first"""
+        return str(memoryview(buf)[start:end], 'utf-8')
 else:
 
     def lookahead(iterable):
@@ -57,54 +63,9 @@ else:
             last = e
         yield last, True
 
-
-def chunkit(msg, maxsend, minsend=0, pad="\n"):
-    """
-    chunkit iterates over a msg returning chunks of at most maxsend
-    size, and of at least minsend size if non-zero. Padding will be
-    added if required. This function currently requires that maxsend
-    is at least large enough to hold 2 minsend chunks.
-    """
-    # For now we'll make this assumption as it makes the
-    # implementation much easier.
-    assert maxsend >= 2 * minsend
-
-    sz = len(msg)
-    nchunks = sz // maxsend
-    lastmax = sz % maxsend
-
-    # Handle the special cases
-    if sz == 0:
-        return
-    elif nchunks == 1 and lastmax == 0:
-        yield msg
-        return
-    elif nchunks == 0:
-        # lastmax == 0 then sz == 0 handled above.
-        assert lastmax != 0
-        if lastmax < minsend:
-            msg = msg + pad * (minsend - lastmax)
-        yield msg
-        return
-
-    # Make sure our final chunk is at least minsend long.
-    nchunks -= 1
-    penultmax = maxsend
-    if lastmax == 0:
-        lastmax = maxsend
-        nchunks -= 1
-    elif lastmax < minsend:
-        penultmax -= minsend - lastmax
-        lastmax = minsend
-
-    left = 0
-    for unused in range(0, nchunks):
-        yield msg[left:left + maxsend]
-        left += maxsend
-
-    right = left + penultmax
-    yield msg[left:right]
-    yield msg[right:]
+    def _decode(buf, start, end):
+        """Decode the UTF-8 text in buf[start:end]"""
+        return bytes(buf[start:end]).decode('utf-8')
 
 
 class NetconfTransportMixin(object):
@@ -123,15 +84,96 @@ class NetconfPacketTransport(object):
         raise NotImplementedError()
 
 
+class PDUWriter(object):
+    """A file-like object that sends a PDU while it is being written.
+
+    With 1.1 framing the written data is sent as a chunk each time `max_chunk`
+    bytes are buffered, with 1.0 framing the data is sent as is. The end of
+    message is sent by `close`. Memory use is bounded by the chunk size
+    rather than by the size of the message.
+
+    The writer holds the transport's send side until it is closed or aborted
+    so other PDUs aren't sent in the middle of the message.
+
+    :param transport: The `NetconfFramingTransport` to send with.
+    :param max_chunk: The maximum chunk size.
+    :param new_framing: True to use 1.1 chunked framing.
+    """
+
+    def __init__(self, transport, max_chunk, new_framing):
+        self.transport = transport
+        self.max_chunk = max_chunk
+        self.new_framing = new_framing
+        self.buffer = bytearray()
+        self.nbytes = 0
+        transport._acquire_sender()
+        self.sending = True
+
+    def write(self, data):
+        self.buffer += data
+        # Hold some data back so the final send isn't too short.
+        while len(self.buffer) >= self.max_chunk + MIN_SEND:
+            self._send(self.max_chunk)
+
+    def flush(self):
+        pass
+
+    def _send(self, size, end=b""):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        parts = [data, end]
+        if self.new_framing and size:
+            parts.insert(0, "\n#{}\n".format(size).encode('utf-8'))
+        self.transport._write_parts(parts)
+        self.nbytes += size
+
+    def close(self):
+        """Send any buffered data and the end of message."""
+        end = b"\n##\n" if self.new_framing else b"]]>]]>"
+        try:
+            self._send(len(self.buffer), end)
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Give up the transport's send side without finishing the message."""
+        if self.sending:
+            self.sending = False
+            self.transport._release_sender()
+
+
+class _OutgoingPDU(object):
+    __slots__ = ("parts", "done", "error")
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.done = False
+        self.error = None
+
+
 class NetconfFramingTransport(NetconfPacketTransport):
     """Packetize an ssh stream into netconf PDUs -- doesn't need to be SSH specific"""
 
+    # Buffers grown beyond this for a large message are released after it.
+    max_keep = 1024 * 1024
+
+    # Largest single write to the stream, even if the channel window is larger.
+    max_send = 1024 * 1024
+
     def __init__(self, stream, max_chunk, debug):
         # XXX we have 2 channels defined one here and one in the connect/accept class
         self.stream = stream
         self.max_chunk = max_chunk
         self.debug = debug
-        self.rbuffer = b""
+        # PDUs waiting for the thread sending to the stream.
+        self.send_cv = threading.Condition()
+        self.send_queue = []
+        self.sending = False
+        # Received data is in rbuffer[rstart:rend], messages are assembled in abuffer.
+        self.rbuffer = bytearray(2 * max_chunk)
+        self.rstart = 0
+        self.rend = 0
+        self.abuffer = bytearray()
 
     def __del__(self):
         self.close()
@@ -155,105 +197,291 @@ class NetconfFramingTransport(NetconfPacketTransport):
         else:
             return self.stream.is_active()
 
-    def receive_pdu(self, new_framing):
+    def receive_pdu(self, new_framing, parser=None):
+        """Receive the next PDU.
+
+        :param new_framing: True to use 1.1 chunked framing.
+        :param parser: An optional feed parser (e.g., `etree.XMLParser`). The
+                       data is fed to it as it is received and the parsed root
+                       element is returned when the end of message arrives.
+        :return: The PDU text or root element, None if the PDU was empty and
+                 a parser was given.
+        """
         assert self.stream is not None
         if new_framing:
-            return self._receive_11()
+            return self._receive_11(parser)
         else:
-            return self._receive_10()
+            return self._receive_10(parser)
 
     def send_pdu(self, msg, new_framing):
+        """Send a PDU.
+
+        The message is framed as a list of parts referring to it rather than
+        copied. If another thread is sending, the PDU is queued and sent by
+        that thread together with any others queued meanwhile, so small PDUs
+        share channel writes. Returns once the PDU has been sent.
+
+        :param msg: The message as UTF-8 bytes or as text.
+        :param new_framing: True to use 1.1 chunked framing.
+        """
         assert self.stream is not None
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+        body = memoryview(msg)
         if new_framing:
-            bmsg = msg.encode('utf-8')
-            blen = len(bmsg)
-            msg = "\n#{}\n".format(blen).encode('utf-8') + bmsg + "\n##\n".encode('utf-8')
+            parts = ["\n#{}\n".format(len(body)).encode('utf-8'), body, b"\n##\n"]
         else:
-            msg += "]]>]]>"
+            parts = [body, b"]]>]]>"]
+
+        pdu = _OutgoingPDU(parts)
+        with self.send_cv:
+            self.send_queue.append(pdu)
+            while not pdu.done:
+                if self.sending:
+                    self.send_cv.wait()
+                    continue
+                batch, self.send_queue = self.send_queue, []
+                self.sending = True
+                error = None
+                self.send_cv.release()
+                try:
+                    self._write_parts([x for queued in batch for x in queued.parts])
+                except Exception as ex:
+                    error = ex
+                finally:
+                    self.send_cv.acquire()
+                    self.sending = False
+                    for queued in batch:
+                        queued.done = True
+                        queued.error = error
+                    self.send_cv.notify_all()
+        if pdu.error is not None:
+            raise pdu.error
+
+    def pdu_writer(self, new_framing):
+        """Return a `PDUWriter` sending a PDU incrementally on this transport."""
+        assert self.stream is not None
+        return PDUWriter(self, self._send_size(), new_framing)
+
+    def _acquire_sender(self):
+        with self.send_cv:
+            while self.sending:
+                self.send_cv.wait()
+            self.sending = True
+
+    def _release_sender(self):
+        with self.send_cv:
+            self.sending = False
+            self.send_cv.notify_all()
 
-        # Apparently ssh has a bug that requires minimum of 64 bytes?
-        for chunk in chunkit(msg, self.max_chunk, 64):
-            self.stream.sendall(chunk)
+    def _send_size(self):
+        """Return the size of the writes of large messages.
 
-    def _receive_10(self):
-        searchfrom = 0
+        Writes are sized to what the peer's channel window accepts, in whole
+        packets, so a write doesn't stall part way, and are at least `max_chunk`.
+        """
+        chan = getattr(self.stream, "chan", self.stream)
+        window = getattr(chan, "out_window_size", 0) or 0
+        packet = getattr(chan, "out_max_packet_size", 0) or 0
+        if packet:
+            window -= window % packet
+        return max(self.max_chunk, min(window, self.max_send))
+
+    def _write_parts(self, parts):
+        """Write a list of byte strings to the stream with few writes.
+
+        Parts smaller than `max_chunk` are copied together, larger ones are
+        written in place in pieces of `_send_size` keeping the last
+        `MIN_SEND` bytes to join what follows.
+        """
+        stream = self.stream
+        size = self._send_size()
+        pending = bytearray()
+        for part in parts:
+            if len(part) < self.max_chunk:
+                pending += part
+                if len(pending) >= size:
+                    stream.sendall(pending)
+                    pending = bytearray()
+                continue
+            part = memoryview(part)
+            if pending:
+                # Top up what's pending with the start of the part.
+                nbytes = max(0, min(self.max_chunk - len(pending), len(part) - MIN_SEND))
+                pending += part[:nbytes]
+                part = part[nbytes:]
+                stream.sendall(pending)
+                pending = bytearray()
+            while len(part) > size + MIN_SEND:
+                stream.sendall(part[:size])
+                part = part[size:]
+            if len(part) >= self.max_chunk:
+                stream.sendall(part[:-MIN_SEND])
+                part = part[-MIN_SEND:]
+            pending += part
+        if pending:
+            if len(pending) < MIN_SEND:
+                pending += b"\n" * (MIN_SEND - len(pending))
+            stream.sendall(pending)
+
+    def take_buffered(self):
+        """Return and forget the data received but not yet consumed as a PDU."""
+        data = bytes(self.rbuffer[self.rstart:self.rend])
+        self.rstart = self.rend = 0
+        return data
+
+    def _recv_into(self, view):
+        """Receive into memoryview `view`, return the number of bytes received."""
+        stream = self.stream
+        if stream is None:
+            if self.debug:
+                logger.debug("Channel closed: stream is None")
+            raise ChannelClosed(self)
+        recv_into = getattr(stream, "recv_into", None)
+        if recv_into is not None:
+            nbytes = recv_into(view, len(view))
+        else:
+            # e.g., paramiko channels
+            buf = stream.recv(len(view))
+            nbytes = len(buf)
+            view[:nbytes] = buf
+        if not nbytes:
+            if self.debug:
+                logger.debug("Channel closed: Zero bytes read")
+            raise ChannelClosed(self)
+        return nbytes
+
+    def _fill(self):
+        """Receive more data at the end of the receive buffer."""
+        if len(self.rbuffer) - self.rend < self.max_chunk:
+            # Compact, then grow if still short of space.
+            pending = self.rend - self.rstart
+            if self.rstart:
+                self.rbuffer[:pending] = self.rbuffer[self.rstart:self.rend]
+                self.rstart, self.rend = 0, pending
+            if len(self.rbuffer) - self.rend < self.max_chunk:
+                self.rbuffer += bytearray(max(len(self.rbuffer), self.max_chunk))
+        view = memoryview(self.rbuffer)[self.rend:self.rend + self.max_chunk]
+        self.rend += self._recv_into(view)
+
+    def _consume(self, nbytes):
+        """Advance the receive buffer cursor past `nbytes` bytes."""
+        self.rstart += nbytes
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+            if len(self.rbuffer) > self.max_keep:
+                self.rbuffer = bytearray(2 * self.max_chunk)
+
+    def _feed(self, parser, start, end):
+        parser.feed(bytes(memoryview(self.rbuffer)[start:end]))
+
+    def _receive_10(self, parser=None):
+        # With a parser everything that can't be part of the end marker is fed
+        # as it arrives, fed is relative to rstart as the buffer may compact.
+        fed = 0
+        searchfrom = self.rstart
         while True:
-            eomidx = self.rbuffer.find(b"]]>]]>", searchfrom)
+            eomidx = self.rbuffer.find(b"]]>]]>", searchfrom, self.rend)
             if eomidx != -1:
                 break
-            searchfrom = max(0, len(self.rbuffer) - 5)
-            buf = self.stream.recv(self.max_chunk)
-            self.rbuffer += buf
-
-        msg = self.rbuffer[:eomidx]
-        self.rbuffer = self.rbuffer[eomidx + 6:]
-        return msg.decode('utf-8')
-
-    def _receive_chunk(self):
-        blen = len(self.rbuffer)
-        while blen < 4:
-            buf = self.stream.recv(self.max_chunk)
-            self.rbuffer += buf
-            blen = len(self.rbuffer)
-            if self.stream is None:
-                if self.debug:
-                    logger.debug("Channel closed: stream is None")
-                raise ChannelClosed(self)
-            if not buf:
-                if self.debug:
-                    logger.debug("Channel closed: Zero bytes read")
-                raise ChannelClosed(self)
+            searchfrom = max(0, self.rend - self.rstart - 5)
+            if parser is not None and searchfrom > fed:
+                self._feed(parser, self.rstart + fed, self.rstart + searchfrom)
+                fed = searchfrom
+            self._fill()
+            searchfrom += self.rstart
+
+        msglen = eomidx - self.rstart
+        if parser is not None:
+            if msglen > fed:
+                self._feed(parser, self.rstart + fed, eomidx)
+            msg = parser.close() if msglen else None
+        else:
+            msg = _decode(self.rbuffer, self.rstart, eomidx)
+        self._consume(msglen + 6)
+        return msg
+
+    def _receive_chunk_header(self):
+        """Return the length of the next chunk or None for the end of message."""
+        while self.rend - self.rstart < 4:
+            self._fill()
 
-        if self.rbuffer[:2] != b"\n#":
-            raise FramingError(self.rbuffer)
-        self.rbuffer = self.rbuffer[2:]
+        if self.rbuffer[self.rstart:self.rstart + 2] != b"\n#":
+            raise FramingError(bytes(self.rbuffer[self.rstart:self.rend]))
+        self._consume(2)
 
         # Get chunk length or termination indicator
-        idx = -1
-        searchfrom = 0
         while True:
-            idx = self.rbuffer.find(b"\n", searchfrom)
+            idx = self.rbuffer.find(b"\n", self.rstart, self.rend)
+            if idx != -1:
+                idx -= self.rstart
             if 12 > idx > 0:
                 break
-            if idx > 12 or len(self.rbuffer) > 12:
-                raise FramingError(self.rbuffer)
-            searchfrom = len(self.rbuffer)
-            self.rbuffer += self.stream.recv(self.max_chunk)
+            if idx > 12 or self.rend - self.rstart > 12:
+                raise FramingError(bytes(self.rbuffer[self.rstart:self.rend]))
+            self._fill()
+
+        lenstr = bytes(self.rbuffer[self.rstart:self.rstart + idx])
+        self._consume(idx + 1)
 
         # Check for last chunk.
-        if self.rbuffer[0:2] == b"#\n":
-            self.rbuffer = self.rbuffer[2:]
+        if lenstr == b"#":
             return None
 
-        lenstr = self.rbuffer[:idx]
-        self.rbuffer = bytes(self.rbuffer[idx + 1:])
-
         try:
             chunklen = int(lenstr)
             if not (4294967295 >= chunklen > 0):
                 raise FramingError("Unacceptable chunk length: {}".format(chunklen))
         except ValueError:
-            raise FramingError("Frame length not integer: {}".format(lenstr.encode('utf-8')))
+            raise FramingError("Frame length not integer: {}".format(lenstr))
+        return chunklen
 
-        while True:
-            blen = len(self.rbuffer)
-            if blen >= chunklen:
-                chunk = self.rbuffer[:chunklen]
-                self.rbuffer = self.rbuffer[chunklen:]
-                return chunk
-            self.rbuffer += self.stream.recv(self.max_chunk)
-
-    def _iter_receive_chunks(self):
+    def _receive_11(self, parser=None):
         assert self.stream is not None
-        chunk = self._receive_chunk()
-        while chunk:
-            yield chunk
-            chunk = self._receive_chunk()
+        if parser is not None:
+            return self._receive_11_parse(parser)
 
-    def _receive_11(self):
-        assert self.stream is not None
-        data = b"".join([x for x in self._iter_receive_chunks()])
-        return data.decode('utf-8')
+        # The chunks are assembled in place in a buffer reused across messages.
+        msglen = 0
+        while True:
+            chunklen = self._receive_chunk_header()
+            if chunklen is None:
+                break
+            size = msglen + chunklen
+            if len(self.abuffer) < size:
+                self.abuffer += bytearray(max(size, 2 * len(self.abuffer)) - len(self.abuffer))
+            view = memoryview(self.abuffer)
+
+            # Copy what has been received already, read the rest straight into place.
+            nbytes = min(chunklen, self.rend - self.rstart)
+            view[msglen:msglen + nbytes] = memoryview(self.rbuffer)[self.rstart:self.rstart + nbytes]
+            self._consume(nbytes)
+            msglen += nbytes
+            while msglen < size:
+                msglen += self._recv_into(view[msglen:size])
+            del view
+
+        msg = _decode(self.abuffer, 0, msglen)
+        if len(self.abuffer) > self.max_keep:
+            self.abuffer = bytearray()
+        return msg
+
+    def _receive_11_parse(self, parser):
+        # Feed the chunk data to the parser as it is received.
+        msglen = 0
+        while True:
+            chunklen = self._receive_chunk_header()
+            if chunklen is None:
+                break
+            msglen += chunklen
+            while chunklen:
+                if self.rstart == self.rend:
+                    self._fill()
+                nbytes = min(chunklen, self.rend - self.rstart)
+                self._feed(parser, self.rstart, self.rstart + nbytes)
+                self._consume(nbytes)
+                chunklen -= nbytes
+        return parser.close() if msglen else None
 
 
 class NetconfSession(object):
@@ -263,8 +491,18 @@ class NetconfSession(object):
     # figure a way to factor the commonality. One issue is that this class can
     # be used with any transport not just SSH so where should it go?
 
-    def __init__(self, stream, debug, session_id, max_chunk=MAXSSHBUF):
+    # True to parse received messages as they arrive, `_reader_handle_message`
+    # is then passed the root element (see `_message_parser`) instead of the
+    # message text.
+    parse_messages = False
+
+    def __init__(self, stream, debug, session_id, max_chunk=MAXSSHBUF, engine=None,
+                 compact=False):
         self.debug = debug
+        # An `aio.SessionEngine` reading the session in place of a reader thread.
+        self.engine = engine
+        # Serialize messages as compact UTF-8 bytes instead of indented text.
+        self.compact = compact
         self.pkt_stream = NetconfFramingTransport(stream, max_chunk, debug)
         self.new_framing = False
         self.capabilities = set()
@@ -284,23 +522,79 @@ class NetconfSession(object):
     def __str__(self):
         return "NetconfSession(sid:{})".format(self.session_id)
 
+    def serialize(self, elm):
+        """Return the message for element `elm` as `send_message` takes it.
+
+        Compact sessions get UTF-8 bytes without indentation, others indented
+        text.
+        """
+        if self.compact:
+            return etree.tostring(elm, encoding="utf-8")
+        return etree.tounicode(elm, pretty_print=True)
+
     def send_message(self, msg):
+        """Send a message without the XML declaration.
+
+        :param msg: The message as UTF-8 bytes or as text.
+        """
         with self.slock:
             pkt_stream = self.pkt_stream
         if not pkt_stream:
             logger.info("Dropping message b/c no connection stream (%d): %s", len(msg), msg)
             return
         if self.debug:
-            logger.debug("Sending message (%d): %s", len(msg), msg)
-        pkt_stream.send_pdu(XML_HEADER + msg, self.new_framing)
+            logger.debug("Sending message (%d): %s", len(msg),
+                         msg.decode('utf-8') if isinstance(msg, bytes) else msg)
+        if isinstance(msg, bytes):
+            pkt_stream.send_pdu(XML_HEADER_BYTES + msg, self.new_framing)
+        else:
+            pkt_stream.send_pdu(XML_HEADER + msg, self.new_framing)
+
+    def send_message_stream(self, write):
+        """Send a message generated incrementally.
+
+        :param write: A callable passed an `etree.xmlfile` that writes the
+                      message to it, data is sent as it is written.
+        :return: The number of bytes sent.
+        """
+        with self.slock:
+            pkt_stream = self.pkt_stream
+        if not pkt_stream:
+            logger.info("Dropping streamed message b/c no connection stream")
+            return 0
+        writer = pkt_stream.pdu_writer(self.new_framing)
+        try:
+            with etree.xmlfile(writer, encoding="utf-8") as xf:
+                xf.write_declaration()
+                write(xf)
+            writer.close()
+        except Exception:
+            writer.abort()
+            # Part of the message may have been sent, the framing is lost.
+            logger.error("%s: Closing session after failing to send streamed message", str(self))
+            self.close()
+            raise
+        if self.debug:
+            logger.debug("Sent streamed message (%d)", writer.nbytes)
+        return writer.nbytes
 
-    def _receive_message(self):
-        # private method to receive a full message.
+    def _receive_message(self, parse=None):
+        # private method to receive a full message, returns the text or the
+        # root element if parsing, None if empty.
         with self.slock:
             if self.reader_thread and not self.reader_thread.keep_running:
                 return None
             pkt_stream = self.pkt_stream
-        return pkt_stream.receive_pdu(self.new_framing)
+        parser = etree.XMLParser() if parse else None
+        if parse is None and self.parse_messages:
+            parser = self._message_parser()
+        if parser is None:
+            return pkt_stream.receive_pdu(self.new_framing) or None
+        try:
+            return pkt_stream.receive_pdu(self.new_framing, parser)
+        except etree.XMLSyntaxError as error:
+            logger.warning("Closing session due to malformed message")
+            raise SessionError("Invalid XML received: {}".format(error))
 
     def send_hello(self, caplist, session_id=None):
         msg = ncutil.elm("hello", attrib={'xmlns': NSMAP['nc']})
@@ -316,8 +610,7 @@ class NetconfSession(object):
             logger.debug("%s: Sending HELLO", str(self))
         if session_id is not None:
             msg.append(ncutil.leaf_elm("session-id", str(session_id)))
-        msg = etree.tostring(msg)
-        self.send_message(msg.decode('utf-8'))
+        self.send_message(etree.tostring(msg, encoding="utf-8"))
 
     def close(self):
         if self.debug:
@@ -335,6 +628,9 @@ class NetconfSession(object):
                 if self.debug:
                     logger.debug("%s: Closing transport.", str(self))
 
+                if self.engine is not None:
+                    self.engine.detach(self)
+
                 pkt_stream = self.pkt_stream
                 self.pkt_stream = None
 
@@ -351,13 +647,12 @@ class NetconfSession(object):
             self.send_hello((NC_BASE_10, NC_BASE_11), self.session_id)
 
             # Get reply
-            reply = self._receive_message()
+            root = self._receive_message(True)
+            if root is None:
+                raise SessionError("Empty HELLO received")
             if self.debug:
                 logger.debug("Received HELLO")
 
-            # Parse reply
-            tree = etree.parse(io.BytesIO(reply.encode('utf-8')))
-            root = tree.getroot()
             caps = root.xpath("//nc:hello/nc:capabilities/nc:capability", namespaces=NSMAP)
 
             # Store capabilities
@@ -385,11 +680,14 @@ class NetconfSession(object):
 
             self.session_open = True
 
-            # Create reader thread.
-            self.reader_thread = threading.Thread(target=self._read_message_thread)
-            self.reader_thread.daemon = True
-            self.reader_thread.keep_running = True
-            self.reader_thread.start()
+            if self.engine is not None:
+                self.engine.attach(self)
+            else:
+                # Create reader thread.
+                self.reader_thread = threading.Thread(target=self._read_message_thread)
+                self.reader_thread.daemon = True
+                self.reader_thread.keep_running = True
+                self.reader_thread.start()
 
             if self.debug:
                 logger.debug("%s: Opened version %s session.", str(self), "1.1"
@@ -399,6 +697,14 @@ class NetconfSession(object):
             self.close()
             raise
 
+    def _message_parser(self):
+        """Return the feed parser of the next received message with `parse_messages`.
+
+        The object's feed() is passed the message data as it arrives and the
+        value returned by its close() is passed to `_reader_handle_message`.
+        """
+        return etree.XMLParser()
+
     def _reader_exits(self):
         """This function is called from the session reader thread as it exits. No more
         messages will be read from the session socket.
@@ -427,7 +733,7 @@ class NetconfSession(object):
                     assert pkt_stream is not None
 
                 msg = self._receive_message()
-                if msg:
+                if msg is not None:
                     self._reader_handle_message(msg)
                     closed = False
                 else:
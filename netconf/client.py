@@ -18,10 +18,17 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 from contextlib import contextmanager
+import concurrent.futures
+import functools
 import logging
-import io
+import re
 import threading
 import socket
+import weakref
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import sshutil.conn
 from lxml import etree
@@ -34,6 +41,10 @@ from netconf import util
 logger = logging.getLogger(__name__)
 
 
+def _put_done(done, index, future):
+    done.put((index, future))
+
+
 def _is_filter(select):
     return select.lstrip().startswith("<")
 
@@ -81,17 +92,178 @@ class Timeout(object):
             return self.end_time - ctime
 
 
+# How the reply of an RPC is delivered, see `NetconfClientSession.send_rpc_async`.
+REPLY_TREE = "tree"
+REPLY_ELEMENT = "element"
+REPLY_RAW = "raw"
+
+# The start of a message up to the end of its first start tag.
+_START_TAG_RE = re.compile(
+    br"""\s*(?:<\?.*?\?>\s*)?(?:<!--.*?-->\s*)*<([^\s/>]+)((?:\s+[^\s=/>]+\s*=\s*"""
+    br"""(?:"[^"]*"|'[^']*'))*)\s*/?>""", re.S)
+_MESSAGE_ID_RE = re.compile(br"""\smessage-id\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+# Give up looking for the message-id in a start tag larger than this.
+_MAX_START_TAG = 64 * 1024
+_RPC_REPLY_TAG = "{" + NSMAP['nc'] + "}rpc-reply"
+_RPC_ERROR_TAG = "{" + NSMAP['nc'] + "}rpc-error"
+# An <rpc-error> first child, matched right after the start tag.
+_FIRST_ERROR_RE = re.compile(br"""\s*(?:<!--.*?-->\s*)*<(?:[^\s/>:]+:)?rpc-error[\s/>]""", re.S)
+
+
+class RPCFuture(concurrent.futures.Future):
+    """The reply to an RPC sent with `NetconfClientSession.send_rpc_async`.
+
+    The result is what `NetconfClientSession.wait_reply` returns. An
+    rpc-error reply sets an `RPCError` exception, the session closing a
+    `SessionError`. Done callbacks are called from the session reader.
+
+    :param msg_id: The message-id of the RPC.
+    :param reply: How the reply is delivered, `REPLY_TREE`, `REPLY_ELEMENT`,
+                  `REPLY_RAW` or an event callback.
+    :param events: The iterparse events passed to an event callback.
+    """
+
+    def __init__(self, msg_id, reply=REPLY_TREE, events=("end", )):
+        super(RPCFuture, self).__init__()
+        self.msg_id = msg_id
+        self.reply = reply
+        self.events = events
+
+    def __repr__(self):
+        return "RPCFuture(msg-id:{}, done:{})".format(self.msg_id, self.done())
+
+
+class _ReplyReceiver(object):
+    """The feed parser of a received message of a client session.
+
+    Data is kept until the start tag of the <rpc-reply> is complete, the
+    `RPCFuture` of its message-id then decides how the rest is handled: fed to
+    a tree parser, kept as bytes, or fed to a pull parser whose events are
+    passed to a callback. Messages of no awaited RPC are parsed as trees.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.head = bytearray()
+        self.msg_id = None
+        self.future = None
+        self.target = None
+        self.root = None
+        self.raw = None
+        # The offset in `raw` of what follows the start tag.
+        self.body = 0
+        self.error = None
+        # The depth in an <rpc-error> whose events aren't passed to the callback.
+        self.depth = None
+        self.callback_error = None
+
+    def feed(self, data):
+        if self.target is None and self.raw is None:
+            self.head += data
+            match = _START_TAG_RE.match(self.head)
+            if match is None and len(self.head) < _MAX_START_TAG:
+                return
+            self._start(match)
+            data, self.head = bytes(self.head), None
+        if self.raw is not None:
+            self.raw += data
+            return
+        self.target.feed(data)
+        if self.future is not None and callable(self.future.reply):
+            self._events()
+
+    def _start(self, match):
+        # Choose how the message is handled from its start tag.
+        if match is not None and match.group(1).rpartition(b":")[2] == b"rpc-reply":
+            msg_id = _MESSAGE_ID_RE.search(match.group(2))
+            if msg_id is not None:
+                try:
+                    self.msg_id = int(msg_id.group(1) or msg_id.group(2))
+                except ValueError:
+                    pass
+        if self.msg_id is not None:
+            with self.session.out_lock:
+                self.future = self.session.rpc_out.get(self.msg_id)
+        reply = self.future.reply if self.future is not None else REPLY_TREE
+        if reply == REPLY_RAW:
+            self.raw = bytearray()
+            self.body = match.end() if match is not None else 0
+        elif reply in (REPLY_TREE, REPLY_ELEMENT):
+            self.target = etree.XMLParser()
+        else:
+            self.target = etree.XMLPullParser(
+                events=set(self.future.events) | set(["start", "end"]))
+
+    def _events(self):
+        # Pass the events to the callback, except those of an <rpc-error>.
+        events = self.future.events
+        for event, elm in self.target.read_events():
+            if self.depth is not None:
+                self.depth += 1 if event == "start" else -1 if event == "end" else 0
+                if self.depth == 0:
+                    self.depth = None
+                    if self.error is None:
+                        self.error = elm
+                continue
+            if event == "start" and elm.tag == _RPC_ERROR_TAG:
+                parent = elm.getparent()
+                if parent is not None and parent.getparent() is None:
+                    self.depth = 1
+                    continue
+            if event not in events or self.callback_error is not None:
+                continue
+            try:
+                self.future.reply(event, elm)
+            except Exception as error:
+                self.callback_error = error
+
+    def close(self):
+        if self.target is None and self.raw is None:
+            self._start(_START_TAG_RE.match(self.head))
+            head, self.head = bytes(self.head), None
+            if head:
+                self.feed(head)
+        if self.raw is not None:
+            self.raw = bytes(self.raw)
+            if _FIRST_ERROR_RE.match(self.raw, self.body) is not None:
+                # Don't deliver an error as data, it's only parsed then.
+                error = etree.fromstring(self.raw).find("nc:rpc-error", namespaces=NSMAP)
+                if error is not None:
+                    self.error = error
+            return self
+        root = self.target.close()
+        if self.future is not None and callable(self.future.reply):
+            self._events()
+        self.root = root
+        return self
+
+
 class NetconfClientSession(NetconfSession):
-    """Netconf Protocol"""
+    """Netconf Protocol
 
-    def __init__(self, stream, debug=False):
-        super(NetconfClientSession, self).__init__(stream, debug, None)
+    :param max_in_flight: The maximum number of RPCs awaiting a reply,
+                          `send_rpc_async` waits for a reply when it's reached.
+                          None for no limit.
+    """
+
+    # Replies are received by a `_ReplyReceiver` chosen by their RPC.
+    parse_messages = True
+
+    def __init__(self, stream, debug=False, engine=None, compact=False, max_in_flight=None):
+        super(NetconfClientSession, self).__init__(
+            stream, debug, None, engine=engine, compact=compact)
         self.message_id = 0
         self.closing = False
+        self.reader_exited = False
+        # The `RPCFuture` of the RPCs awaiting a reply by message-id.
         self.rpc_out = {}
-
-        # Condition to handle rpc_out queue
-        self.cv = threading.Condition()
+        # Every `RPCFuture` still referenced by message-id, replied or not.
+        self.rpc_futures = weakref.WeakValueDictionary()
+        self.out_lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.in_flight = None
+        if max_in_flight is not None:
+            self.in_flight = threading.BoundedSemaphore(max_in_flight)
 
         super(NetconfClientSession, self)._open_session(False)
 
@@ -108,7 +280,7 @@ class NetconfClientSession(NetconfSession):
         try:
             # So we need a lock here to check these members.
             send = False
-            with self.cv:
+            with self.out_lock:
                 if self.session_id is not None and self.is_active():
                     send = True
 
@@ -124,103 +296,171 @@ class NetconfClientSession(NetconfSession):
         if self.debug:
             logger.debug("%s: Closed: %s", str(self), str(reply))
 
-    def is_reply_ready(self, msg_id):
-        """Check whether reply is ready (or session closed)"""
-        with self.cv:
-            if not self.is_active():
-                raise SessionError("Session closed while checking for reply")
-            return self.rpc_out[msg_id] is not None
+    def _get_future(self, msg_id):
+        if isinstance(msg_id, RPCFuture):
+            return msg_id
+        with self.out_lock:
+            future = self.rpc_futures.get(msg_id)
+        if future is None:
+            raise KeyError("No RPC with message-id {}".format(msg_id))
+        return future
 
-    def wait_reply(self, msg_id, timeout=None):
-        """Wait for a reply to a given RPC message ID.
+    def is_reply_ready(self, msg_id):
+        """Check whether reply is ready (or session closed)
 
-        :param msg_id: the RPC message ID returned from one of the async method calls
-        :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
-        :rtype: (lxml.etree, lxml.Element, lxml.Element)
-        :raises: RPCError, SessionError
+        :param msg_id: The `RPCFuture` returned by one of the async method calls.
+        :raises: KeyError, SessionError
         """
-        assert msg_id in self.rpc_out
+        future = self._get_future(msg_id)
+        if not future.done() and not self.is_active():
+            raise SessionError("Session closed while checking for reply")
+        return future.done()
 
-        check_timeout = Timeout(timeout)
-
-        self.cv.acquire()
-        # XXX need to make sure the channel doesn't close
-        while self.rpc_out[msg_id] is None and self.is_active():
-            remaining = check_timeout.remaining()
-
-            self.cv.wait(remaining)
-            if self.rpc_out[msg_id] is not None:
-                break
-
-            if check_timeout.is_expired():
-                raise ReplyTimeoutError(
-                    "Timeout ({}s) while waiting for RPC reply to msg-id: {}".format(
-                        timeout, msg_id))
-
-        if not self.is_active():
-            self.cv.release()
-            raise SessionError("Session closed while waiting for reply")
+    def wait_reply(self, msg_id, timeout=None):
+        """Wait for a reply to a given RPC.
+
+        :param msg_id: The `RPCFuture` returned by one of the async method
+                       calls or the message-id of an RPC whose `RPCFuture`
+                       is still referenced.
+        :return: For `REPLY_TREE` (Message as an lxml tree, Parsed reply
+                 content, Message text), for `REPLY_ELEMENT` the parsed
+                 <rpc-reply> element, for `REPLY_RAW` the message UTF-8
+                 bytes, for an event callback the <rpc-reply> element with
+                 what the callback left of it.
+        :raises: KeyError, RPCError, SessionError, ReplyTimeoutError
+        """
+        future = self._get_future(msg_id)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise ReplyTimeoutError("Timeout ({}s) while waiting for RPC reply to msg-id: {}".format(
+                timeout, future.msg_id))
 
-        tree, reply, msg = self.rpc_out[msg_id]
-        del self.rpc_out[msg_id]
-        self.cv.release()
+    def send_rpc_async(self, rpc, noreply=False, reply=REPLY_TREE, events=("end", )):
+        """Send a generic RPC to the server without waiting for the reply.
 
-        error = reply.xpath("nc:rpc-error", namespaces=NSMAP)
-        if error:
-            raise RPCError(msg, tree, error[0])
+        If `max_in_flight` RPCs are awaiting a reply this waits for one of them.
 
-        # data = reply.xpath("nc:data", namespaces=self.nsmap)
-        # ok = reply.xpath("nc:ok", namespaces=self.nsmap)
-        return tree, reply, msg
-
-    def send_rpc_async(self, rpc, noreply=False):
-        """Send a generic RPC to the server and await the reply.
+        The reply is parsed as it's received, by default into a tree. With
+        `REPLY_ELEMENT` only the parsed element is returned, the message text
+        isn't serialized from it. With `REPLY_RAW` it's kept as the received
+        bytes without parsing (e.g., to write it to a file), only replies
+        holding "rpc-error" are parsed. With a callable, it's called from the
+        session reader as callback(event, element) for the `events` of an
+        `etree.iterparse`, it may clear the elements it's done with so the
+        reply is never held whole.
 
         :param rpc: The XML of the netconf RPC, not including the <rpc> tag.
         :type rpc: str or `lxml.Element`
         :param noreply: True if no reply is required.
         :type noreply: Boolean
+        :param reply: `REPLY_TREE`, `REPLY_ELEMENT`, `REPLY_RAW` or an event callback.
+        :param events: The iterparse events passed to the event callback.
 
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :return: The `RPCFuture` of the reply (None if `noreply`), it can
+                 also be passed to wait_reply for the results.
+        :raises: SessionError
         """
         # Not sure it makes sense to go back to a string here, but OK.
         # Need to be a bit careful about namespaces the default needs to be nc:
-        if hasattr(rpc, "nsmap"):
+        if self.compact:
+            if hasattr(rpc, "nsmap"):
+                rpc = etree.tostring(rpc, encoding="utf-8")
+            elif not isinstance(rpc, bytes):
+                rpc = rpc.encode('utf-8')
+        elif hasattr(rpc, "nsmap"):
             rpc = etree.tounicode(rpc)
 
+        if not noreply and self.in_flight is not None:
+            self.in_flight.acquire()
+
         # Get the next message id
-        with self.cv:
+        future = None
+        with self.out_lock:
             assert self.session_id is not None
             msg_id = self.message_id
             self.message_id += 1
+            if not noreply:
+                if self.reader_exited:
+                    if self.in_flight is not None:
+                        self.in_flight.release()
+                    raise SessionError("Session closed")
+                # Mark us as expecting a reply
+                future = RPCFuture(msg_id, reply, events)
+                self.rpc_out[msg_id] = future
+                self.rpc_futures[msg_id] = future
+                if self.in_flight is not None:
+                    future.add_done_callback(lambda unused: self.in_flight.release())
 
         if self.debug:
             logger.debug("%s: Sending RPC message-id: %s", str(self), str(msg_id))
 
-        def sendit():
-            self.send_message("""<rpc message-id="{}"
+        try:
+            if self.compact:
+                self.send_message('<rpc message-id="{}" xmlns="{}">'.format(
+                    msg_id, NSMAP['nc']).encode('utf-8') + rpc + b"</rpc>")
+            else:
+                self.send_message("""<rpc message-id="{}"
                 xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">{}</rpc>""".format(msg_id, rpc))
+        except Exception as error:
+            if future is not None:
+                with self.out_lock:
+                    self.rpc_out.pop(msg_id, None)
+                future.set_exception(error)
+            raise
+
+        return future
+
+    def send_many(self, rpcs, timeout=None):
+        """Send RPCs pipelined on the session and yield them as their replies arrive.
+
+        RPCs are sent without waiting for replies, up to `max_in_flight` at a
+        time if the session has a limit.
+
+        :param rpcs: An iterable of RPCs as taken by `send_rpc_async`.
+        :param timeout: The maximum seconds to wait for the next reply.
+        :return: An iterator of (index of the RPC in `rpcs`, its done
+                 `RPCFuture`) in the order the replies arrive.
+        :raises: ReplyTimeoutError, SessionError
+        """
+        done = queue.Queue()
+        outstanding = 0
+        for index, rpc in enumerate(rpcs):
+            # Hand out completed replies rather than wait to send.
+            while outstanding and (not done.empty() or not self._may_send()):
+                yield self._next_done(done, timeout)
+                outstanding -= 1
+            future = self.send_rpc_async(rpc)
+            future.add_done_callback(functools.partial(_put_done, done, index))
+            outstanding += 1
+        while outstanding:
+            yield self._next_done(done, timeout)
+            outstanding -= 1
+
+    def _may_send(self):
+        # True if another RPC can be sent without waiting for a reply.
+        if self.max_in_flight is None:
+            return True
+        with self.out_lock:
+            return len(self.rpc_out) < self.max_in_flight
+
+    def _next_done(self, done, timeout):
+        try:
+            return done.get(timeout=timeout)
+        except queue.Empty:
+            raise ReplyTimeoutError("Timeout ({}s) while waiting for RPC replies".format(timeout))
 
-        if noreply:
-            sendit()
-            return None
-
-        with self.cv:
-            sendit()
-            # Mark us as expecting a reply
-            self.rpc_out[msg_id] = None
-
-        return msg_id
-
-    def send_rpc(self, rpc, timeout=None):
+    def send_rpc(self, rpc, timeout=None, reply=REPLY_TREE, events=("end", )):
         """Send a generic RPC to the server and await the reply.
 
         :param rpc (string): The XML of the netconf RPC, not including the <rpc> tag.
-        :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
-        :rtype: (lxml.etree, lxml.Element, lxml.Element)
+        :param reply: How the reply is delivered, see `send_rpc_async`.
+        :return: What `wait_reply` returns, by default (Message as an lxml
+                 tree, Parsed reply content, Message text).
+        :rtype: (lxml.etree, lxml.Element, str)
         :raises: RPCError, SessionError
         """
-        msg_id = self.send_rpc_async(rpc)
+        msg_id = self.send_rpc_async(rpc, reply=reply, events=events)
         return self.wait_reply(msg_id, timeout)
 
     def edit_config_async(self, target, mode, newconf):
@@ -231,7 +471,7 @@ class NetconfClientSession(NetconfSession):
         :param target: the target of the config, defaults to "running".
         :param method: "merge", "replace" or "none"
         :param newconf: The new configuration.
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :return: The `RPCFuture` of the reply, it can also be passed to wait_reply for the results.
         :raises: SessionError
         """
         if hasattr(target, "nsmap"):
@@ -267,14 +507,15 @@ class NetconfClientSession(NetconfSession):
         _, reply, _ = self.wait_reply(msg_id, timeout)
         return reply
 
-    def get_config_async(self, source, select):
+    def get_config_async(self, source, select, reply=REPLY_TREE, events=("end", )):
         """Get config asynchronously for a given source from the server. If `select` is
         specified it is either an XPATH expression or XML subtree filter for
         selecting a subsection of the config.
 
         :param source: the source of the config, defaults to "running".
         :param select: An XML subtree filter or XPATH expression to select a subsection of config.
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :param reply: How the reply is delivered, see `send_rpc_async`.
+        :return: The `RPCFuture` of the reply, it can also be passed to wait_reply for the results.
         :raises: SessionError
         """
         getelm = util.elm("get-config")
@@ -282,9 +523,10 @@ class NetconfClientSession(NetconfSession):
             source = util.elm(source)
         util.subelm(util.subelm(getelm, "source"), source)
         _get_selection(getelm, select)
-        return self.send_rpc_async(getelm)
+        return self.send_rpc_async(getelm, reply=reply, events=events)
 
-    def get_config(self, source="running", select=None, timeout=None):
+    def get_config(self, source="running", select=None, timeout=None, reply=REPLY_TREE,
+                   events=("end", )):
         """Get config for a given source from the server. If `select` is specified it
         is either an XPATH expression or XML subtree filter for selecting a
         subsection of the config. If `timeout` is not `None` it specifies how
@@ -294,30 +536,35 @@ class NetconfClientSession(NetconfSession):
         :param select: An XML subtree filter or XPATH expression to select a subsection of config.
         :param timeout: A value in fractional seconds to wait for the operation to complete or
                         `None` for no timeout.
-        :return: The Parsed XML config (i.e., "<config>...</config>".)
+        :param reply: How the reply is delivered, see `send_rpc_async`.
+        :return: The Parsed XML config (i.e., "<config>...</config>".), what
+                 `wait_reply` returns if `reply` isn't `REPLY_TREE`.
         :rtype: lxml.Element
         :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.get_config_async(source, select)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
-        return reply.find("nc:data", namespaces=NSMAP)
+        # The message text of the default reply isn't returned.
+        msg_id = self.get_config_async(source, select, REPLY_ELEMENT if reply == REPLY_TREE else reply, events)
+        if reply != REPLY_TREE:
+            return self.wait_reply(msg_id, timeout)
+        return self.wait_reply(msg_id, timeout).find("nc:data", namespaces=NSMAP)
 
-    def get_async(self, select):
+    def get_async(self, select, reply=REPLY_TREE, events=("end", )):
         """Get operational state asynchronously from the server. If `select` is
         specified it is either an XPATH expression or XML subtree filter for
         selecting a subsection of the state. If `timeout` is not `None` it
         specifies how long to wait for the get operation to complete.
 
         :param select: A XML subtree filter or XPATH expression to select a subsection of state.
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :param reply: How the reply is delivered, see `send_rpc_async`.
+        :return: The `RPCFuture` of the reply, it can also be passed to wait_reply for the results.
         :raises: SessionError
         """
 
         getelm = util.elm("get")
         _get_selection(getelm, select)
-        return self.send_rpc_async(getelm)
+        return self.send_rpc_async(getelm, reply=reply, events=events)
 
-    def get(self, select=None, timeout=None):
+    def get(self, select=None, timeout=None, reply=REPLY_TREE, events=("end", )):
         """Get operational state from the server. If `select` is specified it is either
         an XPATH expression or XML subtree filter for selecting a subsection of
         the state. If `timeout` is not `None` it specifies how long to wait for
@@ -326,19 +573,23 @@ class NetconfClientSession(NetconfSession):
         :param select: A XML subtree filter or XPATH expression to select a subsection of state.
         :param timeout: A value in fractional seconds to wait for the operation to complete or
                        `None` for no timeout.
-        :return: The Parsed XML state (i.e., "<data>...</data>".)
+        :param reply: How the reply is delivered, see `send_rpc_async`.
+        :return: The Parsed XML state (i.e., "<data>...</data>".), what
+                 `wait_reply` returns if `reply` isn't `REPLY_TREE`.
         :rtype: lxml.Element
         :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.get_async(select)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
-        return reply.find("nc:data", namespaces=NSMAP)
+        # The message text of the default reply isn't returned.
+        msg_id = self.get_async(select, REPLY_ELEMENT if reply == REPLY_TREE else reply, events)
+        if reply != REPLY_TREE:
+            return self.wait_reply(msg_id, timeout)
+        return self.wait_reply(msg_id, timeout).find("nc:data", namespaces=NSMAP)
 
     def lock_async(self, target):
         """Lock target datastore asynchronously.
 
         :param target: A string specifying the config datastore to lock.
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :return: The `RPCFuture` of the reply, it can also be passed to wait_reply for the results.
         :raises: SessionError
         """
         lockelm = util.elm("lock")
@@ -364,7 +615,7 @@ class NetconfClientSession(NetconfSession):
         """Unlock target datastore asynchronously.
 
         :param target: A string specifying the config datastore to unlock.
-        :return: The RPC message id which can be passed to wait_reply for the results.
+        :return: The `RPCFuture` of the reply, it can also be passed to wait_reply for the results.
         :raises: SessionError
         """
         unlockelm = util.elm("unlock")
@@ -395,58 +646,63 @@ class NetconfClientSession(NetconfSession):
         messages will be read from the session socket.
         """
         if self.debug:
-            logger.debug("%s: Reader thread exited notifying all.", str(self))
-        with self.cv:
-            self.cv.notify_all()
+            logger.debug("%s: Reader thread exited failing pending replies.", str(self))
+        with self.out_lock:
+            self.reader_exited = True
+            pending = list(self.rpc_out.values())
+            self.rpc_out.clear()
+        for future in pending:
+            future.set_exception(SessionError("Session closed while waiting for reply"))
+
+    def _message_parser(self):
+        return _ReplyReceiver(self)
 
     def _reader_handle_message(self, msg):
         """This function is called from the session reader thread to process a received
-        framed netconf message.
+        framed netconf message, the `_ReplyReceiver` that received it.
         """
-        try:
-            tree = etree.parse(io.BytesIO(msg.encode('utf-8')))
-            if not tree:
-                raise SessionError(msg, "Invalid XML from server.")
-        except etree.XMLSyntaxError:
-            raise SessionError(msg, "Invalid XML from server.")
-
-        replies = tree.xpath("/nc:rpc-reply", namespaces=NSMAP)
-        if not replies:
-            raise SessionError(msg, "No rpc-reply found")
+        root = msg.root
+        if root is not None:
+            if root.tag != _RPC_REPLY_TAG:
+                raise SessionError(etree.tounicode(root), "No rpc-reply found")
+            if msg.error is None:
+                msg.error = root.find("nc:rpc-error", namespaces=NSMAP)
+        msg_id = msg.msg_id
+        if msg_id is None:
+            # # Cisco is returning errors without message-id attribute which
+            # # is non-rfc-conforming it is doing this for any malformed XML
+            # # not simply missing message-id attribute.
+            # error = reply.xpath("nc:rpc-error", namespaces=self.nsmap)
+            # if error:
+            #     raise RPCError(received, tree, error[0])
+            raise SessionError(etree.tounicode(root), "No valid message-id attribute found")
+
+        # Resolve the waiting future
+        with self.out_lock:
+            future = self.rpc_out.pop(msg_id, None)
+        if future is None:
+            if self.debug:
+                logger.debug("Ignoring unwanted reply for message-id %s", str(msg_id))
+            return
 
-        for reply in replies:
-            try:
-                msg_id = int(reply.get('message-id'))
-            except (TypeError, ValueError):
-                # # Cisco is returning errors without message-id attribute which
-                # # is non-rfc-conforming it is doing this for any malformed XML
-                # # not simply missing message-id attribute.
-                # error = reply.xpath("nc:rpc-error", namespaces=self.nsmap)
-                # if error:
-                #     raise RPCError(received, tree, error[0])
-                raise SessionError(msg, "No valid message-id attribute found")
-
-            # Queue the message
-            with self.cv:
-                try:
-                    if msg_id not in self.rpc_out:
-                        if self.debug:
-                            logger.debug("Ignoring unwanted reply for message-id %s", str(msg_id))
-                        return
-                    elif self.rpc_out[msg_id] is not None:
-                        logger.warning(
-                            "Received multiple replies for message-id %s:"
-                            " before: %s now: %s", str(msg_id), str(self.rpc_out[msg_id]), str(msg))
-
-                    if self.debug:
-                        logger.debug("%s: Received rpc-reply message-id: %s", str(self),
-                                     str(msg_id))
-                    self.rpc_out[msg_id] = tree, reply, msg
-                except Exception as error:
-                    logger.debug("%s: Unexpected exception: %s", str(self), str(error))
-                    raise
-                finally:
-                    self.cv.notify_all()
+        if self.debug:
+            logger.debug("%s: Received rpc-reply message-id: %s", str(self), str(msg_id))
+        if msg.callback_error is not None:
+            future.set_exception(msg.callback_error)
+        elif msg.error is not None:
+            if root is None:
+                text = msg.raw.decode('utf-8')
+                tree = msg.error.getroottree()
+            else:
+                text = etree.tounicode(root)
+                tree = root.getroottree()
+            future.set_exception(RPCError(text, tree, msg.error))
+        elif future.reply == REPLY_RAW:
+            future.set_result(msg.raw)
+        elif future.reply == REPLY_TREE:
+            future.set_result((root.getroottree(), root, etree.tounicode(root)))
+        else:
+            future.set_result(root)
 
 
 class NetconfSSHSession(NetconfClientSession):
@@ -457,7 +713,10 @@ class NetconfSSHSession(NetconfClientSession):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 engine=None,
+                 compact=False,
+                 max_in_flight=None):
         """A netconf SSH client session.
 
         If `username` is not specified then it will be obtained with
@@ -473,13 +732,16 @@ class NetconfSSHSession(NetconfClientSession):
         :param debug: Enable debug logging
         :param cache: An SSH cache (`sshutil.cache`) to use for caching connections.
         :param proxycmd: A proxy command string for connecting with
+        :param engine: An `aio.SessionEngine` to read the session with instead of a thread.
+        :param compact: True to send requests as compact UTF-8 instead of indented text.
+        :param max_in_flight: The maximum number of RPCs awaiting a reply, None for no limit.
         """
         if username is None:
             import getpass
             username = getpass.getuser()
         stream = sshutil.conn.SSHClientSession(
             host, port, "netconf", username, password, debug, cache=cache, proxycmd=proxycmd)
-        super(NetconfSSHSession, self).__init__(stream, debug)
+        super(NetconfSSHSession, self).__init__(stream, debug, engine, compact, max_in_flight)
 
     def __enter__(self):
         return self
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""The server's RPC dispatch registry.
+
+An `RPCRegistry` is built once from the server methods object when the server
+starts. It maps the qualified tag of an RPC (e.g.,
+"{urn:ietf:params:xml:ns:netconf:base:1.0}get-config") to an `RPCHandler`
+holding the method to call and the validator returning the method parameters.
+
+The rpc_* methods of the methods object are found by name. A method may be
+decorated with `rpc` to give the namespace and parameter schema of an RPC
+defined in another YANG module::
+
+    class Methods(NetconfMethods):
+        @dispatch.rpc(namespace="urn:example:reboot",
+                      params=[dispatch.Param("ex:delay", required=True)])
+        def rpc_reboot(self, session, rpc, delay):
+            ...
+
+Methods without a namespace are looked up by the local name of any RPC tag,
+their parameters are all the children of the RPC element.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+from lxml import etree
+
+import netconf.error as ncerror
+from netconf import NSMAP
+from netconf import util
+
+logger = logging.getLogger(__name__)
+
+
+class Param(object):
+    """A parameter of an RPC in a parameter schema.
+
+    :param tag: The tag in "prefix:name" form or Clark notation.
+    :param required: True if the parameter must be present.
+    """
+
+    def __init__(self, tag, required=False):
+        self.tag = util.qname(tag).text
+        self.required = required
+
+    def __repr__(self):
+        return "Param({}, required={})".format(self.tag, self.required)
+
+
+def validate_schema(schema, rpc, rpc_method):
+    """Return the parameters of an RPC in schema order, None for those absent.
+
+    :param schema: A list of `Param`.
+    :param rpc: The rpc element.
+    :param rpc_method: The child of the rpc element naming the method.
+    :raises: `ncerror.RPCServerError` if the parameters don't match the schema,
+             unknown-element for a parameter not in it and bad-element for
+             one given twice.
+    """
+    params = rpc_method.getchildren()
+    found = {}
+    for elm in params:
+        tag = etree.QName(elm).text
+        if tag in found:
+            raise ncerror.BadElementProtoError(rpc, elm)
+        found[tag] = elm
+    values = []
+    for param in schema:
+        value = found.pop(param.tag, None)
+        if value is None and param.required:
+            raise ncerror.MissingElementProtoError(rpc, etree.QName(param.tag))
+        values.append(value)
+    for unknown_elm in params:
+        if etree.QName(unknown_elm).text in found:
+            raise ncerror.UnknownElementProtoError(rpc, unknown_elm)
+    return values
+
+
+def validate_children(unused_schema, unused_rpc, rpc_method):
+    """Return all the children of the method element as the parameters."""
+    return rpc_method.getchildren()
+
+
+def validate_target(schema, rpc, rpc_method):
+    """Validate a <lock> or <unlock>, the parameter is the target datastore name."""
+    target_param, = validate_schema(schema, rpc, rpc_method)
+    elms = target_param.getchildren()
+    if len(elms) != 1:
+        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
+    lock_target = elms[0].tag.replace("{" + NSMAP['nc'] + "}", "")
+    if lock_target not in ["running", "candidate"]:
+        raise ncerror.BadElementProtoError(rpc, util.qname("nc:target"))
+    return [lock_target]
+
+
+def rpc_ok(unused_session, unused_rpc, *unused_params):
+    """The method of the RPCs the server handles when the methods object doesn't."""
+    return etree.Element("ok")
+
+
+def rpc_not_implemented(session, rpc, *unused_params):
+    if session.debug:
+        logger.debug("%s: Not Impl msg-id: %s", str(session), rpc.get('message-id'))
+    raise ncerror.OperationNotSupportedProtoError(rpc)
+
+
+def rpc(name=None, namespace=None, params=None, validate=None, readonly=False):
+    """Decorate an rpc_* method with how its RPC is dispatched.
+
+    :param name: The RPC name, by default the method name without "rpc_" and
+                 with "-" in place of "_".
+    :param namespace: The namespace of the RPC, None to match any.
+    :param params: A list of `Param`, the method is then passed the parameters
+                   in this order with None for those absent.
+    :param validate: A function (schema, rpc, rpc_method) returning the method
+                     parameters, `validate_schema` if `params` is given.
+    :param readonly: True if the RPC doesn't change any datastore and may run
+                     concurrently with other read-only RPCs of the session.
+    """
+
+    def decorate(method):
+        method.netconf_rpc = {
+            "name": name,
+            "namespace": namespace,
+            "params": params,
+            "validate": validate,
+            "readonly": readonly,
+        }
+        return method
+
+    return decorate
+
+
+class RPCHandler(object):
+    """How one RPC is validated and which method it calls.
+
+    :param name: The local name of the RPC.
+    :param namespace: The RPC namespace or None to match any.
+    :param method: Called as method(session, rpc, *params).
+    :param params: The parameter schema, a list of `Param` or None.
+    :param validate: Called as validate(params, rpc, rpc_method) to return the parameters.
+    :param readonly: True if the RPC may run concurrently with other read-only RPCs.
+    """
+
+    def __init__(self, name, namespace, method, params=None, validate=None, readonly=False):
+        self.name = name
+        self.namespace = namespace
+        self.tag = "{" + namespace + "}" + name if namespace else name
+        self.method = method
+        self.params = params
+        if validate is None:
+            validate = validate_schema if params is not None else validate_children
+        self.validate = validate
+        self.readonly = readonly
+
+    def __repr__(self):
+        return "RPCHandler({})".format(self.tag)
+
+    def get_params(self, rpc, rpc_method):
+        """Return the method parameters of a received RPC.
+
+        :raises: `ncerror.RPCServerError` if they are invalid.
+        """
+        return self.validate(self.params, rpc, rpc_method)
+
+
+# The RPCs whose parameters are validated by the server, as the keyword
+# arguments of `RPCHandler`.
+BUILTIN_RPCS = {
+    "get": dict(params=[Param("nc:filter")], readonly=True),
+    "get-config": dict(params=[Param("nc:source", required=True),
+                               Param("nc:filter")], readonly=True),
+    "lock": dict(params=[Param("nc:target", required=True)], validate=validate_target),
+    "unlock": dict(params=[Param("nc:target", required=True)], validate=validate_target),
+    # :candidate, the methods object rejects the :confirmed-commit parameters
+    # it doesn't support.
+    "commit": dict(params=[
+        Param("nc:confirmed"),
+        Param("nc:confirm-timeout"),
+        Param("nc:persist"),
+        Param("nc:persist-id")
+    ]),
+    "discard-changes": dict(params=[]),
+    "close-session": dict(),
+    "kill-session": dict(),
+}
+
+# Handled by the server and never passed to the methods object.
+# XXX should we also call the user method if it exists?
+SESSION_RPCS = set(["close-session", "kill-session"])
+
+
+class RPCRegistry(object):
+    """The handlers of the RPCs a server implements.
+
+    :param methods: The object implementing the rpc_* methods.
+    :param handled: Names of the built-in RPCs answered with <ok/> when
+                    `methods` doesn't implement them.
+    """
+
+    def __init__(self, methods, handled=()):
+        self.by_tag = {}
+        self.by_name = {}
+        self.not_implemented = RPCHandler("not-implemented", None, rpc_not_implemented)
+
+        for name, kwargs in BUILTIN_RPCS.items():
+            method = None
+            if name not in SESSION_RPCS:
+                method = getattr(methods, "rpc_" + name.replace('-', '_'), None)
+            if method is None:
+                method = rpc_ok if name in handled or name in SESSION_RPCS else rpc_not_implemented
+            self.add(RPCHandler(name, NSMAP['nc'], method, **kwargs))
+
+        for attr in dir(methods):
+            if not attr.startswith("rpc_"):
+                continue
+            method = getattr(methods, attr)
+            if not callable(method):
+                continue
+            options = dict(getattr(method, "netconf_rpc", None) or {})
+            name = options.pop("name", None) or attr[4:].replace('_', '-')
+            namespace = options.pop("namespace", None)
+            if name in BUILTIN_RPCS and namespace in (None, NSMAP['nc']):
+                continue
+            self.add(RPCHandler(name, namespace, method, **options))
+
+    def add(self, handler):
+        """Register a handler, replacing any with the same name and namespace."""
+        if handler.namespace:
+            self.by_tag[handler.tag] = handler
+        else:
+            self.by_name[handler.name] = handler
+
+    def lookup(self, tag):
+        """Return the `RPCHandler` for the tag of an RPC method element.
+
+        Unknown RPCs get a handler replying with operation-not-supported.
+        """
+        handler = self.by_tag.get(tag)
+        if handler is None:
+            handler = self.by_name.get(tag.rpartition("}")[-1], self.not_implemented)
+        return handler
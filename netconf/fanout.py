@@ -0,0 +1,164 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Run a netconf client utility operation on many targets at once.
+
+Used by ``python -m netconf --targets FILE``. All targets are driven by one
+event loop with `aioclient.AsyncNetconfSession`, at most --concurrency at a
+time, their SSH connections made by as many threads. A JSON object is
+written per line for each target as it completes, with its result or error
+and its timing in seconds. This module requires Python 3.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import asyncio
+import concurrent.futures
+import json
+import sys
+from lxml import etree
+from monotonic import monotonic
+
+from netconf import aioclient
+
+
+def parse_target(line, username, port):
+    """Parse a "[user@]host[:port]" target, IPv6 addresses are given as "[addr]:port".
+
+    >>> parse_target("admin@router1:2022", "nobody", 830)
+    ('router1', 2022, 'admin')
+    >>> parse_target("[2001:db8::1]", "admin", 830)
+    ('2001:db8::1', 830, 'admin')
+    """
+    if "@" in line:
+        username, line = line.rsplit("@", 1)
+    if line.startswith("["):
+        host, _, rest = line[1:].partition("]")
+        if rest.startswith(":"):
+            port = int(rest[1:])
+    elif line.count(":") == 1:
+        host, port = line.split(":")
+        port = int(port)
+    else:
+        host = line
+    return host, port, username
+
+
+def read_targets(targets, username, port):
+    """Return the targets listed one per line in a file ("-" for stdin), "#" starts a comment."""
+    infile = sys.stdin if targets == "-" else open(targets)
+    result = []
+    for line in infile:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            result.append(parse_target(line, username, port))
+    return result
+
+
+def _format_result(args, session, result):
+    if args.hello:
+        return sorted(session.capabilities)
+    if result is None:
+        return None
+    return etree.tounicode(result)
+
+
+async def _fanout_target(args, xml, target, executor):
+    # Run the operation on one target, return its result line.
+    host, port, username = target
+    line = {"host": host, "port": port, "username": username}
+    start = monotonic()
+    session = None
+    try:
+        session = await aioclient.connect_ssh(
+            host,
+            port,
+            username,
+            args.password,
+            debug=args.debug,
+            timeout=args.timeout,
+            executor=executor)
+        line["connect-time"] = monotonic() - start
+        if args.hello:
+            result = None
+        elif args.get is not None:
+            result = await session.get(args.get or xml, args.timeout)
+        elif args.get_config is not None:
+            result = await session.get_config(args.source, args.get_config or xml, args.timeout)
+        elif args.edit_config is not None:
+            result = await session.edit_config(args.source, args.edit_config, xml, args.timeout)
+        else:
+            result = (await session.send_rpc(xml, args.timeout))[1]
+        line["ok"] = True
+        line["session-id"] = session.session_id
+        line["result"] = _format_result(args, session, result)
+    except Exception as error:
+        line["ok"] = False
+        line["error"] = "{}: {}".format(type(error).__name__, str(error))
+    finally:
+        if session is not None:
+            await session.close()
+    line["time"] = monotonic() - start
+    return line
+
+
+async def _fanout(args, xml, targets, executor):
+    limit = asyncio.Semaphore(args.concurrency)
+    failed = 0
+
+    async def run(target):
+        async with limit:
+            try:
+                return await asyncio.wait_for(
+                    _fanout_target(args, xml, target, executor), args.host_timeout)
+            except asyncio.TimeoutError:
+                host, port, username = target
+                return {
+                    "host": host,
+                    "port": port,
+                    "username": username,
+                    "ok": False,
+                    "error": "Timeout ({}s) for target".format(args.host_timeout),
+                    "time": args.host_timeout,
+                }
+
+    for done in asyncio.as_completed([run(x) for x in targets]):
+        line = await done
+        failed += not line["ok"]
+        sys.stdout.write(json.dumps(line) + "\n")
+        sys.stdout.flush()
+    return failed
+
+
+def main(args):
+    """Run the operation on all targets, return the number that failed."""
+    targets = read_targets(args.targets, args.username, args.port)
+    xml = None
+    if args.infile:
+        xml = open(args.infile).read()
+    elif args.hello or args.get is not None or args.get_config is not None:
+        pass
+    elif args.targets == "-":
+        print("Need --infile for the RPC when targets are read from stdin", file=sys.stderr)
+        sys.exit(1)
+    else:
+        xml = sys.stdin.read()
+    if not targets:
+        print("No targets.", file=sys.stderr)
+        return 0
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(args.concurrency)
+    try:
+        return loop.run_until_complete(_fanout(args, xml, targets, executor))
+    finally:
+        loop.close()
+        executor.shutdown()
@@ -17,20 +17,22 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
-import io
+import functools
 import logging
 import os
 import sys
 import threading
+import types
 import paramiko as ssh
 from lxml import etree
 import sshutil.server
 
 from netconf import base
+from netconf import dispatch
 import netconf.error as ncerror
 from netconf import NSMAP
 from netconf import qmap
-from netconf import util
+from netconf import workers
 
 if sys.platform == 'win32' and sys.version_info < (3, 5):
     import backports.socketpair  # pylint: disable=E0401,W0611
@@ -206,12 +208,38 @@ class SSHUserPassController(ssh.ServerInterface):
         return name == "netconf"
 
 
+class StreamingReply(object):
+    """The contents of an rpc-reply written while the reply is being sent.
+
+    The rpc_* methods may return this instead of an element to send large
+    replies in chunks as they are generated, a generator yielding elements
+    may be returned as well.
+
+    :param write: A callable passed an `etree.xmlfile` positioned inside the
+                  <rpc-reply> element, it writes the reply contents.
+    """
+
+    def __init__(self, write):
+        self.write = write
+
+    @classmethod
+    def from_iterable(cls, elements):
+        """Return a `StreamingReply` writing the elements yielded by `elements`."""
+
+        def write(xf):
+            for elm in elements:
+                xf.write(elm)
+
+        return cls(write)
+
+
 class NetconfServerSession(base.NetconfSession):
     """Netconf Server-side session with a client.
 
     This object will be passed to a the server RPC methods.
     """
     handled_rpc_methods = set(["close-session", "lock", "kill-session", "unlock"])
+    parse_messages = True
 
     def __init__(self, channel, server, unused_extra_args, debug):
         self.server = server
@@ -221,7 +249,11 @@ class NetconfServerSession(base.NetconfSession):
             logger.debug("NetconfServerSession: Creating session-id %s", str(sid))
 
         self.methods = server.server_methods
-        super(NetconfServerSession, self).__init__(channel, debug, sid)
+        self.rpc_queue = None
+        if server.pool is not None:
+            self.rpc_queue = workers.SessionQueue(server.pool, self._rpc_queue_error)
+        super(NetconfServerSession, self).__init__(
+            channel, debug, sid, engine=server.engine, compact=server.compact)
         super(NetconfServerSession, self)._open_session(True)
 
         if self.debug:
@@ -270,25 +302,78 @@ class NetconfServerSession(base.NetconfSession):
         externally the return value from the rpc_* methods will be returned
         using this method.
         """
+        if isinstance(rpc_reply, types.GeneratorType):
+            rpc_reply = StreamingReply.from_iterable(rpc_reply)
+        if isinstance(rpc_reply, StreamingReply):
+            self._stream_rpc_reply(rpc_reply, origmsg)
+            return
+
         reply = etree.Element(qmap('nc') + "rpc-reply", attrib=origmsg.attrib, nsmap=origmsg.nsmap)
         try:
             rpc_reply.getchildren  # pylint: disable=W0104
             reply.append(rpc_reply)
         except AttributeError:
             reply.extend(rpc_reply)
-        ucode = etree.tounicode(reply, pretty_print=True)
         if self.debug:
-            logger.debug("%s: Sending RPC-Reply: %s", str(self), str(ucode))
-        self.send_message(ucode)
+            logger.debug("%s: Sending RPC-Reply: %s", str(self),
+                         etree.tounicode(reply, pretty_print=True))
+        self.send_message(self.serialize(reply))
 
-    def _rpc_not_implemented(self, unused_session, rpc, *unused_params):
+    def _stream_rpc_reply(self, rpc_reply, origmsg):
+        """Send a `StreamingReply` to the client in chunks as it is written."""
+
+        def write(xf):
+            with xf.element(
+                    qmap('nc') + "rpc-reply", attrib=dict(origmsg.attrib), nsmap=origmsg.nsmap):
+                try:
+                    rpc_reply.write(xf)
+                except Exception as ex:
+                    # The reply has been partially sent, finish it with the error.
+                    logger.error("%s: Error while streaming RPC-Reply: %s", str(self), str(ex))
+                    if not isinstance(ex, ncerror.RPCServerError):
+                        ex = ncerror.RPCSvrException(origmsg, ex)
+                    for rpcerr in ex.reply:
+                        xf.write(rpcerr)
+
+        nbytes = self.send_message_stream(write)
         if self.debug:
-            msg_id = rpc.get('message-id')
-            logger.debug("%s: Not Impl msg-id: %s", str(self), msg_id)
-        raise ncerror.OperationNotSupportedProtoError(rpc)
+            logger.debug("%s: Sent streamed RPC-Reply (%d)", str(self), nbytes)
 
     def _send_rpc_reply_error(self, error):
-        self.send_message(error.get_reply_msg())
+        if self.compact:
+            self.send_message(etree.tostring(error.reply, encoding="utf-8"))
+        else:
+            self.send_message(error.get_reply_msg())
+
+    def _send_rpc_error(self, rpc, error):
+        """Send the rpc-error reply for an exception raised handling rpc."""
+        try:
+            raise error
+        except ncerror.MalformedMessageRPCError as msgerr:
+            if self.new_framing:
+                if self.debug:
+                    logger.debug("%s: MalformedMessageRPCError: %s", str(self), str(msgerr))
+                self._send_rpc_reply_error(msgerr)
+            else:
+                # If we are 1.0 we have to simply close the connection
+                # as we are not allowed to send this error
+                logger.warning("Closing 1.0 session due to malformed message")
+                raise ncerror.SessionError(rpc, "Malformed message")
+        except ncerror.RPCServerError as error:
+            if self.debug:
+                logger.debug("%s: RPCServerError: %s", str(self), str(error))
+            self._send_rpc_reply_error(error)
+        except EOFError:
+            if self.debug:
+                logger.debug("%s: Got EOF in reader_handle_message", str(self))
+            error = ncerror.RPCSvrException(rpc, EOFError("EOF"))
+            self._send_rpc_reply_error(error)
+        except Exception as exception:
+            if self.debug:
+                logger.debug("%s: Got unexpected exception in reader_handle_message: %s",
+                             str(self), str(exception))
+            error = ncerror.RPCSvrException(rpc, exception)
+            self._send_rpc_reply_error(error)
 
     def _reader_exits(self):
         if self.debug:
@@ -299,21 +384,16 @@ class NetconfServerSession(base.NetconfSession):
         if not self.session_open:
             return
 
-        # Any error with XML encoding here is going to cause a session close
-        # Technically we should be able to return malformed message I think.
-        try:
-            tree = etree.parse(io.BytesIO(msg.encode('utf-8')))
-            if not tree:
-                raise ncerror.SessionError(msg, "Invalid XML from client.")
-        except etree.XMLSyntaxError:
-            logger.warning("Closing session due to malformed message")
-            raise ncerror.SessionError(msg, "Invalid XML from client.")
-
+        # The message has been parsed while it was received, any error with XML
+        # encoding has already closed the session.
+        tree = msg.getroottree()
         rpcs = tree.xpath("/nc:rpc", namespaces=NSMAP)
         if not rpcs:
             raise ncerror.SessionError(msg, "No rpc found")
 
         for rpc in rpcs:
+            if not self.session_open:
+                return
             try:
                 msg_id = rpc.get('message-id')
                 if self.debug:
@@ -321,152 +401,120 @@ class NetconfServerSession(base.NetconfSession):
             except (TypeError, ValueError):
                 raise ncerror.SessionError(msg, "No valid message-id attribute found")
 
-            try:
-                # Get the first child of rpc as the method name
-                rpc_method = rpc.getchildren()
-                if len(rpc_method) != 1:
-                    if self.debug:
-                        logger.debug("%s: Bad Msg: msg-id: %s", str(self), msg_id)
-                    raise ncerror.MalformedMessageRPCError(rpc)
-                rpc_method = rpc_method[0]
-
-                rpcname = rpc_method.tag.replace(qmap('nc'), "")
-                params = rpc_method.getchildren()
-                paramslen = len(params)
-                lock_target = None
+            if self.rpc_queue is not None:
+                self._queue_rpc(rpc)
+            else:
+                self._handle_rpc(rpc)
 
-                if self.debug:
-                    logger.debug("%s: RPC: %s: paramslen: %s", str(self), rpcname, str(paramslen))
-
-                if rpcname == "close-session":
-                    # XXX should be RPC-unlocking if need be
-                    if self.debug:
-                        logger.debug("%s: Received close-session msg-id: %s", str(self), msg_id)
-                    self._send_rpc_reply(etree.Element("ok"), rpc)
-                    self.close()
-                    # XXX should we also call the user method if it exists?
-                    return
-                elif rpcname == "kill-session":
-                    # XXX we are supposed to cleanly abort anything underway
-                    if self.debug:
-                        logger.debug("%s: Received kill-session msg-id: %s", str(self), msg_id)
-                    self._send_rpc_reply(etree.Element("ok"), rpc)
-                    self.close()
-                    # XXX should we also call the user method if it exists?
-                    return
-                elif rpcname == "get":
-                    # Validate GET parameters
-
-                    if paramslen > 1:
-                        # XXX need to specify all elements not known
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    if params and not util.filter_tag_match(params[0], "nc:filter"):
-                        raise ncerror.UnknownElementProtoError(rpc, params[0])
-                    if not params:
-                        params = [None]
-                elif rpcname == "get-config":
-                    # Validate GET-CONFIG parameters
-
-                    if paramslen > 2:
-                        # XXX Should be ncerror.UnknownElementProtoError? for each?
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    source_param = rpc_method.find("nc:source", namespaces=NSMAP)
-                    if source_param is None:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:source"))
-                    filter_param = None
-                    if paramslen == 2:
-                        filter_param = rpc_method.find("nc:filter", namespaces=NSMAP)
-                        if filter_param is None:
-                            unknown_elm = params[0] if params[0] != source_param else params[1]
-                            raise ncerror.UnknownElementProtoError(rpc, unknown_elm)
-                    params = [source_param, filter_param]
-                elif rpcname == "lock" or rpcname == "unlock":
-                    if paramslen != 1:
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    target_param = rpc_method.find("nc:target", namespaces=NSMAP)
-                    if target_param is None:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
-                    elms = target_param.getchildren()
-                    if len(elms) != 1:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
-                    lock_target = elms[0].tag.replace(qmap('nc'), "")
-                    if lock_target not in ["running", "candidate"]:
-                        raise ncerror.BadElementProtoError(rpc, util.qname("nc:target"))
-                    params = [lock_target]
-
-                    if rpcname == "lock":
-                        logger.error("%s: Lock Target: %s", str(self), lock_target)
-                        # Try and obtain the lock.
-                        locksid = self.server.lock_target(self, lock_target)
-                        if locksid:
-                            raise ncerror.LockDeniedProtoError(rpc, locksid)
-                    elif rpcname == "unlock":
-                        logger.error("%s: Unlock Target: %s", str(self), lock_target)
-                        # Make sure we have the lock.
-                        locksid = self.server.is_target_locked(lock_target)
-                        if locksid != self.session_id:
-                            # An odd error to return
-                            raise ncerror.LockDeniedProtoError(rpc, locksid)
-
-                #------------------
-                # Call the method.
-                #------------------
+    def _handle_rpc(self, rpc):
+        """Run an rpc and send its reply from the reader."""
+        try:
+            handler, params = self._prepare_rpc(rpc)
+        except Exception as error:
+            self._send_rpc_error(rpc, error)
+            return
 
-                try:
-                    # Handle any namespaces or prefixes in the tag, other than
-                    # "nc" which was removed above. Of course, this does not handle
-                    # namespace collisions, but that seems reasonable for now.
-                    rpcname = rpcname.rpartition("}")[-1]
-                    method_name = "rpc_" + rpcname.replace('-', '_')
-                    method = getattr(self.methods, method_name, None)
-
-                    if method is None:
-                        if rpcname in self.handled_rpc_methods:
-                            self._send_rpc_reply(etree.Element("ok"), rpc)
-                            method = None
-                        else:
-                            method = self._rpc_not_implemented
-
-                    if method is not None:
-                        if self.debug:
-                            logger.debug("%s: Calling method: %s", str(self), method_name)
-                        reply = method(self, rpc, *params)
-                        self._send_rpc_reply(reply, rpc)
-                except Exception:
-                    # If user raised error unlock if this was lock
-                    if rpcname == "lock" and lock_target:
-                        self.server.unlock_target(self, lock_target)
-                    raise
-
-                # If this was unlock and we're OK, release the lock.
-                if rpcname == "unlock":
-                    self.server.unlock_target(self, lock_target)
-
-            except ncerror.MalformedMessageRPCError as msgerr:
-                if self.new_framing:
-                    if self.debug:
-                        logger.debug("%s: MalformedMessageRPCError: %s", str(self), str(msgerr))
-                    self.send_message(msgerr.get_reply_msg())
-                else:
-                    # If we are 1.0 we have to simply close the connection
-                    # as we are not allowed to send this error
-                    logger.warning("Closing 1.0 session due to malformed message")
-                    raise ncerror.SessionError(msg, "Malformed message")
-            except ncerror.RPCServerError as error:
-                if self.debug:
-                    logger.debug("%s: RPCServerError: %s", str(self), str(error))
-                self._send_rpc_reply_error(error)
-            except EOFError:
-                if self.debug:
-                    logger.debug("%s: Got EOF in reader_handle_message", str(self))
-                error = ncerror.RPCSvrException(rpc, EOFError("EOF"))
-                self._send_rpc_reply_error(error)
-            except Exception as exception:
-                if self.debug:
-                    logger.debug("%s: Got unexpected exception in reader_handle_message: %s",
-                                 str(self), str(exception))
-                error = ncerror.RPCSvrException(rpc, exception)
-                self._send_rpc_reply_error(error)
+        reply, error = self._call_rpc(rpc, handler, params)
+        finish = functools.partial(self._finish_rpc, rpc, handler, params)
+        if error is None and self.engine is not None and self.engine.defer(reply, finish):
+            return
+        finish(reply, error)
+
+    def _queue_rpc(self, rpc):
+        """Queue an rpc on the server's worker pool, the reply is sent in order."""
+        try:
+            handler, params = self._prepare_rpc(rpc)
+        except Exception as error:
+            self.rpc_queue.submit(
+                lambda done: done(functools.partial(self._send_rpc_error, rpc, error)), True)
+            return
+
+        def job(done):
+            reply, error = self._call_rpc(rpc, handler, params)
+            finish = functools.partial(self._finish_rpc, rpc, handler, params)
+
+            def deferred(reply, error):
+                done(functools.partial(finish, reply, error))
+
+            if error is None and self.engine is not None and self.engine.defer(reply, deferred):
+                return
+            deferred(reply, error)
+
+        self.rpc_queue.submit(job, handler.readonly)
+
+    def _rpc_queue_error(self, error):
+        # Sending a reply from the worker pool failed, the session is unusable.
+        if isinstance(error, (ncerror.ChannelClosed, EOFError, IOError)):
+            logger.debug("%s: Session channel closed: %s", str(self), str(error))
+        else:
+            logger.error("%s Session error [closing session]: %s", str(self), str(error))
+        self.close()
+
+    def _prepare_rpc(self, rpc):
+        """Validate an rpc in the reader before its method is called.
+
+        A lock is obtained here so that lock requests are granted in the order
+        they are received.
+
+        :return: (`dispatch.RPCHandler`, params)
+        :raises: `ncerror.RPCServerError` for invalid requests.
+        """
+        # Get the first child of rpc as the method name
+        rpc_method = rpc.getchildren()
+        if len(rpc_method) != 1:
+            if self.debug:
+                logger.debug("%s: Bad Msg: msg-id: %s", str(self), rpc.get('message-id'))
+            raise ncerror.MalformedMessageRPCError(rpc)
+        rpc_method = rpc_method[0]
+
+        handler = self.server.rpc_registry.lookup(rpc_method.tag)
+        if self.debug:
+            logger.debug("%s: RPC: %s: paramslen: %s", str(self), handler.tag, len(rpc_method))
+        params = handler.get_params(rpc, rpc_method)
+
+        if handler.name == "lock":
+            logger.error("%s: Lock Target: %s", str(self), params[0])
+            # Try and obtain the lock.
+            locksid = self.server.lock_target(self, params[0])
+            if locksid:
+                raise ncerror.LockDeniedProtoError(rpc, locksid)
+        elif handler.name == "unlock":
+            logger.error("%s: Unlock Target: %s", str(self), params[0])
+            # Make sure we have the lock.
+            locksid = self.server.is_target_locked(params[0])
+            if locksid != self.session_id:
+                # An odd error to return
+                raise ncerror.LockDeniedProtoError(rpc, locksid)
+        return handler, params
+
+    def _call_rpc(self, rpc, handler, params):
+        """Call the method of an rpc, return (reply, exception or None)."""
+        try:
+            return handler.method(self, rpc, *params), None
+        except Exception as ex:
+            return None, ex
+
+    def _finish_rpc(self, rpc, handler, params, reply, error):
+        """Send the reply of an rpc, or the error raised by its method."""
+        failed = error is not None
+        try:
+            if error is None:
+                self._send_rpc_reply(reply, rpc)
+        except (ncerror.ChannelClosed, ncerror.SessionError):
+            raise
+        except Exception as ex:
+            failed = True
+            error = ex
+        if failed:
+            # If user raised error unlock if this was lock
+            if handler.name == "lock" and handler.namespace == NSMAP['nc']:
+                self.server.unlock_target(self, params[0])
+            self._send_rpc_error(rpc, error)
+        elif handler.name == "unlock" and handler.namespace == NSMAP['nc']:
+            # If this was unlock and we're OK, release the lock.
+            self.server.unlock_target(self, params[0])
+        elif handler.name in dispatch.SESSION_RPCS and handler.namespace == NSMAP['nc']:
+            self.close()
 
 
 class NetconfMethods(object):
@@ -477,6 +525,10 @@ class NetconfMethods(object):
     in the methods object, so feel free to use duck-typing here (i.e., no need to
     inherit). Create a class that implements the rpc_* methods you handle and pass
     that to `NetconfSSHServer` init.
+
+    The rpc_* methods are looked up once when the server is created. Methods of
+    RPCs defined in other YANG modules can be decorated with `dispatch.rpc` to
+    give their namespace and parameters.
     """
 
     def nc_append_capabilities(self, capabilities):  # pylint: disable=W0613
@@ -497,7 +549,8 @@ class NetconfMethods(object):
         :type rpc: `lxml.Element`
         :param filter_or_none: The filter element if present.
         :type filter_or_none: `lxml.Element` or None
-        :return: `lxml.Element` of "nc:data" type containing the requested state.
+        :return: `lxml.Element` of "nc:data" type containing the requested state, or a
+                 `StreamingReply` writing it.
         :raises: `error.RPCServerError` which will be used to construct an XML error response.
         """
         raise ncerror.OperationNotSupportedProtoError(rpc)
@@ -514,7 +567,8 @@ class NetconfMethods(object):
         :type source_elm: `lxml.Element`
         :param filter_or_none: The filter element if present.
         :type filter_or_none: `lxml.Element` or None
-        :return: `lxml.Element` of "nc:data" type containing the requested state.
+        :return: `lxml.Element` of "nc:data" type containing the requested state, or a
+                 `StreamingReply` writing it.
         :raises: `error.RPCServerError` which will be used to construct an XML error response.
         """
         raise ncerror.OperationNotSupportedProtoError(rpc)
@@ -629,10 +683,32 @@ class NetconfSSHServer(sshutil.server.SSHServer):
     :param port: The port to bind the server to.
     :param host_key: The file containing the host key.
     :param debug: True to enable debug logging.
+    :param engine: An `aio.SessionEngine` to read the sessions with instead of a
+                   thread per session. The rpc_* methods are then called from
+                   the engine's executor and may also be coroutine functions.
+    :param pool: A `workers.WorkerPool` to call the rpc_* methods on instead of
+                 the session reader. Replies are still sent in message order
+                 and only the read-only RPCs (see `dispatch.rpc`) of a session
+                 run concurrently.
+    :param compact: True to send replies as compact UTF-8 instead of indented
+                    XML, indentation is then only used for debug logging.
     """
 
-    def __init__(self, server_ctl=None, server_methods=None, port=830, host_key=None, debug=False):
+    def __init__(self,
+                 server_ctl=None,
+                 server_methods=None,
+                 port=830,
+                 host_key=None,
+                 debug=False,
+                 engine=None,
+                 pool=None,
+                 compact=False):
         self.server_methods = server_methods if server_methods is not None else NetconfMethods()
+        self.engine = engine
+        self.pool = pool
+        self.compact = compact
+        self.rpc_registry = dispatch.RPCRegistry(self.server_methods,
+                                                 NetconfServerSession.handled_rpc_methods)
         self.session_id = 1
         self.session_locks_lock = threading.Lock()
         self.session_locks = {
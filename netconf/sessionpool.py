@@ -0,0 +1,424 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A pool of opened netconf client sessions.
+
+Opening a `client.NetconfSSHSession` costs an SSH key exchange, authentication
+and the hello exchange. A `NetconfSessionPool` keeps sessions that have been
+released to hand them out again, per target (host, port and username)::
+
+    pool = NetconfSessionPool(max_per_target=2, spares=1)
+    with pool.session("router1", username="admin", password="admin") as session:
+        config = session.get_config()
+
+Idle sessions are checked before they are handed out, closed after an idle
+TTL, and a background thread keeps spare sessions opened for the targets in use.
+Spares are opened concurrently, a target that fails to open is retried after a
+backoff.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import concurrent.futures
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from monotonic import monotonic
+
+from netconf.client import NetconfSSHSession
+from netconf.error import SessionError
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(SessionError):
+    """No session of a target became available in time."""
+    pass
+
+
+class _Target(object):
+    def __init__(self, key, password):
+        self.key = key
+        self.password = password
+        # Released sessions as (session, released time), the most recent last.
+        self.idle = collections.deque()
+        self.in_use = 0
+        self.opening = 0
+        self.last_used = monotonic()
+        # Consecutive failures to open a session and when spares are opened again.
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def count(self):
+        return len(self.idle) + self.in_use + self.opening
+
+
+class NetconfSessionPool(object):
+    """Opened netconf client sessions shared by the threads of a process.
+
+    :param max_per_target: Maximum sessions (in use, idle or opening) per target.
+    :param idle_ttl: Seconds an idle session is kept beyond the spares, and
+                     that spares are kept after a target was last used.
+    :param spares: Number of idle sessions kept opened for each target in use.
+    :param check_after: Seconds idle after which `health_check` is called
+                        before the session is handed out.
+    :param health_check: Called with an idle session, returns False or raises
+                         if the session can't be used (e.g.,
+                         ``lambda s: s.get_config(select="/sys:system") is not None``),
+                         None to only check that the session is active.
+    :param connect: Called as connect(host, port, username, password) to open
+                    a session, by default a `NetconfSSHSession` is opened with
+                    `session_args`.
+    :param interval: Seconds between runs of the maintenance thread.
+    :param open_workers: Number of spare sessions opened concurrently.
+    :param max_backoff: Maximum seconds spares of a target that fails to open
+                        aren't opened for, the backoff doubles from `interval`
+                        with each failure.
+    :param session_args: Keyword arguments of `NetconfSSHSession` (e.g., cache, compact).
+    """
+
+    def __init__(self,
+                 max_per_target=4,
+                 idle_ttl=300,
+                 spares=0,
+                 check_after=30,
+                 health_check=None,
+                 connect=None,
+                 interval=1.0,
+                 open_workers=4,
+                 max_backoff=60.0,
+                 **session_args):
+        if max_per_target < 1 or spares < 0 or spares > max_per_target:
+            raise ValueError("Need 0 <= spares <= max_per_target and max_per_target >= 1")
+        if open_workers < 1:
+            raise ValueError("Need open_workers >= 1")
+        self.max_per_target = max_per_target
+        self.idle_ttl = idle_ttl
+        self.spares = spares
+        self.check_after = check_after
+        self.health_check = health_check
+        self.connect = connect
+        self.session_args = session_args
+        self.interval = interval
+        self.max_backoff = max_backoff
+        # Opens the spares, so a target slow to connect doesn't delay the others.
+        self.executor = concurrent.futures.ThreadPoolExecutor(open_workers)
+        self.cv = threading.Condition()
+        self.targets = {}
+        # The target key of the sessions handed out.
+        self.leased = {}
+        self.closed = False
+
+        self.acquires = 0
+        self.hits = 0
+        self.opened = 0
+        self.open_failures = 0
+        self.open_total = 0.0
+        self.open_max = 0.0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.check_failures = 0
+        self.expired = 0
+        self.discarded = 0
+
+        self.thread = threading.Thread(target=self._maintain, name="NetconfSessionPool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return "NetconfSessionPool(targets:{})".format(len(self.targets))
+
+    def close(self):
+        """Close the idle sessions, sessions in use are closed when released."""
+        with self.cv:
+            self.closed = True
+            idle = [x[0] for target in self.targets.values() for x in target.idle]
+            for target in self.targets.values():
+                target.idle.clear()
+            self.cv.notify_all()
+        for session in idle:
+            self._close_session(session)
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        # Spares still opening are closed once opened.
+        self.executor.shutdown(wait=False)
+
+    @contextmanager
+    def session(self, host, port=830, username=None, password=None, timeout=None):
+        """A context manager handing out a session of a target and releasing it.
+
+        The session is discarded instead of kept if the block raises a
+        `SessionError` or a socket error.
+        """
+        session = self.acquire(host, port, username, password, timeout)
+        discard = False
+        try:
+            yield session
+        except (SessionError, EnvironmentError):
+            discard = True
+            raise
+        finally:
+            self.release(session, discard)
+
+    def _get_target(self, host, port, username, password):
+        # Must be called with cv held.
+        if username is None:
+            import getpass
+            username = getpass.getuser()
+        key = (host, port, username)
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = _Target(key, password)
+        elif password is not None:
+            target.password = password
+        return target
+
+    def acquire(self, host, port=830, username=None, password=None, timeout=None):
+        """Return a session of a target, opening one if none is idle.
+
+        Waits for a session to be released if the target has `max_per_target`.
+
+        :param timeout: Seconds to wait for a session or None to wait forever.
+        :return: An opened `NetconfSSHSession` to be passed to `release`.
+        :raises: PoolTimeoutError, SessionError
+        """
+        start = monotonic()
+        while True:
+            session, idle_since, target = self._take(host, port, username, password, start,
+                                                     timeout)
+            if session is None:
+                break
+            if self._check(session, idle_since):
+                self._lease(session, target, start, hit=True)
+                return session
+            with self.cv:
+                self.check_failures += 1
+                target.in_use -= 1
+                self.cv.notify_all()
+            self._close_session(session)
+
+        # Open a session in the slot taken for it.
+        try:
+            session = self._open(target)
+        except Exception:
+            with self.cv:
+                target.opening -= 1
+                self.cv.notify_all()
+            raise
+        with self.cv:
+            target.opening -= 1
+            target.in_use += 1
+        self._lease(session, target, start, hit=False)
+        return session
+
+    def _take(self, host, port, username, password, start, timeout):
+        # Return an idle session taken for use or take a slot to open one.
+        with self.cv:
+            target = self._get_target(host, port, username, password)
+            while True:
+                if self.closed:
+                    raise SessionError("{} is closed".format(self))
+                target.last_used = monotonic()
+                if target.idle:
+                    session, idle_since = target.idle.pop()
+                    target.in_use += 1
+                    self.cv.notify_all()
+                    return session, idle_since, target
+                if target.count() < self.max_per_target:
+                    target.opening += 1
+                    return None, None, target
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (monotonic() - start)
+                    if remaining <= 0:
+                        raise PoolTimeoutError("Timeout ({}s) waiting for a session to {}".format(
+                            timeout, target.key))
+                self.cv.wait(remaining)
+
+    def _lease(self, session, target, start, hit):
+        wait = monotonic() - start
+        with self.cv:
+            self.leased[session] = target.key
+            self.acquires += 1
+            self.hits += hit
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            # Replace the spare just handed out.
+            self.cv.notify_all()
+
+    def release(self, session, discard=False):
+        """Give back a session returned by `acquire`.
+
+        :param discard: True to close the session instead of keeping it.
+        """
+        keep = not discard and session.is_active()
+        with self.cv:
+            key = self.leased.pop(session)
+            target = self.targets[key]
+            target.in_use -= 1
+            if keep and not self.closed:
+                target.idle.append((session, monotonic()))
+            else:
+                keep = False
+                self.discarded += discard
+            self.cv.notify_all()
+        if not keep:
+            self._close_session(session)
+
+    def _check(self, session, idle_since):
+        try:
+            if not session.is_active():
+                return False
+            if self.health_check is not None and monotonic() - idle_since >= self.check_after:
+                return self.health_check(session) is not False
+        except Exception as error:
+            logger.info("%s: Health check of %s failed: %s", str(self), str(session), str(error))
+            return False
+        return True
+
+    def _open(self, target):
+        host, port, username = target.key
+        start = monotonic()
+        try:
+            if self.connect is not None:
+                session = self.connect(host, port, username, target.password)
+            else:
+                session = NetconfSSHSession(host, port, username, target.password,
+                                            **self.session_args)
+        except Exception:
+            with self.cv:
+                self.open_failures += 1
+                target.failures += 1
+                backoff = min(self.interval * 2**(target.failures - 1), self.max_backoff)
+                target.retry_at = monotonic() + backoff
+            raise
+        elapsed = monotonic() - start
+        with self.cv:
+            target.failures = 0
+            target.retry_at = 0.0
+            self.opened += 1
+            self.open_total += elapsed
+            self.open_max = max(self.open_max, elapsed)
+        return session
+
+    def _close_session(self, session):
+        try:
+            session.close()
+        except Exception as error:
+            logger.debug("%s: Exception closing %s: %s", str(self), str(session), str(error))
+
+    def warm(self, host, port=830, username=None, password=None, count=1):
+        """Open sessions of a target ahead of use, up to `max_per_target`.
+
+        :return: The number of sessions opened.
+        """
+        opened = 0
+        for _ in range(count):
+            with self.cv:
+                target = self._get_target(host, port, username, password)
+                if self.closed or target.count() >= self.max_per_target:
+                    break
+                target.last_used = monotonic()
+                target.opening += 1
+            if self._open_idle(target):
+                opened += 1
+        return opened
+
+    def _open_idle(self, target):
+        # Open a session in the slot taken for it and keep it idle.
+        try:
+            session = self._open(target)
+        except Exception as error:
+            logger.warning("%s: Failed to open spare session to %s: %s", str(self),
+                           str(target.key), str(error))
+            session = None
+        kept = False
+        with self.cv:
+            target.opening -= 1
+            if session is not None and not self.closed:
+                target.idle.appendleft((session, monotonic()))
+                kept = True
+            self.cv.notify_all()
+        if session is not None and not kept:
+            self._close_session(session)
+        return kept
+
+    def _maintain(self):
+        while True:
+            with self.cv:
+                if self.closed:
+                    return
+                self.cv.wait(self.interval)
+                if self.closed:
+                    return
+                expired, spares = self._expire()
+            for session in expired:
+                self._close_session(session)
+            for target in spares:
+                self.executor.submit(self._open_spare, target)
+
+    def _open_spare(self, target):
+        try:
+            self._open_idle(target)
+        except Exception as error:
+            logger.error("%s: Unexpected exception opening spare: %s: %s", str(self), str(error),
+                         traceback.format_exc())
+
+    def _expire(self):
+        # Must be called with cv held. Returns the idle sessions to close and
+        # a target for each spare to open, with its slot taken.
+        now = monotonic()
+        expired = []
+        spares = []
+        for key, target in list(self.targets.items()):
+            active = now - target.last_used < self.idle_ttl
+            keep = self.spares if active else 0
+            # The oldest idle sessions are at the left.
+            while len(target.idle) > keep and now - target.idle[0][1] >= self.idle_ttl:
+                expired.append(target.idle.popleft()[0])
+                self.expired += 1
+            if not active:
+                if not target.count() and not target.idle:
+                    del self.targets[key]
+                continue
+            if now < target.retry_at:
+                continue
+            while len(target.idle) + target.opening < self.spares and \
+                    target.count() < self.max_per_target:
+                target.opening += 1
+                spares.append(target)
+        return expired, spares
+
+    def stats(self):
+        """Return a dictionary with a consistent copy of the counters."""
+        with self.cv:
+            return {
+                "targets": len(self.targets),
+                "in-use": sum(x.in_use for x in self.targets.values()),
+                "idle": sum(len(x.idle) for x in self.targets.values()),
+                "opening": sum(x.opening for x in self.targets.values()),
+                "acquires": self.acquires,
+                "hits": self.hits,
+                "opened": self.opened,
+                "open-failures": self.open_failures,
+                "open-total": self.open_total,
+                "open-max": self.open_max,
+                "open-avg": self.open_total / self.opened if self.opened else 0.0,
+                "wait-total": self.wait_total,
+                "wait-max": self.wait_max,
+                "wait-avg": self.wait_total / self.acquires if self.acquires else 0.0,
+                "check-failures": self.check_failures,
+                "expired": self.expired,
+                "discarded": self.discarded,
+            }
@@ -156,71 +156,76 @@ def xpath_filter_result(data, xpath):
     return data
 
 
-def subtree_filter(data,rpc):
-
-    # Aqui estan los distintos componentes de la base de datos
-    for filter_item in rpc.iter(qmap('nc')+'filter'):
-        filter_tree = filter_item
-
-    unprunned_toreturn = data
-    filter_elm = filter_tree
-
-    logging.info(etree.tostring(unprunned_toreturn,pretty_print=True))
-    logging.info(etree.tostring(filter_elm,pretty_print=True))
-
-    def check_content_match(data):
-        response = False
-        for child in data:
-            if not(child.text == '' or child.text is None):
-                response = True
-        return response
-
-    def prune_descendants(data,filter):
-        logging.info("The child " + filter.tag + " is a content match: " + str(check_content_match(filter)))
-        if check_content_match(filter):
-
-            # logging.info("Elements of the content match: ------------------")
-            # logging.info(etree.tostring(data,pretty_print=True))
-            # logging.info(etree.tostring(filter, pretty_print=True))
-
-            #find content match element
-            for child in filter:
-                if not(child.text is '' or child.text is None):
-                    matching_elem = child
-            # logging.info("Looking for the element " + matching_elem.tag + " , " + matching_elem.text)
-
-            # Checking if the current elem matches the seached one
-            if data.find(matching_elem.tag) is not None and data.find(matching_elem.tag).text == matching_elem.text:
-                # logging.info("This element matches")
-                #logging.info(etree.tostring(data,pretty_print=True))
-                #logging.info(etree.tostring(filter, pretty_print=True))
-                if len(list(filter)) > 1:
-                    matching_elem.text = ''
-                    logging.info("Containment nodes inside")
-                    logging.info(etree.tostring(data,pretty_print=True))
-                    logging.info(etree.tostring(filter, pretty_print=True))
-                    prune_descendants(data,filter)
-            else:
-                # logging.info("This element doesnt match")
-                data.getparent().remove(data)
-
-        else:
-            for child in data:
+def _filter_tag_match(felm, delm):
+    """Check if data element `delm` matches filter node `felm`, a filter node
+    without a namespace matches any namespace."""
+    fqname = etree.QName(felm)
+    dqname = etree.QName(delm)
+    if fqname.localname != dqname.localname:
+        return False
+    return fqname.namespace is None or fqname.namespace == dqname.namespace
 
-                if len(list(filter)) is not 0:
-                    if filter.find(child.tag) is not None:
-                        logging.info("Element " + child.tag + " found in data, so persisting it")
-                        prune_descendants(child, filter[0])
 
-                    else:
-                        logging.info("Element " + child.tag + " missing in data, deleting it")
-                        data.remove(child)
+def _is_content_match(felm):
+    return not len(felm) and not is_selection_node(felm)
 
-    prune_descendants(unprunned_toreturn,filter_elm)
 
-    #logging.info(etree.tostring(unprunned_toreturn,pretty_print=True))
+def _filter_siblings(delm, felms):
+    """Return a copy of `delm` pruned by the filter sibling set `felms`.
 
-    return unprunned_toreturn
+    None is returned if a content match node doesn't match or nothing below
+    `delm` is selected (RFC6241 6.2.5).
+    """
+    matches = [x for x in felms if _is_content_match(x)]
+    for felm in matches:
+        text = felm.text.strip()
+        if not any(
+                _filter_tag_match(felm, x) and (x.text or "").strip() == text
+                for x in delm.iterchildren(tag=etree.Element)):
+            return None
+    # Only content match nodes selects the whole subtree.
+    if len(matches) == len(felms):
+        return copy.deepcopy(delm)
+
+    result = etree.Element(delm.tag, delm.attrib, nsmap=delm.nsmap)
+    for child in delm.iterchildren(tag=etree.Element):
+        for felm in felms:
+            if not _filter_tag_match(felm, child):
+                continue
+            if _is_content_match(felm):
+                if (child.text or "").strip() != felm.text.strip():
+                    continue
+                selected = copy.deepcopy(child)
+            elif not len(felm):
+                selected = copy.deepcopy(child)
+            else:
+                # Several containment nodes for a list select a union of entries.
+                selected = _filter_siblings(child, list(felm.iterchildren(tag=etree.Element)))
+                if selected is None:
+                    continue
+            result.append(selected)
+            break
+    if not len(result):
+        return None
+    return result
+
+
+def subtree_filter(data, filter_elm):
+    """Return the part of `data` selected by subtree filter `filter_elm`.
+
+    The children of the filter are matched against the children of `data`,
+    an empty `data` element is returned if nothing is selected.
+
+    >>> data = etree.fromstring("<data><a><k>1</k><v>x</v></a><a><k>2</k><v>y</v></a></data>")
+    >>> felm = etree.fromstring("<filter><a><k>2</k><v/></a></filter>")
+    >>> etree.tounicode(subtree_filter(data, felm))
+    '<data><a><k>2</k><v>y</v></a></data>'
+    """
+    felms = list(filter_elm.iterchildren(tag=etree.Element))
+    result = _filter_siblings(data, felms) if felms else None
+    if result is None:
+        return etree.Element(data.tag, data.attrib, nsmap=data.nsmap)
+    return result
 
 
 def filter_results(rpc, data, filter_or_none, debug=False):
@@ -242,7 +247,7 @@ def filter_results(rpc, data, filter_or_none, debug=False):
 
     elif filter_or_none.attrib['type'] == "subtree":
         logger.debug("Filtering with subtree")
-        return subtree_filter(data,rpc)
+        return subtree_filter(data, filter_or_none)
 
     elif filter_or_none.attrib['type'] == "xpath":
         if 'select' not in filter_or_none.attrib:
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Run the RPCs of server sessions on a bounded pool of worker threads.
+
+The reader of a session (thread or `aio.SessionEngine`) only validates a
+received rpc and queues it, so it keeps reading (e.g., a <close-session>)
+while a slow <get> runs. A `WorkerPool` is shared by all sessions of a
+server, each session queues its RPCs through its own `SessionQueue`.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import logging
+import threading
+import traceback
+from monotonic import monotonic
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 16
+DEFAULT_MAX_PENDING = 256
+DEFAULT_DRAIN_TIMEOUT = 30
+
+
+class PoolClosed(RuntimeError):
+    """A job was submitted to a closed `WorkerPool`."""
+
+
+class WorkerPool(object):
+    """A fixed number of threads running queued jobs.
+
+    The pool also bounds the number of RPCs accepted from all sessions and not
+    yet replied to, a session reader waits in `acquire` when it's reached.
+
+    :param max_workers: Number of worker threads.
+    :param max_pending: Maximum RPCs pending over all sessions.
+    :param name: Prefix of the worker thread names.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 name="NetconfRPC"):
+        if max_workers < 1 or max_pending < 1:
+            raise ValueError("max_workers and max_pending must be positive")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.cv = threading.Condition()
+        self.slots = threading.Semaphore(max_pending)
+        self.jobs = collections.deque()
+        self.closed = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.queued_max = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.pending = 0
+        self.admission_waits = 0
+        self.admission_wait_total = 0.0
+
+        self.threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._worker, name="{}-{}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __str__(self):
+        return "WorkerPool(workers:{})".format(self.max_workers)
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """Wait until every RPC taken by `acquire` has been released.
+
+        The server is closed first so no RPC is accepted meanwhile, and then
+        the pool is drained before it is closed: the reply of an RPC may
+        start the next RPC of its session.
+
+        :param timeout: Seconds to wait at most or None to wait forever.
+        :return: True if the pool was drained.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cv:
+            while self.pending:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning("%s: %d RPCs still pending", str(self), self.pending)
+                    return False
+                self.cv.wait(remaining)
+        return True
+
+    def close(self):
+        """Stop the workers once the queued jobs have run."""
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def submit(self, func, *args):
+        """Queue a call of func(*args) on a worker thread.
+
+        :raises: `PoolClosed` if the pool is closed.
+        """
+        with self.cv:
+            if self.closed:
+                raise PoolClosed("{} is closed".format(self))
+            self.jobs.append((monotonic(), func, args))
+            self.submitted += 1
+            self.queued_max = max(self.queued_max, len(self.jobs))
+            self.cv.notify()
+
+    def acquire(self):
+        """Take a pending slot for an RPC, waiting if all are taken."""
+        if not self.slots.acquire(False):
+            start = monotonic()
+            self.slots.acquire()
+            with self.cv:
+                self.admission_waits += 1
+                self.admission_wait_total += monotonic() - start
+        with self.cv:
+            self.pending += 1
+
+    def release(self):
+        """Return the slot taken by `acquire` once the RPC has been replied to."""
+        with self.cv:
+            self.pending -= 1
+            if not self.pending:
+                self.cv.notify_all()
+        self.slots.release()
+
+    def _worker(self):
+        while True:
+            with self.cv:
+                while not self.jobs and not self.closed:
+                    self.cv.wait()
+                if not self.jobs:
+                    return
+                queued, func, args = self.jobs.popleft()
+                start = monotonic()
+                wait = start - queued
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.running += 1
+
+            failed = False
+            try:
+                func(*args)
+            except Exception as error:
+                failed = True
+                logger.error("%s: Unexpected exception in job: %s: %s", str(self), str(error),
+                             traceback.format_exc())
+
+            with self.cv:
+                self.running -= 1
+                self.completed += 1
+                self.failed += failed
+                self.run_total += monotonic() - start
+
+    def stats(self):
+        """Return a dictionary with a consistent copy of the counters."""
+        with self.cv:
+            started = self.submitted - len(self.jobs)
+            return {
+                "workers": self.max_workers,
+                "running": self.running,
+                "queued": len(self.jobs),
+                "queued-max": self.queued_max,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait-total": self.wait_total,
+                "wait-max": self.wait_max,
+                "wait-avg": self.wait_total / started if started else 0.0,
+                "run-total": self.run_total,
+                "pending": self.pending,
+                "max-pending": self.max_pending,
+                "admission-waits": self.admission_waits,
+                "admission-wait-total": self.admission_wait_total,
+            }
+
+
+class SessionQueue(object):
+    """The RPCs of one session running on a `WorkerPool`.
+
+    Read-only RPCs run concurrently with each other, any other RPC runs alone
+    once all RPCs received before it have been replied to. Replies are sent in
+    the order the RPCs were received.
+
+    A job is called on a worker as job(done) and must call done(send) exactly
+    once, possibly later from another thread; send() is then called on a
+    worker to send the reply when all earlier replies have been sent.
+
+    :param pool: The `WorkerPool` running the jobs.
+    :param on_error: Called with the exception if a send() raises.
+    """
+
+    def __init__(self, pool, on_error):
+        self.pool = pool
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.waiting = collections.deque()
+        self.ready = {}
+        self.next_seq = 0
+        self.send_seq = 0
+        self.reads = 0
+        self.writing = False
+        self.sending = False
+
+    def submit(self, job, readonly):
+        """Queue job, called by the session reader in message order."""
+        self.pool.acquire()
+        with self.lock:
+            self.waiting.append((self.next_seq, job, readonly))
+            self.next_seq += 1
+            starts = self._startable()
+        self._start(starts)
+
+    def _startable(self):
+        # Must be called with lock held.
+        starts = []
+        while self.waiting and not self.writing:
+            seq, job, readonly = self.waiting[0]
+            if not readonly:
+                if self.reads:
+                    break
+                self.writing = True
+            else:
+                self.reads += 1
+            self.waiting.popleft()
+            starts.append((seq, job, readonly))
+        return starts
+
+    def _start(self, starts):
+        for i, (seq, job, readonly) in enumerate(starts):
+            try:
+                self.pool.submit(self._run, seq, job, readonly)
+            except PoolClosed:
+                self._drop(starts[i:])
+                return
+
+    def _drop(self, starts):
+        # The pool is closed: the RPCs not started and those waiting are
+        # dropped without a reply, their slots released in order.
+        with self.lock:
+            dropped = [(seq, readonly) for seq, _, readonly in starts]
+            for seq, _, readonly in self.waiting:
+                # Counted as started, as `_send_ready` uncounts them.
+                if readonly:
+                    self.reads += 1
+                else:
+                    self.writing = True
+                dropped.append((seq, readonly))
+            self.waiting.clear()
+            for seq, readonly in dropped:
+                self.ready[seq] = (None, readonly)
+        logger.debug("%s: Dropping %d RPCs", str(self.pool), len(dropped))
+        self._send_ready()
+
+    def _run(self, seq, job, readonly):
+        called = []
+
+        def done(send):
+            assert not called, "done called twice"
+            called.append(True)
+            with self.lock:
+                self.ready[seq] = (send, readonly)
+            self._send_ready()
+
+        try:
+            job(done)
+        except Exception as error:
+            logger.error("Unexpected exception in RPC job: %s: %s", str(error),
+                         traceback.format_exc())
+            if not called:
+                done(None)
+
+    def _send_ready(self):
+        # Send the replies that are next in order, one thread at a time. An
+        # RPC is complete only once its reply is sent so streamed replies are
+        # rendered before a following write runs.
+        while True:
+            with self.lock:
+                if self.sending or self.send_seq not in self.ready:
+                    return
+                send, readonly = self.ready.pop(self.send_seq)
+                self.send_seq += 1
+                self.sending = True
+            try:
+                if send is not None:
+                    send()
+            except Exception as error:
+                self.on_error(error)
+            finally:
+                self.pool.release()
+                with self.lock:
+                    self.sending = False
+                    if readonly:
+                        self.reads -= 1
+                    else:
+                        self.writing = False
+                    starts = self._startable()
+                self._start(starts)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""The compiled schema of the example module the tests edit and filter."""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+
+import Serializer
+
+NS = "http://example.net/yang/plat"
+MODULE = "example-plat"
+
+
+def _add(parent, node):
+    node.module = MODULE
+    parent.children[node.name] = node
+    parent.order.append(node.name)
+    return node
+
+
+def _schema():
+    module = Serializer.ModuleSerializer(MODULE, NS)
+    module.module = MODULE
+    components = _add(module, Serializer._Container("components", NS))
+    component = _add(components, Serializer._List("component", NS, ["name"]))
+    _add(component, Serializer._Leaf("name", NS, "string"))
+    config = _add(component, Serializer._Container("config", NS))
+    _add(config, Serializer._Leaf("name", NS, "string"))
+    _add(config, Serializer._Leaf("enabled", NS, "boolean"))
+    _add(config, Serializer._Leaf("count", NS, "uint32"))
+    state = _add(component, Serializer._Container("state", NS))
+    _add(state, Serializer._Leaf("name", NS, "string"))
+    _add(state, Serializer._Leaf("temp", NS, "int32"))
+    component._finish()
+    tags = _add(module, Serializer._Container("tags", NS))
+    _add(tags, Serializer._LeafList("tag", NS, "string"))
+    return module
+
+
+@pytest.fixture(scope="session")
+def schema():
+    """The `Serializer.ModuleSerializer` of module example-plat.
+
+    Each component of the components list has a config and a state
+    container, the tags container holds a leaf-list.
+    """
+    return _schema()
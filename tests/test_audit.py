@@ -0,0 +1,177 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Queue and write records with `Audit.AuditLog` into a stub collection.
+
+The stub holds the flusher in insert_many until its gate is opened, so that
+the queue can be filled while a batch is being written.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import threading
+import pytest
+
+import Audit
+
+
+class _Collection(object):
+    def __init__(self, gate=None, error=None):
+        self.batches = []
+        self.gate = gate
+        self.error = error
+        # Set once the flusher is writing a batch.
+        self.entered = threading.Event()
+
+    def insert_many(self, batch, ordered=True):  # pylint: disable=W0613
+        self.entered.set()
+        if self.gate is not None:
+            self.gate.wait(10)
+        if self.error is not None:
+            raise self.error
+        self.batches.append(list(batch))
+
+    def records(self):
+        return [x for batch in self.batches for x in batch]
+
+
+def _record(i):
+    return {"operation": "edit-config", "status": "success", "n": i}
+
+
+def _held(policy, max_queue=2):
+    """Return an audit log whose flusher is writing record 0 and waits for the gate."""
+    gate = threading.Event()
+    collection = _Collection(gate)
+    audit_log = Audit.AuditLog(collection, max_queue, flush_size=1, flush_interval=60,
+                               policy=policy)
+    assert audit_log.log(_record(0))
+    assert collection.entered.wait(10)
+    return audit_log, collection, gate
+
+
+def test_bad_parameters():
+    with pytest.raises(ValueError):
+        Audit.AuditLog(_Collection(), policy="bogus")
+    with pytest.raises(ValueError):
+        Audit.AuditLog(_Collection(), max_queue=0)
+
+
+def test_batches():
+    collection = _Collection()
+    audit_log = Audit.AuditLog(collection, flush_size=2, flush_interval=60)
+    try:
+        for i in range(5):
+            assert audit_log.log(_record(i))
+        assert audit_log.flush(10)
+        assert collection.records() == [_record(i) for i in range(5)]
+        assert all(len(x) <= 2 for x in collection.batches)
+        stats = audit_log.stats()
+        assert (stats["queued"], stats["flushed"], stats["pending"]) == (5, 5, 0)
+        assert stats["batches"] == len(collection.batches)
+    finally:
+        audit_log.close()
+
+
+def test_drop():
+    audit_log, collection, gate = _held("drop")
+    try:
+        assert audit_log.log(_record(1))
+        assert audit_log.log(_record(2))
+        assert not audit_log.log(_record(3))
+        stats = audit_log.stats()
+        assert (stats["queued"], stats["dropped"], stats["pending"]) == (3, 1, 3)
+        gate.set()
+        assert audit_log.flush(10)
+        assert collection.records() == [_record(i) for i in range(3)]
+        assert audit_log.stats()["flushed"] == 3
+    finally:
+        gate.set()
+        audit_log.close()
+
+
+def test_block():
+    audit_log, collection, gate = _held("block")
+    try:
+        assert audit_log.log(_record(1))
+        assert audit_log.log(_record(2))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(audit_log.log(_record(3))))
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+        assert audit_log.stats()["blocked"] == 1
+        gate.set()
+        thread.join(10)
+        assert result == [True]
+        assert audit_log.flush(10)
+        assert collection.records() == [_record(i) for i in range(4)]
+        stats = audit_log.stats()
+        assert (stats["queued"], stats["flushed"], stats["dropped"]) == (4, 4, 0)
+    finally:
+        gate.set()
+        audit_log.close()
+
+
+def test_flush_timeout():
+    audit_log, collection, gate = _held("drop")
+    try:
+        assert not audit_log.flush(0.05)
+        gate.set()
+        assert audit_log.flush(10)
+        assert audit_log.stats()["pending"] == 0
+    finally:
+        gate.set()
+        audit_log.close()
+
+
+def test_failed():
+    audit_log = Audit.AuditLog(_Collection(error=RuntimeError("down")), flush_interval=60)
+    try:
+        audit_log.log(_record(0))
+        audit_log.log(_record(1))
+        assert audit_log.flush(10)
+        stats = audit_log.stats()
+        assert (stats["failed"], stats["flushed"], stats["pending"]) == (2, 0, 0)
+    finally:
+        audit_log.close()
+
+
+def test_close_writes_queued():
+    collection = _Collection()
+    audit_log = Audit.AuditLog(collection, flush_size=100, flush_interval=60)
+    for i in range(3):
+        audit_log.log(_record(i))
+    audit_log.close()
+    assert not audit_log.thread.is_alive()
+    assert collection.records() == [_record(i) for i in range(3)]
+    assert not audit_log.log(_record(3))
+    stats = audit_log.stats()
+    assert (stats["flushed"], stats["dropped"], stats["pending"]) == (3, 1, 0)
+
+
+def test_close_releases_blocked():
+    audit_log, collection, gate = _held("block", max_queue=1)
+    assert audit_log.log(_record(1))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(audit_log.log(_record(2))))
+    thread.start()
+    thread.join(0.2)
+    closer = threading.Thread(target=audit_log.close)
+    closer.start()
+    thread.join(10)
+    # A record logged once closed is dropped rather than waiting.
+    assert result == [False]
+    gate.set()
+    closer.join(10)
+    assert collection.records() == [_record(0), _record(1)]
+    assert audit_log.stats()["dropped"] == 1
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Cache and invalidate renderings with `Cache.ReplyCache`."""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+from lxml import etree
+
+import Cache
+
+
+def _render(text, during=None):
+    def render():
+        if during is not None:
+            during()
+        return etree.fromstring("<m>{}</m>".format(text))
+
+    return render
+
+
+def _text(element):
+    return element.text
+
+
+@pytest.mark.parametrize("name", ["a", None])
+def test_invalidate(name):
+    cache = Cache.ReplyCache()
+    assert _text(cache.lookup("a", _render("1"))) == "1"
+    assert _text(cache.lookup("a", _render("2"))) == "1"
+    cache.invalidate(name)
+    assert _text(cache.lookup("a", _render("2"))) == "2"
+    assert cache.stats()["entries"] == 1
+
+
+@pytest.mark.parametrize("name", ["a", None])
+def test_write_during_render(name):
+    """A rendering raced by a write isn't stored, even of a datastore never seen before."""
+    cache = Cache.ReplyCache()
+    assert _text(cache.lookup("a", _render("1", lambda: cache.invalidate(name)))) == "1"
+    assert _text(cache.lookup("a", _render("2"))) == "2"
+    assert cache.stats()["misses"] == 2
+
+
+def test_evict():
+    cache = Cache.ReplyCache(max_entries=2)
+    for name in ("a", "b", "c"):
+        cache.lookup(name, _render(name))
+    assert cache.stats()["evictions"] == 1
+    assert _text(cache.lookup("a", _render("x"))) == "x"
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Validate the parameters of the built-in RPCs with `dispatch`."""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+from lxml import etree
+
+import netconf.error as ncerror
+from netconf import NSMAP, dispatch
+
+
+def _params(name, body):
+    rpc = etree.fromstring('<rpc xmlns="{}" message-id="1"><{}>{}</{}></rpc>'.format(
+        NSMAP["nc"], name, body, name))
+    handler = dispatch.RPCRegistry(object()).lookup(rpc[0].tag)
+    return handler.get_params(rpc, rpc[0])
+
+
+def test_commit_parameters():
+    assert _params("commit", "") == [None, None, None, None]
+    confirmed, timeout, persist, persist_id = _params(
+        "commit", "<confirmed/><confirm-timeout>60</confirm-timeout>")
+    assert etree.QName(confirmed).localname == "confirmed"
+    assert timeout.text == "60"
+    assert persist is None and persist_id is None
+
+
+@pytest.mark.parametrize("name, body, expected", [
+    ("commit", "<bogus/>", ncerror.UnknownElementProtoError),
+    ("discard-changes", "<bogus/>", ncerror.UnknownElementProtoError),
+    ("lock", "<target><candidate/></target><bogus/>", ncerror.UnknownElementProtoError),
+    ("lock", "", ncerror.MissingElementProtoError),
+    ("get", "<filter/><filter/>", ncerror.BadElementProtoError),
+])
+def test_bad_parameters(name, body, expected):
+    with pytest.raises(expected):
+        _params(name, body)
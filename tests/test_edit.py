@@ -0,0 +1,234 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Plan and apply each <edit-config> operation with `Edit`, and translate
+the changes into MongoDB updates.
+
+Run with ``python -m pytest tests`` from the repository root.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+from lxml import etree
+
+import Edit
+
+NS = "http://example.net/yang/plat"
+NC = Edit.NC_NAMESPACE
+# The IETF JSON field of the component list.
+COMPONENT = "example-plat:components.component"
+CURRENT = """
+<example-plat xmlns="{0}">
+  <components>
+    <component><name>a</name><config><name>a</name><count>1</count></config></component>
+    <component><name>b</name><config><name>b</name><count>2</count></config></component>
+  </components>
+  <tags><tag>x</tag><tag>y</tag></tags>
+</example-plat>
+""".format(NS)
+
+
+def _current():
+    return etree.fromstring(CURRENT, etree.XMLParser(remove_blank_text=True))
+
+
+def _config(body):
+    return etree.fromstring('<example-plat xmlns="{}" xmlns:nc="{}">{}</example-plat>'.format(
+        NS, NC, body))
+
+
+def _component(name, body="", operation=None):
+    attr = ' nc:operation="{}"'.format(operation) if operation else ""
+    return "<components><component{}><name>{}</name>{}</component></components>".format(
+        attr, name, body)
+
+
+def _plan(schema, body, default_operation="merge"):
+    return Edit.plan(_current(), _config(body), default_operation, schema)
+
+
+def _edit(schema, body, default_operation="merge"):
+    current = _current()
+    Edit.apply(current, Edit.plan(current, _config(body), default_operation, schema))
+    return current
+
+
+def _counts(module):
+    return dict((x.findtext("{%s}name" % NS), x.findtext("{%s}config/{%s}count" % (NS, NS)))
+                for x in module.iter("{%s}component" % NS))
+
+
+def test_merge_sets_only_changed_leaves(schema):
+    assert _plan(schema, _component("a", "<config><count>1</count></config>")) == []
+    changes = _plan(schema, _component("a", "<config><count>5</count></config>"))
+    assert [(x.op, x.exists) for x in changes] == [("set", True)]
+    assert changes[0].path[1] == ("{%s}component" % NS, (("{%s}name" % NS, "a"), ))
+    assert _counts(_edit(schema, _component("a", "<config><count>5</count></config>"))) == {
+        "a": "5",
+        "b": "2"
+    }
+
+
+def test_merge_adds_entry(schema):
+    changes = _plan(schema, _component("c", "<config><count>3</count></config>"))
+    assert [(x.op, x.exists) for x in changes] == [("set", False)]
+    assert _counts(_edit(schema, _component("c", "<config><count>3</count></config>"))) == {
+        "a": "1",
+        "b": "2",
+        "c": "3"
+    }
+
+
+def test_merge_into_empty_datastore(schema):
+    changes = Edit.plan(None, _config(_component("a")), "merge", schema)
+    assert [(x.op, x.exists, len(x.path)) for x in changes] == [("set", False, 1)]
+
+
+def test_replace(schema):
+    module = _edit(schema, _component("a", "<config><name>a</name></config>", "replace"))
+    assert _counts(module) == {"a": None, "b": "2"}
+    changes = _plan(schema, _component("c", "", "replace"))
+    assert [(x.op, x.exists) for x in changes] == [("set", False)]
+
+
+def test_create(schema):
+    with pytest.raises(Edit.DataExists):
+        _plan(schema, _component("a", "", "create"))
+    assert _counts(_edit(schema, _component("c", "", "create"))) == {"a": "1", "b": "2", "c": None}
+
+
+def test_delete(schema):
+    with pytest.raises(Edit.DataMissing):
+        _plan(schema, _component("c", "", "delete"))
+    changes = _plan(schema, _component("b", "", "delete"))
+    assert [(x.op, x.exists) for x in changes] == [("delete", True)]
+    assert _counts(_edit(schema, _component("b", "", "delete"))) == {"a": "1"}
+
+
+def test_remove(schema):
+    assert _plan(schema, _component("c", "", "remove")) == []
+    assert _counts(_edit(schema, _component("b", "", "remove"))) == {"a": "1"}
+
+
+def test_delete_in_new_node(schema):
+    body = _component("c", '<config nc:operation="delete"/>')
+    with pytest.raises(Edit.DataMissing):
+        _plan(schema, body)
+
+
+def test_default_operation_none(schema):
+    assert _plan(schema, _component("a", "<config><count>5</count></config>"), "none") == []
+    with pytest.raises(Edit.DataMissing):
+        _plan(schema, _component("c"), "none")
+    body = _component("a", '<config><count nc:operation="merge">5</count></config>')
+    assert _counts(_edit(schema, body, "none")) == {"a": "5", "b": "2"}
+
+
+def test_leaf_list_entries_by_value(schema):
+    assert _plan(schema, "<tags><tag>x</tag></tags>") == []
+    changes = _plan(schema, '<tags><tag nc:operation="delete">y</tag><tag>z</tag></tags>')
+    assert [(x.op, x.path[-1]) for x in changes] == [("delete", ("{%s}tag" % NS, "y")),
+                                                     ("set", ("{%s}tag" % NS, "z"))]
+    module = _edit(schema, '<tags><tag nc:operation="delete">y</tag><tag>z</tag></tags>')
+    assert [x.text for x in module.iter("{%s}tag" % NS)] == ["x", "z"]
+
+
+def test_missing_key(schema):
+    with pytest.raises(Edit.DataMissing):
+        _plan(schema, "<components><component><config/></component></components>")
+
+
+def test_bad_operation(schema):
+    with pytest.raises(Edit.BadOperation):
+        _plan(schema, _component("a", "", "bogus"))
+
+
+def test_unknown_schema(schema):
+    with pytest.raises(Edit.UnknownSchema) as info:
+        _plan(schema, "<components><other/></components>")
+    assert etree.QName(info.value.element).localname == "other"
+    with pytest.raises(Edit.UnknownSchema) as info:
+        Edit.plan(_current(), _config(_component("a")), "merge", None)
+    assert info.value.element is None
+
+
+def test_index_follows_apply(schema):
+    index = Edit.Index()
+    current = _current()
+    for name in ("c", "d", "a"):
+        changes = Edit.plan(current, _config(_component(name, "", "replace")), "merge", schema,
+                            index)
+        Edit.apply(current, changes, index)
+    changes = Edit.plan(current, _config(_component("d", "", "delete")), "merge", schema, index)
+    Edit.apply(current, changes, index)
+    assert _counts(current) == {"a": None, "b": "2", "c": None}
+    path = changes[0].path
+    assert Edit.find(current, path, index)[-1] is None
+    assert Edit.find(current, path[:1] + ((path[1][0], (("{%s}name" % NS, "c"), )), ),
+                     index)[-1] is not None
+
+
+def test_revert(schema):
+    current = _current()
+    before = etree.tostring(current)
+    index = Edit.Index()
+    body = (_component("a", "<config><count>7</count></config>") +
+            '<tags><tag nc:operation="delete">x</tag><tag>z</tag></tags>')
+    changes = Edit.plan(current, _config(body), "merge", schema, index)
+    changes += Edit.plan(current, _config(_component("b", "", "delete")), "merge", schema, index)
+    undo = []
+    Edit.apply(current, changes, index, undo)
+    assert etree.tostring(current) != before
+    Edit.revert(undo, index)
+    assert etree.tostring(current) == before
+    assert undo == []
+    step = ("{%s}component" % NS, (("{%s}name" % NS, "b"), ))
+    assert Edit.find(current, (("{%s}components" % NS, None), step), index)[-1] is not None
+
+
+def test_replacement():
+    module = Edit.replacement(_current(), _config('<tags><tag>z</tag></tags>'))
+    assert [etree.QName(x).localname for x in module] == ["tags"]
+    assert [x.text for x in module.iter("{%s}tag" % NS)] == ["z"]
+    module = Edit.replacement(_current(), _config('<tags nc:operation="delete"/>'))
+    assert len(module) == 0
+    with pytest.raises(Edit.DataMissing):
+        Edit.replacement(None, _config('<tags nc:operation="delete"/>'))
+    with pytest.raises(Edit.DataExists):
+        Edit.replacement(_current(), _config('<tags nc:operation="create"/>'))
+
+
+@pytest.mark.parametrize("body, expected", [
+    (_component("a", "<config><count>5</count></config>"),
+     [({"$set": {COMPONENT + ".$[e1].config.count": 5}}, [{"e1.name": "a"}])]),
+    (_component("a", '<config><count nc:operation="remove"/></config>'),
+     [({"$unset": {COMPONENT + ".$[e1].config.count": ""}}, [{"e1.name": "a"}])]),
+    (_component("c", "<config><count>3</count></config>"),
+     [({"$push": {COMPONENT: {"name": "c", "config": {"count": 3}}}}, None)]),
+    (_component("b", "", "delete"), [({"$pull": {COMPONENT: {"name": "b"}}}, None)]),
+    (_component("b", "", "remove"), [({"$pull": {COMPONENT: {"name": "b"}}}, None)]),
+    (_component("a", "<config><name>a</name></config>", "replace"),
+     [({"$set": {COMPONENT + ".$[e1]": {"name": "a", "config": {"name": "a"}}}},
+       [{"e1.name": "a"}])]),
+    ('<tags><tag nc:operation="delete">y</tag><tag>z</tag></tags>',
+     [({"$pull": {"example-plat:tags.tag": {"$in": ["y"]}}}, None),
+      ({"$addToSet": {"example-plat:tags.tag": "z"}}, None)]),
+])
+def test_mongo_updates(schema, body, expected):
+    assert Edit.mongo_updates(schema, _plan(schema, body)) == expected
+
+
+def test_mongo_updates_unsupported(schema):
+    changes = _plan(schema, _component("a", "<config><count>seven</count></config>"))
+    with pytest.raises(Edit.UnsupportedEdit):
+        Edit.mongo_updates(schema, changes)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Replay the journal of a `Journal.JournalDatastore` after a crash.
+
+A crash is simulated by copying the journal and base directories once the
+edits are synced, the journal datastore is then opened on the copies.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import os
+import shutil
+import pytest
+from lxml import etree
+
+import Datastore
+import Edit
+import Journal
+
+NS = "http://example.net/yang/plat"
+NAME = "example-plat"
+COMPONENTS = (("{%s}components" % NS, None), )
+
+
+def _component(name):
+    return etree.fromstring(
+        '<component xmlns="{}"><name>{}</name></component>'.format(NS, name))
+
+
+def _step(name):
+    return ("{%s}component" % NS, (("{%s}name" % NS, name), ))
+
+
+def _edit(ds, op, name):
+    current = ds.read(NAME)
+    if current is None:
+        current = Datastore.module_element(NAME, NS)
+    if current.find(COMPONENTS[0][0]) is None:
+        changes = [Edit.Change("set", COMPONENTS, etree.Element(COMPONENTS[0][0]), False)]
+        Edit.apply(current, changes)
+        ds.edit(NAME, changes, current)
+    path = COMPONENTS + (_step(name), )
+    element = _component(name) if op == "set" else None
+    changes = [Edit.Change(op, path, element, Edit.find(current, path)[-1] is not None)]
+    Edit.apply(current, changes)
+    ds.edit(NAME, changes, current)
+    ds.sync()
+
+
+def _names(ds):
+    module = ds.read(NAME)
+    if module is None:
+        return []
+    return [x.text for x in module.iter("{%s}name" % NS)]
+
+
+def _open(tmpdir, name="run"):
+    path = str(tmpdir.join(name))
+    base = Datastore.FileDatastore(os.path.join(path, "base"))
+    return Journal.JournalDatastore(base, os.path.join(path, "journal"), checkpoint_interval=3600)
+
+
+def _crash(tmpdir, name="run", crashed="crashed"):
+    """Copy the files of journal datastore `name` as a crash would leave them."""
+    shutil.copytree(str(tmpdir.join(name)), str(tmpdir.join(crashed)))
+
+
+def _journal_files(tmpdir, name):
+    return sorted(os.listdir(str(tmpdir.join(name, "journal"))))
+
+
+def test_rejects_memory_base(tmpdir):
+    with pytest.raises(ValueError):
+        Journal.JournalDatastore(Datastore.MemoryDatastore(), str(tmpdir.join("journal")))
+
+
+def test_replay(tmpdir):
+    ds = _open(tmpdir)
+    for name in ("a", "b", "c"):
+        _edit(ds, "set", name)
+    _edit(ds, "delete", "b")
+    _crash(tmpdir)
+    ds.close()
+
+    assert _names(Datastore.FileDatastore(str(tmpdir.join("crashed", "base")))) == []
+    ds = _open(tmpdir, "crashed")
+    try:
+        assert _names(ds) == ["a", "c"]
+        assert _names(ds.base) == ["a", "c"]
+        assert ds.stats()["replayed"] == 5
+        assert len(_journal_files(tmpdir, "crashed")) == 1
+    finally:
+        ds.close()
+
+
+def test_torn_record(tmpdir, caplog):
+    ds = _open(tmpdir)
+    _edit(ds, "set", "a")
+    _edit(ds, "set", "b")
+    _crash(tmpdir)
+    ds.close()
+    filename = os.path.join(str(tmpdir.join("crashed", "journal")),
+                            _journal_files(tmpdir, "crashed")[-1])
+    with open(filename, "ab") as f:
+        f.write(b'{"n":"example-plat","c":[["set"')
+
+    with caplog.at_level(logging.WARNING, logger="Journal"):
+        ds = _open(tmpdir, "crashed")
+    try:
+        assert _names(ds) == ["a", "b"]
+        assert ds.stats()["replayed"] == 3
+        assert any("torn record" in x.getMessage() for x in caplog.records)
+    finally:
+        ds.close()
+
+
+def test_crash_between_checkpoint_and_unlink(tmpdir):
+    ds = _open(tmpdir)
+    for name in ("a", "b"):
+        _edit(ds, "set", name)
+    _edit(ds, "delete", "a")
+    journal = str(tmpdir.join("run", "journal"))
+    kept = str(tmpdir.join("kept"))
+    shutil.copytree(journal, kept)
+    assert ds.checkpoint()
+    _edit(ds, "set", "c")
+    _crash(tmpdir)
+    ds.close()
+
+    # The journal files retired by the checkpoint weren't removed.
+    crashed = str(tmpdir.join("crashed", "journal"))
+    for filename in os.listdir(kept):
+        shutil.copy(os.path.join(kept, filename), crashed)
+    assert len(_journal_files(tmpdir, "crashed")) == 2
+    assert _names(Datastore.FileDatastore(str(tmpdir.join("crashed", "base")))) == ["b"]
+
+    ds = _open(tmpdir, "crashed")
+    try:
+        assert _names(ds) == ["b", "c"]
+        assert _names(ds.base) == ["b", "c"]
+        assert len(_journal_files(tmpdir, "crashed")) == 1
+    finally:
+        ds.close()
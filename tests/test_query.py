@@ -0,0 +1,147 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compare the filters pushed down by `Query` with the in-memory filters.
+
+The aggregation pipelines run on mongomock. XPath filters are compared with
+`util.xpath_filter_result`, which doesn't return the keys of the list entries
+selected below (RFC 6241 8.9.1), they are added to its result. Subtree filters
+are compared with the result RFC 6241 6.2.5 gives and with `util.filter_results`.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+from lxml import etree
+
+import Query
+from netconf import NSMAP, util
+
+mongomock = pytest.importorskip("mongomock")
+
+NS = "http://example.net/yang/plat"
+NC = NSMAP["nc"]
+MODULE = "example-plat"
+DOCUMENT = {
+    "example-plat:components": {
+        "component": [
+            {
+                "name": "a",
+                "config": {"name": "a", "enabled": True, "count": 3},
+                "state": {"name": "a", "temp": 40}
+            },
+            {
+                "name": "b",
+                "config": {"name": "b", "enabled": False}
+            },
+            {
+                "name": "c",
+                "config": {"name": "c", "enabled": True, "count": 7},
+                "state": {"name": "c", "temp": 55}
+            },
+        ]
+    }
+}
+
+
+@pytest.fixture
+def collection():
+    collection = mongomock.MongoClient().db[MODULE]
+    collection.insert_one(dict(DOCUMENT))
+    return collection
+
+
+def _pushdown(collection, schema, filter_elm):
+    for document in collection.aggregate(Query.subtree_pipeline(schema, filter_elm)):
+        return etree.tounicode(schema.to_element(document))
+
+
+def _module(body):
+    return '<{0} xmlns="{1}"><components>{2}</components></{0}>'.format(MODULE, NS, body)
+
+
+def _entry(name, body):
+    return "<component><name>{}</name>{}</component>".format(name, body)
+
+
+CONFIG_A = "<config><name>a</name><enabled>true</enabled><count>3</count></config>"
+ENTRY_A = _entry("a", CONFIG_A + "<state><name>a</name><temp>40</temp></state>")
+ENTRY_B = _entry("b", "<config><name>b</name><enabled>false</enabled></config>")
+ENTRY_C = _entry("c", ("<config><name>c</name><enabled>true</enabled><count>7</count></config>"
+                       "<state><name>c</name><temp>55</temp></state>"))
+
+
+@pytest.mark.parametrize("select, keys", [
+    ("/p:components", []),
+    ("/p:components/p:component", []),
+    ("/p:components/p:component[p:name='a']", []),
+    ("/p:components/p:component[p:name='c'] | /p:components/p:component[p:name='a']", []),
+    ("/p:components/p:component/p:config/p:enabled", []),
+    ("/p:components/p:component[p:name='c']/p:state", ["c"]),
+    ("/p:components/p:component[p:name='a'] | "
+     "/p:components/p:component[p:name='c']/p:config/p:count", ["c"]),
+])
+def test_xpath(collection, schema, monkeypatch, select, keys):
+    monkeypatch.setitem(NSMAP, "p", NS)
+    pushed = _pushdown(collection, schema, Query.xpath_subtree(select, {"p": NS}))
+
+    data = etree.Element("{" + NC + "}data")
+    data.extend(schema.to_element(DOCUMENT))
+    expected = etree.Element("{" + NS + "}" + MODULE, nsmap={None: NS})
+    expected.extend(util.xpath_filter_result(data, select))
+    # The keys of the entries selected below by key, in document order.
+    missing = [
+        x for x in expected.iter("{" + NS + "}component") if x.find("{" + NS + "}name") is None
+    ]
+    for entry, key in zip(missing, keys):
+        etree.SubElement(entry, "{" + NS + "}name").text = key
+        entry.insert(0, entry[-1])
+    assert pushed == etree.tounicode(expected)
+
+
+@pytest.mark.parametrize("body, expected", [
+    ("", _module(ENTRY_A + ENTRY_B + ENTRY_C)),
+    ("<component/>", _module(ENTRY_A + ENTRY_B + ENTRY_C)),
+    ("<component><name>a</name></component>", _module(ENTRY_A)),
+    ("<component><name>zz</name></component>",
+     '<{} xmlns="{}"/>'.format(MODULE, NS)),
+    ("<component><name>a</name><config/></component>",
+     _module(_entry("a", CONFIG_A))),
+    ("<component><name>c</name><state><temp/></state></component>",
+     _module(_entry("c", "<state><temp>55</temp></state>"))),
+    ("<component><config><enabled>false</enabled></config></component>",
+     _module("<component><config><name>b</name><enabled>false</enabled></config></component>")),
+    ("<component><state/></component>",
+     _module("<component><state><name>a</name><temp>40</temp></state></component>"
+             "<component><state><name>c</name><temp>55</temp></state></component>")),
+    ("<component><name>a</name></component><component><name>c</name></component>",
+     _module(ENTRY_A + ENTRY_C)),
+])
+def test_subtree(collection, schema, body, expected):
+    rpc = etree.fromstring('<rpc xmlns="{}"><get><filter type="subtree">'
+                           '<components xmlns="{}">{}</components></filter></get></rpc>'.format(
+                               NC, NS, body))
+    filter_elm = rpc[0][0]
+    pushed = _pushdown(collection, schema, filter_elm)
+    assert pushed == etree.tounicode(etree.fromstring(expected))
+    memory = util.filter_results(rpc, schema.to_element(DOCUMENT), filter_elm)
+    assert pushed == etree.tounicode(memory)
+
+
+def test_unsupported(schema):
+    with pytest.raises(Query.UnsupportedFilter):
+        Query.xpath_subtree("/p:components/p:component[p:config/p:count=7]", {"p": NS})
+    filter_elm = etree.fromstring('<filter><components xmlns="{}"><component>'
+                                  '<config><count>seven</count></config>'
+                                  '</component></components></filter>'.format(NS))
+    with pytest.raises(Query.UnsupportedFilter):
+        Query.subtree_pipeline(schema, filter_elm)
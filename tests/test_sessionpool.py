@@ -0,0 +1,101 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Open spare sessions with `sessionpool.NetconfSessionPool` through a stub connect.
+
+Target "slow" hangs in connect until its gate is opened and then fails, so the
+spares of the other targets must be opened while it is connecting.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import threading
+import time
+
+from netconf import sessionpool
+
+
+class _Session(object):
+    def is_active(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class _Connect(object):
+    def __init__(self):
+        self.gate = threading.Event()
+        self.down = set(["slow", "down"])
+        self.lock = threading.Lock()
+        self.attempts = {}
+
+    def __call__(self, host, port, username, password):  # pylint: disable=W0613
+        with self.lock:
+            self.attempts[host] = self.attempts.get(host, 0) + 1
+        if host == "slow":
+            self.gate.wait(10)
+        if host in self.down:
+            raise IOError("{} unreachable".format(host))
+        return _Session()
+
+
+def _wait(predicate, timeout=5):
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _target(pool, host):
+    with pool.cv:
+        return pool._get_target(host, 830, None, None)
+
+
+def test_slow_target_doesnt_delay_spares():
+    connect = _Connect()
+    pool = sessionpool.NetconfSessionPool(spares=2, connect=connect, interval=0.02)
+    try:
+        slow = _target(pool, "slow")
+        assert _wait(lambda: connect.attempts.get("slow") == 2)
+        pool.release(pool.acquire("fast"))
+        fast = _target(pool, "fast")
+        assert _wait(lambda: len(fast.idle) == 2)
+        assert slow.opening == 2 and not slow.idle
+        connect.gate.set()
+        assert _wait(lambda: slow.opening == 0)
+        assert slow.failures >= 1
+    finally:
+        connect.gate.set()
+        pool.close()
+
+
+def test_backoff():
+    connect = _Connect()
+    pool = sessionpool.NetconfSessionPool(spares=1, connect=connect, interval=0.02)
+    try:
+        assert pool.warm("down") == 0
+        time.sleep(0.5)
+        # Retried after 0.02, 0.04, 0.08, 0.16 and 0.32 seconds rather than every interval.
+        assert 2 <= connect.attempts["down"] <= 8
+        target = _target(pool, "down")
+        assert target.failures == connect.attempts["down"]
+        assert pool.stats()["open-failures"] == target.failures
+
+        # A session opened resets the backoff.
+        connect.down.discard("down")
+        assert pool.warm("down") == 1
+        assert (target.failures, target.retry_at) == (0, 0.0)
+    finally:
+        pool.close()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Validate data trees and edits with `Validation.Schema`.
+
+The YANG module is tests/yang/example-plat.yang. An edit validated with
+`validate_changes` must report what `validate` reports for the whole edited
+tree, except that a duplicate unique value is reported for the changed entry
+rather than for its list, so the messages and error-tags are compared.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import os
+import pytest
+from lxml import etree
+
+import Edit
+import Validation
+
+pytest.importorskip("pyang")
+
+NS = "http://example.net/yang/plat"
+NC = Edit.NC_NAMESPACE
+CURRENT = """
+<example-plat xmlns="{0}">
+  <components>
+    <component>
+      <name>a</name>
+      <config><name>a</name><enabled>true</enabled><count>1</count></config>
+      <state><name>a</name><temp>40</temp></state>
+    </component>
+    <component>
+      <name>b</name>
+      <config><name>b</name><enabled>false</enabled></config>
+    </component>
+  </components>
+  <tags><tag>a</tag></tags>
+</example-plat>
+""".format(NS)
+
+
+@pytest.fixture(scope="module")
+def yang():
+    return Validation.Schema([os.path.join(os.path.dirname(__file__), "yang")])
+
+
+def _current():
+    return etree.fromstring(CURRENT, etree.XMLParser(remove_blank_text=True))
+
+
+def _config(body):
+    return etree.fromstring('<example-plat xmlns="{}" xmlns:nc="{}">{}</example-plat>'.format(
+        NS, NC, body))
+
+
+def _component(name, body="", operation=None):
+    attr = ' nc:operation="{}"'.format(operation) if operation else ""
+    return "<components><component{}><name>{}</name>{}</component></components>".format(
+        attr, name, body)
+
+
+def _new(name, body="<enabled>false</enabled>"):
+    return _component(name, "<config><name>{}</name>{}</config>".format(name, body))
+
+
+def _messages(issues):
+    return sorted((x.message, x.tag) for x in issues)
+
+
+def test_valid(yang):
+    assert yang.validate(_current()) == []
+    yang.check(_current())
+
+
+@pytest.mark.parametrize("old, new, message, tag", [
+    ("<enabled>false</enabled>", "<enabled>maybe</enabled>", "boolean", "invalid-value"),
+    ("<enabled>false</enabled>", "<enabled>false</enabled><count>-1</count>", '"-1"',
+     "invalid-value"),
+    ("<name>b</name>", "<name>x</name>", 'leafref target "x"', "invalid-value"),
+    ("<enabled>false</enabled>", "", "missing mandatory node", "data-missing"),
+    ("<enabled>false</enabled>", "<enabled>false</enabled><bogus/>", "unknown element",
+     "unknown-element"),
+])
+def test_schema(yang, old, new, message, tag):
+    current = etree.tostring(_current(), encoding="unicode")
+    issues = yang.validate(etree.fromstring(current.replace(old, new, 1)))
+    assert len(issues) == 1
+    assert message in issues[0].message
+    assert issues[0].tag == tag
+    with pytest.raises(Validation.ValidationError) as info:
+        yang.check(etree.fromstring(current.replace(old, new, 1)))
+    assert info.value.issues == issues
+
+
+def test_missing_key(yang):
+    current = _current()
+    entry = current[0][1]
+    entry.remove(entry[0])
+    assert _messages(yang.validate(current)) == [("missing key name", "missing-element")]
+
+
+def test_state_in_configuration(yang):
+    assert yang.validate(_current(), config=True) == [
+        Validation.Issue("/components/component[name='a']/state", "state data in configuration",
+                         "invalid-value")
+    ]
+
+
+@pytest.mark.parametrize("body, message", [
+    (_component("a", "", "delete"), 'leafref target "a"'),
+    ('<tags><tag nc:operation="delete">a</tag></tags>', "too few elements (0 < 1)"),
+    (_new("c") + _new("d"), "too many elements (4 > 3)"),
+    (_component("b", "<config><count>1</count></config>"), "duplicate unique value ('1',)"),
+    (_component("b", "<config><enabled>true</enabled></config>"),
+     "an enabled component needs a count"),
+    (_component("b", '<config><enabled nc:operation="delete"/></config>'),
+     "missing mandatory node"),
+    (_component("b", "<config><count>seven</count></config>"), "not an integer"),
+    (_new("c", "<enabled>true</enabled><count>2</count>") + "<tags><tag>c</tag></tags>", None),
+    (_component("b", "<config><count>2</count></config>"), None),
+])
+def test_changes(schema, yang, body, message):
+    current = _current()
+    changes = Edit.plan(current, _config(body), "merge", schema)
+    located = Edit.apply(current, changes)
+    issues = yang.validate_changes(current, changes, located)
+    assert _messages(issues) == _messages(yang.validate(current))
+    assert _messages(yang.validate_changes(current, changes)) == _messages(issues)
+    if message is None:
+        assert issues == []
+    else:
+        assert len(issues) == 1 and message in issues[0].message
+
+
+def test_test_only(schema, yang):
+    """An edit validated and reverted leaves the working tree as it was."""
+    current = _current()
+    before = etree.tostring(current)
+    index = Edit.Index()
+    unique = Validation.Index()
+    changes = Edit.plan(current, _config(_new("c", "<enabled>false</enabled><count>5</count>")),
+                        "merge", schema, index)
+    undo = []
+    located = Edit.apply(current, changes, index, undo)
+    assert yang.validate_changes(current, changes, located, index=unique) == []
+    Edit.revert(undo, index)
+    assert etree.tostring(current) == before
+
+    # The unique values indexed for the reverted entry aren't found again.
+    for count, expected in (("5", []), ("1", ["duplicate unique value ('1',)"])):
+        body = _new("d", "<enabled>false</enabled><count>{}</count>".format(count))
+        changes = Edit.plan(current, _config(body), "merge", schema, index)
+        located = Edit.apply(current, changes, index, undo)
+        issues = yang.validate_changes(current, changes, located, index=unique)
+        assert [x.message for x in issues] == expected
+        Edit.revert(undo, index)
+    assert etree.tostring(current) == before